@@ -6,16 +6,29 @@ import html
 import json
 import logging
 import os
+import time
 import traceback
 
 import redis
-import telegram
-from telegram import ParseMode, Update
+from telegram import ParseMode, ReplyKeyboardMarkup, Update
 from telegram.ext import Updater, CommandHandler, CallbackContext
 import unidecode
 
-from checker import a2exams_checker
+from bot import broadcast
+from bot import city_index
+from bot import coalesce
+from bot import filters
+from bot import outbox
+from bot import shards
+from bot import subscriptions
+from checker import rollups
+from checker import schools_data
 import utils
+from utils import health
+from utils import profiler
+from utils import snapshot
+from utils import targets
+from utils import tracing
 
 NOTIFICATIONS_PAUSED = False
 UPDATE_INTERVAL = 20
@@ -23,8 +36,36 @@ TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 DEVELOPER_CHAT_ID = os.getenv('DEVELOPER_CHAT_ID')
 EXAMS_CHANNEL = os.getenv('EXAMS_CHANNEL')
 
-SCHOOLS_DATA = a2exams_checker.get_schools_from_file()
+# holds the state subscribers have last been told about, it is loaded when the bot starts
+COALESCER = coalesce.Coalescer()
+# monitored registration pages, cities of all but the main one are keyed <target>/<city>
+TARGETS = targets.load()
+# a private reader so that other consumers of the json can't swallow a generation change
+SCHOOLS_SNAPSHOT = schools_data.StateReader(TARGETS)
+# data of all targets as commands see it
+SCHOOLS = schools_data.StateReader(TARGETS)
+# freshness of data is tracked with a reader of its own for the same reason
+FRESHNESS_SNAPSHOT = snapshot.SnapshotReader(schools_data.LAST_FETCHED_JSON, loader=schools_data.load_schools,
+                                             default={})
+# slot release history maintained by the checker
+ROLLUPS_SNAPSHOT = snapshot.SnapshotReader(rollups.ROLLUPS_JSON, loader=rollups.load, default=rollups.empty())
 REDIS = redis.from_url(os.getenv('REDIS_URL', 'redis://redis:6379'))
+# NOTE(ivasilev) Every key in the main database is a subscriber's chat_id, so the bot's own bookkeeping
+# (broadcast jobs etc) lives in a separate database
+REDIS_INTERNAL = redis.from_url(os.getenv('REDIS_INTERNAL_URL', 'redis://redis:6379/1'))
+# Broadcast pace, telegram allows ~30 messages per second in total and notifications need some share too
+BROADCAST_RATE = int(os.getenv('BROADCAST_RATE', '20'))
+BROADCAST_INTERVAL = 1
+# Threads delivering notifications from the outbox, more senders can be run by bot/outbox.py elsewhere
+OUTBOX_SENDERS = int(os.getenv('OUTBOX_SENDERS', '2'))
+# Subscriptions are read from redis in chunks of that many chat_ids
+SUBSCRIPTIONS_CHUNK = 1000
+# Date and free slots filters of subscriptions indexed for matching, loaded by run()
+FILTERS = filters.FilterIndex()
+# In-process cache of subscriptions, set up by run() unless SUBSCRIPTION_CACHE_SIZE=0
+SUBSCRIPTIONS = None
+# If set, fan-out to subscribers is done by that many bot/shards.py workers and not by the bot itself
+NOTIFY_SHARDS = int(os.getenv('NOTIFY_SHARDS', '0'))
 
 # XXX FIXME This should not be there but can't think of a better way to get last update time for generic status
 # Using a coroutine to get last fetched time is not an option
@@ -40,17 +81,25 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
-def _vet_requested_cities(user_requested_cities, source_of_truth=SCHOOLS_DATA):
+def _get_city_index(source_of_truth=None):
+    """Index of the cities from the latest schools data unless other source of truth is given"""
+    if source_of_truth is None:
+        source_of_truth = SCHOOLS.get()
+    return city_index.get_index(source_of_truth)
+
+
+def _vet_requested_cities(user_requested_cities, source_of_truth=None):
     """Returns a tuple (cities_ok, cities_error) """
-    requested_cities = [" ".join(map(lambda d: d.title(), unidecode.unidecode(c).lower().split(' ')))
-                        for c in user_requested_cities]
-    if requested_cities:
-        invalid_options = set(requested_cities) - set(source_of_truth.keys())
-        if invalid_options:
-            cities_ok = sorted(set(requested_cities) - invalid_options)
-            return (cities_ok, sorted(invalid_options))
-        return (sorted(requested_cities), [])
-    return ([], [])
+    index = _get_city_index(source_of_truth)
+    cities_ok = set()
+    cities_error = set()
+    for city in user_requested_cities:
+        found = index.lookup(city)
+        if found:
+            cities_ok.add(found)
+        else:
+            cities_error.add(" ".join(map(lambda d: d.title(), unidecode.unidecode(city).lower().split(' '))))
+    return (sorted(cities_ok), sorted(cities_error))
 
 
 def _dump_db_data():
@@ -66,49 +115,57 @@ def _dump_db_data():
 
 
 def _fetch_from_db(chat_id, as_list=False):
-    val = REDIS.get(chat_id)
+    if SUBSCRIPTIONS:
+        val = SUBSCRIPTIONS.get(chat_id)
+    else:
+        val = REDIS.get(chat_id)
+        # redis stores byte strings, decode before returning
+        val = val.decode('utf-8') if val is not None else None
     if val is None:
         return [] if as_list else None
-    # redis stores byte strings, decode before returning
-    val = val.decode('utf-8')
     if as_list:
         val = val.split(',') if val else []
     return val
 
 
 def _get_tracked_cities(chat_id):
-    if REDIS.exists(chat_id):
-        # NOTE(ivasilev) redis stores bytes, need to explicitly call decode to get strings
-        return [c for c in _fetch_from_db(chat_id, as_list=True) if c.strip()]
-    return []
+    return [c for c in _fetch_from_db(chat_id, as_list=True) if c.strip()]
 
 
 def _get_tracked_cities_str(chat_id):
-    if REDIS.exists(chat_id):
-        return _fetch_from_db(chat_id) or "all cities"
-    return ''
+    val = _fetch_from_db(chat_id)
+    if val is None:
+        return ''
+    return val or "all cities"
 
 
 def _set_tracked_cities_str(chat_id, cities_str):
     REDIS.set(chat_id, cities_str)
+    if SUBSCRIPTIONS:
+        SUBSCRIPTIONS.put(chat_id, cities_str)
 
 
 def _unsubscribe(chat_id):
     REDIS.delete(chat_id)
+    if SUBSCRIPTIONS:
+        SUBSCRIPTIONS.discard(chat_id)
 
 
 def _get_all_subscribers():
-    # NOTE(ivasilev) redis stores bytes, need to explicitly call decode to get strings
-    if not NOTIFICATIONS_PAUSED:
-        return [chat_id.decode('utf-8') for chat_id in REDIS.keys(pattern='*')]
-    return [DEVELOPER_CHAT_ID]
+    if NOTIFICATIONS_PAUSED:
+        return [DEVELOPER_CHAT_ID]
+    chat_ids = SUBSCRIPTIONS.chat_ids() if SUBSCRIPTIONS else None
+    if chat_ids is None:
+        # NOTE(ivasilev) redis stores bytes, need to explicitly call decode to get strings
+        chat_ids = [chat_id.decode('utf-8') for chat_id in REDIS.keys(pattern='*')]
+    return chat_ids
 
 
 def _is_admin(chat_id):
     return int(chat_id) == int(DEVELOPER_CHAT_ID)
 
 
-def _parse_cities_args(context_args, source_of_truth=SCHOOLS_DATA):
+def _parse_cities_args(context_args, source_of_truth=None):
     # NOTE(ivasilev) Stripping whitespaces is necessary for correct parsing of 'Praha   , Brno , Ceske budejovice'
     preprocessed_args = [city.strip() for city in " ".join(context_args).split(',') if city.strip()]
     return _vet_requested_cities(preprocessed_args, source_of_truth)
@@ -119,8 +176,10 @@ def check(update: Update, context: CallbackContext) -> None:
     error_msg = ''
     if error_cities:
         error_msg = f'No exams in {",".join(error_cities)}\n'
-    schools = a2exams_checker.get_schools_from_file(cities_filter=requested_cities)
-    msg = a2exams_checker.diff_to_str(schools, url_in_header=True)
+    schools = SCHOOLS.get()
+    if requested_cities:
+        schools = {city: data for city, data in schools.items() if city in requested_cities}
+    msg = schools_data.diff_to_str(schools, url_in_header=True)
     response = f'{error_msg}{msg}'
     if not response:
         # NOTE(ivasilev) That is a temporary warning message until issue #23 is resolved
@@ -132,11 +191,22 @@ def check(update: Update, context: CallbackContext) -> None:
 
 
 def cities(update: Update, context: CallbackContext) -> None:
-    schools = a2exams_checker.get_schools_from_file()
+    schools = SCHOOLS.get()
     all_cities = sorted(schools.keys())
     update.effective_message.reply_text(f'Exam takes place in the following cities:\n{", ".join(all_cities)}')
 
 
+def _suggest_track_commands(requested_cities, error_cities, source_of_truth=None):
+    """Keyboard rows of /track commands where each unknown city is replaced by a suggested one"""
+    index = _get_city_index(source_of_truth)
+    keyboard = []
+    for error_city in error_cities:
+        suggestions = [c for c in index.suggest(error_city) if c not in requested_cities]
+        if suggestions:
+            keyboard.append([f'/track {", ".join(requested_cities + [s])}' for s in suggestions])
+    return keyboard
+
+
 def track(update: Update, context: CallbackContext) -> None:
     error_msg = ''
     requested_cities, error_cities = _parse_cities_args(context.args)
@@ -146,11 +216,18 @@ def track(update: Update, context: CallbackContext) -> None:
     # update tracking information for the given user
     _set_tracked_cities_str(update.effective_message.chat_id, cities_str)
     msg = f'{error_msg}You are tracking exam slots in {cities_str or "all cities"}'
-    update.effective_message.reply_text(msg)
+    keyboard = _suggest_track_commands(requested_cities, error_cities)
+    if keyboard:
+        msg = f'{msg}\nDid you mean one of the suggested cities?'
+        update.effective_message.reply_text(
+            msg, reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True))
+    else:
+        update.effective_message.reply_text(msg)
 
 
 def notrack(update: Update, context: CallbackContext) -> None:
     _unsubscribe(update.effective_message.chat_id)
+    FILTERS.save(REDIS_INTERNAL, update.effective_message.chat_id, {})
     update.effective_message.reply_text(f'You are no longer subscribed for updates')
 
 
@@ -158,50 +235,146 @@ def mystatus(update: Update, context: CallbackContext) -> None:
     tracked_cities = _get_tracked_cities_str(update.effective_message.chat_id)
     message = ('You are not subscribed for any updates, to subscribe use /track' if not tracked_cities else
                f'You are subscribed for updates in {tracked_cities}')
+    flt = FILTERS.get(update.effective_message.chat_id)
+    if tracked_cities and flt:
+        inactive = '' if filters.dates_known(SCHOOLS.get()) else ', not applied while no exam dates are known'
+        message += f' ({filters.filter_to_str(flt)}{inactive})'
     update.effective_message.reply_text(message)
 
 
+def filter_cmd(update: Update, context: CallbackContext) -> None:
+    """/filter before 2024-05-01, /filter minslots 3, /filter off. Filters need FETCH_EXAM_SLOTS on the checker."""
+    chat_id = update.effective_message.chat_id
+    flt = dict(FILTERS.get(chat_id) or {})
+    args = [arg.lower() for arg in context.args]
+    usage = ('Usage: /filter before <date> to hear only about exams before the date, /filter minslots <N> to hear '
+             'only about at least N free slots, /filter off to drop filters')
+    if args == ['off']:
+        flt = {}
+    elif len(args) == 2 and args[0] == 'before' and filters.parse_date(args[1]):
+        flt['before'] = filters.parse_date(args[1])
+    elif len(args) == 2 and args[0] == 'minslots' and args[1].isdigit():
+        flt['min_slots'] = int(args[1])
+    elif args:
+        update.effective_message.reply_text(usage)
+        return
+    FILTERS.save(REDIS_INTERNAL, chat_id, flt)
+    msg = f'Your subscription has {filters.filter_to_str(flt)}'
+    if flt and not filters.dates_known(SCHOOLS.get()):
+        # NOTE(ivasilev) exam dates come from detail pages that are only fetched with FETCH_EXAM_SLOTS=yes
+        msg += ('\nNo exam dates are known at the moment, until they are the filter is not applied and you will '
+                'hear about every change in tracked cities')
+    update.effective_message.reply_text(msg)
+
+
 def users(update: Update, context: CallbackContext) -> None:
     total_users = len(_get_all_subscribers())
     update.effective_message.reply_text(f'{total_users} users are subscribed for updates')
 
 
-def _do_inform(context, chat_ids, new_state, prev_state):
-    """Asynchronous status update for subscribers is done here"""
-    for chat_id in chat_ids:
-        chosen_cities = _get_tracked_cities(chat_id)
-        message = a2exams_checker.diff_to_str(new_state, prev_state, chosen_cities, url_in_header=True)
+def _reply_with_history(update, context, formatter):
+    """Reply with formatter's take on the history of requested, tracked or all cities (in that order)"""
+    history = ROLLUPS_SNAPSHOT.get()['cities']
+    if not history:
+        update.effective_message.reply_text('No slots history has been collected yet')
+        return
+    requested_cities, error_cities = _parse_cities_args(context.args)
+    if not context.args:
+        requested_cities = _get_tracked_cities(update.effective_message.chat_id) or sorted(history)
+    lines = [f'No exams in {",".join(error_cities)}'] if error_cities else []
+    lines.extend(formatter(history[city]) for city in requested_cities if city in history)
+    update.effective_message.reply_text('\n'.join(lines) or 'No slots history for these cities yet')
+
+
+def stats(update: Update, context: CallbackContext) -> None:
+    _reply_with_history(update, context, rollups.stats_to_str)
+
+
+def forecast(update: Update, context: CallbackContext) -> None:
+    _reply_with_history(update, context, rollups.forecast_to_str)
+
+
+def _get_subscriptions(chat_ids):
+    """Return {chat_id: tracked cities} of subscribed chat_ids, empty list means all cities"""
+    if SUBSCRIPTIONS:
+        return {chat_id: [c for c in val.split(',') if c.strip()]
+                for chat_id, val in SUBSCRIPTIONS.get_many(chat_ids).items()}
+    res = {}
+    for start in range(0, len(chat_ids), SUBSCRIPTIONS_CHUNK):
+        chunk = chat_ids[start:start + SUBSCRIPTIONS_CHUNK]
+        for chat_id, val in zip(chunk, REDIS.mget(chunk)):
+            if val is not None:
+                res[chat_id] = [c for c in val.decode('utf-8').split(',') if c.strip()]
+    return res
+
+
+def _render_updates(chat_ids, new_state, prev_state):
+    subscriptions = _get_subscriptions(chat_ids)
+    notifications = FILTERS.notifications(new_state, prev_state)
+    # "all cities" are the cities of the main target
+    main_cities = targets.main_cities(new_state)
+    for chat_id in outbox.fair_order(subscriptions):
+        chosen_cities = notifications.cities(chat_id, subscriptions[chat_id] or main_cities)
+        if not chosen_cities:
+            continue
+        message = schools_data.diff_to_str(new_state, prev_state, chosen_cities, url_in_header=True)
         # if message is empty - then there is no change in chosen_cities, so no need to inform users
-        try:
-            if message:
-                context.bot.send_message(chat_id=chat_id, text=message)
-        except telegram.error.Unauthorized:
-            # the user has unsubscribed for good - remove him from subscribers
-            _unsubscribe(chat_id)
-            logger.info(f'Removing {chat_id} from subscribers')
-        except telegram.error.TelegramError as exc:
-            logger.error(f'An error has occurred during sending a message to {chat_id}: {exc}')
+        if message:
+            yield chat_id, message
+
+
+def _do_inform(context, chat_ids, new_state, prev_state, detected=None, trace=None):
+    """
+    Asynchronous status update for subscribers is done here. Messages are put into the outbox and delivered
+    by outbox senders, so the update survives a crash in the middle of fan-out.
+    """
+    messages = _render_updates(chat_ids, new_state, prev_state)
+    if not trace:
+        total = outbox.enqueue(REDIS_INTERNAL, messages, created=detected)
+    else:
+        with tracing.span('bot.enqueue', trace) as enqueue_trace:
+            total = outbox.enqueue(REDIS_INTERNAL, messages, created=detected,
+                                   trace=tracing.to_str(enqueue_trace, time.time_ns()))
+    logger.info(f'{total} status updates have been put into the outbox')
+    return total
 
 
 def _send_update_to_channel(context: CallbackContext, new_state: dict, prev_state: dict) -> None:
     """A single message with update (all cities, no filtering) is done here"""
-    message = a2exams_checker.diff_to_str(new_state, prev_state, url_in_header=True)
+    message = schools_data.diff_to_str(new_state, prev_state, url_in_header=True)
     if message:
         context.bot.send_message(chat_id=EXAMS_CHANNEL, text=message)
 
 
+def _get_trace(state):
+    """Trace context the checker has put into the data and the time it has published the data at"""
+    return tracing.from_str(next(iter(state.values()), {}).get('trace'))
+
+
 def inform_about_change(context: CallbackContext) -> None:
-    global SCHOOLS_DATA
-    new_data = a2exams_checker.get_schools_from_file()
-    if not SCHOOLS_DATA or a2exams_checker.has_changes(new_data, SCHOOLS_DATA):
+    detected = time.time()
+    update = None
+    if not COALESCER.delivered or SCHOOLS_SNAPSHOT.changed():
+        new_data = SCHOOLS_SNAPSHOT.get()
+        if new_data:
+            update = COALESCER.observe(new_data)
+    # closings are held for a while in case the city opens again right away
+    update = update or COALESCER.due()
+    if update:
         # Now deep copy new_data and old_data for every subscriber to get the same update
-        new_state = copy.deepcopy(new_data)
-        prev_state = copy.deepcopy(SCHOOLS_DATA)
+        new_state, prev_state = copy.deepcopy(update)
         logger.info(f'New state = {new_state}\nOld state = {prev_state}')
-        # Send message to the channel
-        _send_update_to_channel(context, new_state, prev_state)
-        context.dispatcher.run_async(_do_inform, context, _get_all_subscribers(), new_state, prev_state)
-        SCHOOLS_DATA = new_data
+        trace, published = _get_trace(new_state)
+        if trace:
+            # a held update has waited for the coalescing window as well
+            tracing.record('bot.wait', published, max(published, int(detected * 1e9)), trace)
+            with tracing.span('bot.channel', trace):
+                _send_update_to_channel(context, new_state, prev_state)
+        else:
+            _send_update_to_channel(context, new_state, prev_state)
+        if not NOTIFY_SHARDS:
+            context.dispatcher.run_async(_do_inform, context, _get_all_subscribers(), new_state, prev_state,
+                                         detected, trace)
 
 
 def admin_broadcast(update: Update, context: CallbackContext) -> None:
@@ -210,12 +383,44 @@ def admin_broadcast(update: Update, context: CallbackContext) -> None:
                                             f'not for {update.effective_message.chat_id}')
     else:
         message = ' '.join(context.args)
-        for chat_id in _get_all_subscribers():
-            try:
-                context.bot.send_message(chat_id=chat_id, text=message)
-            except telegram.error.Unauthorized:
-                _unsubscribe(chat_id)
-                logger.info(f'User has stopped the bot - removing {chat_id} from subscribers')
+        if not message:
+            update.effective_message.reply_text('Nothing to broadcast, usage: /adminbroadcast <message>')
+            return
+        chat_ids = _get_all_subscribers()
+        job_id = broadcast.start(REDIS_INTERNAL, message, chat_ids)
+        update.effective_message.reply_text(f'Broadcast #{job_id} to {len(chat_ids)} users has been scheduled')
+
+
+def _set_broadcasts_state(update: Update, context: CallbackContext, from_states, state) -> None:
+    """Change state of broadcasts given as command arguments or of all broadcasts in from_states"""
+    if not _is_admin(update.effective_message.chat_id):
+        update.effective_message.reply_text('This command is restricted for admin users only')
+        return
+    job_ids = ([int(job_id) for job_id in context.args if job_id.isdigit()] or
+               [job['id'] for job in broadcast.get_jobs(REDIS_INTERNAL, states=from_states)])
+    changed = [job_id for job_id in job_ids if broadcast.set_state(REDIS_INTERNAL, job_id, state)]
+    msg = (f'Broadcasts {", ".join(f"#{job_id}" for job_id in changed)} are {state} now' if changed else
+           'No broadcasts to change')
+    update.effective_message.reply_text(msg)
+
+
+def admin_broadcast_pause(update: Update, context: CallbackContext) -> None:
+    _set_broadcasts_state(update, context, (broadcast.RUNNING,), broadcast.PAUSED)
+
+
+def admin_broadcast_resume(update: Update, context: CallbackContext) -> None:
+    _set_broadcasts_state(update, context, (broadcast.PAUSED,), broadcast.RUNNING)
+
+
+def admin_broadcast_cancel(update: Update, context: CallbackContext) -> None:
+    _set_broadcasts_state(update, context, (broadcast.RUNNING, broadcast.PAUSED), broadcast.CANCELLED)
+
+
+def send_broadcasts(context: CallbackContext) -> None:
+    """Send the next batch of every running broadcast, picks up unfinished broadcasts after restart as well"""
+    for job in broadcast.get_jobs(REDIS_INTERNAL, states=(broadcast.RUNNING,)):
+        broadcast.send_batch(REDIS_INTERNAL, context.bot, job['id'], limit=BROADCAST_RATE * BROADCAST_INTERVAL,
+                             time_budget=BROADCAST_INTERVAL, on_unauthorized=_unsubscribe)
 
 
 def admin_pause(update: Update, context: CallbackContext) -> None:
@@ -224,6 +429,8 @@ def admin_pause(update: Update, context: CallbackContext) -> None:
     else:
         global NOTIFICATIONS_PAUSED
         NOTIFICATIONS_PAUSED = True
+        # let shard workers know as well
+        REDIS_INTERNAL.set(shards.PAUSED_KEY, 1)
         context.bot.send_message(chat_id=DEVELOPER_CHAT_ID, text='Pausing notifications for all subscribers')
 
 
@@ -233,6 +440,7 @@ def admin_resume(update: Update, context: CallbackContext) -> None:
     else:
         global NOTIFICATIONS_PAUSED
         NOTIFICATIONS_PAUSED = False
+        REDIS_INTERNAL.delete(shards.PAUSED_KEY)
         context.bot.send_message(chat_id=DEVELOPER_CHAT_ID, text='Resuming notifications for all subscribers')
 
 
@@ -241,20 +449,66 @@ def admin_status(update: Update, context: CallbackContext) -> None:
         update.effective_message.reply_text('This command is restricted for admin users only')
     else:
         # get timestamp of last_fetched file
-        last_fetch_time = a2exams_checker.get_last_fetch_time_from_data(human_readable=True)
+        last_fetch_time = schools_data.get_last_fetch_time_from_data(human_readable=True)
         msg = f'Last fetch time: {last_fetch_time}\nUser subscriptions:\n{_dump_db_data()}'
+        broadcasts = broadcast.get_jobs(REDIS_INTERNAL, last=3)
+        if broadcasts:
+            msg += '\nBroadcasts:\n' + '\n'.join(broadcast.format_status(job) for job in broadcasts)
+        if SUBSCRIPTIONS:
+            msg += '\n' + SUBSCRIPTIONS.format_stats()
+        latency = outbox.latency_stats(REDIS_INTERNAL)
+        if latency['deliveries']:
+            msg += '\n' + outbox.format_latency_stats(latency)
         context.bot.send_message(chat_id=DEVELOPER_CHAT_ID, text=msg)
 
 
+def _get_last_fetch_time():
+    """Timestamp of the latest data, the json is only read when a new one has been published"""
+    data = FRESHNESS_SNAPSHOT.get()
+    # take timestamp from the first city, all of them have been fetched at once
+    return float(next(iter(data.values()), {}).get('timestamp') or 0)
+
+
+def _check_redis():
+    REDIS.ping()
+    REDIS_INTERNAL.ping()
+    return True
+
+
+def admin_profile(update: Update, context: CallbackContext) -> None:
+    if not _is_admin(update.effective_message.chat_id):
+        update.effective_message.reply_text('This command is restricted for admin users only')
+        return
+    try:
+        seconds = int(context.args[0]) if context.args else profiler.PROFILE_SECONDS
+    except ValueError:
+        update.effective_message.reply_text('Usage: /adminprofile [seconds]')
+        return
+
+    def _send_profile(filename, stacks):
+        with open(filename, 'rb') as f:
+            context.bot.send_document(chat_id=DEVELOPER_CHAT_ID, document=f, filename=os.path.basename(filename),
+                                      caption=profiler.summary(stacks, limit=15)[:1024])
+
+    if profiler.start(seconds, 'bot', on_done=_send_profile):
+        update.effective_message.reply_text(f'Profiling the bot for {min(seconds, profiler.MAX_PROFILE_SECONDS)} '
+                                            f'seconds, collapsed stacks will follow')
+    else:
+        update.effective_message.reply_text('A profile is being taken already')
+
+
 def track_fetcher_status(context: CallbackContext) -> None:
     global IS_FETCHER_OK
+    # the job queue is alive as long as this job keeps running
+    health.heartbeat(3 * UPDATE_INTERVAL)
     # Only updates for a status change will be sent not to get swamped
-    last_update_ts = a2exams_checker.get_last_fetch_time_from_data(human_readable=False)
-    delta = int(datetime.datetime.now().timestamp()) - int(float(last_update_ts))
+    last_update_ts = _get_last_fetch_time()
+    delta = int(datetime.datetime.now().timestamp()) - int(last_update_ts)
+    health.report(fetcher_ok=delta <= FETCHER_DOWN_THRESHOLD, last_fetch_age=delta)
     if delta > FETCHER_DOWN_THRESHOLD:
         # we are in trouble, fetcher has been blocked or down for some time
         if IS_FETCHER_OK:
-            last_fetch_time = a2exams_checker.get_last_fetch_time_from_data(human_readable=True)
+            last_fetch_time = utils.timestamp_to_str(last_update_ts)
             context.bot.send_message(chat_id=DEVELOPER_CHAT_ID, text=f'Fetcher is down, last update happened {delta} seconds ago at {last_fetch_time}')
         IS_FETCHER_OK = False
     else:
@@ -291,23 +545,55 @@ def error_handler(update: object, context: CallbackContext) -> None:
     context.bot.send_message(chat_id=DEVELOPER_CHAT_ID, text=message, parse_mode=ParseMode.HTML)
 
 
-def run():
+def reconcile_subscriptions(context: CallbackContext) -> None:
+    SUBSCRIPTIONS.reconcile()
+
+
+def build():
+    """Set the bot up with nothing polling telegram yet, returns (updater, event stopping outbox senders)"""
+    global SUBSCRIPTIONS
+    COALESCER.delivered = SCHOOLS_SNAPSHOT.get()
+    FILTERS.load(REDIS_INTERNAL)
+    if subscriptions.CACHE_SIZE:
+        SUBSCRIPTIONS = subscriptions.SubscriptionCache(REDIS)
+        SUBSCRIPTIONS.start()
     updater = Updater(TOKEN)
     updater.dispatcher.add_handler(CommandHandler('check', check))
     updater.dispatcher.add_handler(CommandHandler('cities', cities))
     updater.dispatcher.add_handler(CommandHandler('track', track))
     updater.dispatcher.add_handler(CommandHandler('notrack', notrack))
     updater.dispatcher.add_handler(CommandHandler('mystatus', mystatus))
+    updater.dispatcher.add_handler(CommandHandler('filter', filter_cmd))
     updater.dispatcher.add_handler(CommandHandler('users', users))
+    updater.dispatcher.add_handler(CommandHandler('stats', stats))
+    updater.dispatcher.add_handler(CommandHandler('forecast', forecast))
     updater.dispatcher.add_handler(CommandHandler('adminbroadcast', admin_broadcast))
+    updater.dispatcher.add_handler(CommandHandler('adminbroadcastpause', admin_broadcast_pause))
+    updater.dispatcher.add_handler(CommandHandler('adminbroadcastresume', admin_broadcast_resume))
+    updater.dispatcher.add_handler(CommandHandler('adminbroadcastcancel', admin_broadcast_cancel))
     updater.dispatcher.add_handler(CommandHandler('adminpause', admin_pause))
     updater.dispatcher.add_handler(CommandHandler('adminresume', admin_resume))
     updater.dispatcher.add_handler(CommandHandler('adminstatus', admin_status))
+    updater.dispatcher.add_handler(CommandHandler('adminprofile', admin_profile))
     updater.dispatcher.add_error_handler(error_handler)
     updater.job_queue.run_repeating(inform_about_change, interval=UPDATE_INTERVAL, first=0)
     updater.job_queue.run_repeating(track_fetcher_status, interval=UPDATE_INTERVAL, first=0)
+    health.add_check('redis', _check_redis)
+    updater.job_queue.run_repeating(send_broadcasts, interval=BROADCAST_INTERVAL, first=0)
+    if SUBSCRIPTIONS:
+        updater.job_queue.run_repeating(reconcile_subscriptions, interval=subscriptions.RECONCILE_INTERVAL)
+    outbox.ensure_group(REDIS_INTERNAL)
+    senders = outbox.start_senders(REDIS_INTERNAL, updater.bot, OUTBOX_SENDERS, on_unauthorized=_unsubscribe)
+    return updater, senders
+
+
+def run():
+    tracing.SERVICE_NAME = 'bot'
+    updater, senders = build()
+    health.serve()
     updater.start_polling()
     updater.idle()
+    senders.set()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+"""
+Admin broadcasts as resumable background jobs.
+
+When a broadcast is started its recipients are snapshotted into a redis list and the job keeps a cursor into
+that list. A repeating job sends a rate limited batch on every run and moves the cursor after each message,
+so the command handler returns immediately, a broadcast can be paused and a restarted bot picks it up where
+it has stopped. When telegram asks to slow down the job is not run again until the wait is over, and a job paused
+or cancelled in the middle of a batch stops right away.
+"""
+import logging
+import time
+
+import redis
+import telegram
+
+JOBS_KEY = 'broadcast:jobs'
+LAST_ID_KEY = 'broadcast:last_id'
+RUNNING = 'running'
+PAUSED = 'paused'
+DONE = 'done'
+CANCELLED = 'cancelled'
+_INT_FIELDS = ('cursor', 'total', 'sent', 'failed')
+_FLOAT_FIELDS = ('started', 'finished', 'active_seconds', 'not_before')
+
+logger = logging.getLogger(__name__)
+
+
+def _job_key(job_id):
+    return f'broadcast:{job_id}'
+
+
+def _recipients_key(job_id):
+    return f'broadcast:{job_id}:recipients'
+
+
+def start(db, message, chat_ids):
+    """Snapshot recipients and schedule a new broadcast, returns id of the job"""
+    job_id = db.incr(LAST_ID_KEY)
+    pipe = db.pipeline()
+    if chat_ids:
+        pipe.rpush(_recipients_key(job_id), *chat_ids)
+    pipe.hset(_job_key(job_id), mapping={'message': message,
+                                         'state': RUNNING if chat_ids else DONE,
+                                         'cursor': 0,
+                                         'total': len(chat_ids),
+                                         'sent': 0,
+                                         'failed': 0,
+                                         'started': time.time(),
+                                         'active_seconds': 0})
+    pipe.rpush(JOBS_KEY, job_id)
+    pipe.execute()
+    return job_id
+
+
+def get_job(db, job_id):
+    job = {k.decode('utf-8'): v.decode('utf-8') for k, v in db.hgetall(_job_key(job_id)).items()}
+    if not job:
+        return None
+    job['id'] = int(job_id)
+    for field in _INT_FIELDS:
+        job[field] = int(job[field])
+    for field in _FLOAT_FIELDS:
+        job[field] = float(job.get(field) or 0)
+    return job
+
+
+def get_jobs(db, states=None, last=None):
+    """Return broadcasts in order of creation, optionally filtered by state and limited to the last N ones"""
+    job_ids = db.lrange(JOBS_KEY, -last if last else 0, -1)
+    jobs = [get_job(db, int(job_id)) for job_id in job_ids]
+    return [job for job in jobs if job and (not states or job['state'] in states)]
+
+
+def set_state(db, job_id, state):
+    """Pause, resume or cancel a broadcast. Finished broadcasts are left as they are."""
+    job = get_job(db, job_id)
+    if not job or job['state'] in (DONE, CANCELLED):
+        return False
+    db.hset(_job_key(job_id), 'state', state)
+    if state == CANCELLED:
+        db.delete(_recipients_key(job_id))
+    return True
+
+
+def _is_running(db, job_id):
+    return db.hget(_job_key(job_id), 'state') == RUNNING.encode('utf-8')
+
+
+def _finish(db, job_id):
+    """Move a running broadcast to done, a broadcast paused or cancelled meanwhile is left as it is"""
+    with db.pipeline() as pipe:
+        try:
+            pipe.watch(_job_key(job_id))
+            if pipe.hget(_job_key(job_id), 'state') != RUNNING.encode('utf-8'):
+                return False
+            pipe.multi()
+            pipe.hset(_job_key(job_id), mapping={'state': DONE, 'finished': time.time()})
+            pipe.delete(_recipients_key(job_id))
+            pipe.execute()
+        except redis.WatchError:
+            return False
+    return True
+
+
+def send_batch(db, bot, job_id, limit, time_budget=None, on_unauthorized=None):
+    """
+    Send up to limit messages of a running broadcast and return the number of recipients processed.
+    The cursor is moved right after each message, so a crash can cause at most one duplicate.
+    """
+    job = get_job(db, job_id)
+    if not job or job['state'] != RUNNING or job['not_before'] > time.time():
+        return 0
+    started = time.monotonic()
+    processed = 0
+    for chat_id in db.lrange(_recipients_key(job_id), job['cursor'], job['cursor'] + limit - 1):
+        # NOTE(ivasilev) the state is checked before every message, so /pause and /cancel take effect mid-batch
+        if processed and not _is_running(db, job_id):
+            break
+        chat_id = chat_id.decode('utf-8')
+        outcome = 'sent'
+        try:
+            bot.send_message(chat_id=chat_id, text=job['message'])
+        except telegram.error.RetryAfter as exc:
+            # telegram asks to slow down, the job sleeps through the wait and this chat is retried after it
+            logger.warning('Broadcast #%s is throttled, retrying in %s seconds', job_id, exc.retry_after)
+            db.hset(_job_key(job_id), 'not_before', time.time() + exc.retry_after)
+            break
+        except telegram.error.Unauthorized:
+            outcome = 'failed'
+            if on_unauthorized:
+                on_unauthorized(chat_id)
+            logger.info(f'User has stopped the bot - removing {chat_id} from subscribers')
+        except telegram.error.BadRequest as exc:
+            # NOTE(ivasilev) BadRequest is a NetworkError in python-telegram-bot, but retrying it won't help
+            outcome = 'failed'
+            logger.error(f'Broadcast to {chat_id} has been rejected: {exc}')
+        except telegram.error.NetworkError as exc:
+            # telegram is not reachable or has timed out, this chat is retried on the next run
+            logger.warning('Broadcast #%s could not reach telegram, retrying on the next run: %s', job_id, exc)
+            break
+        except telegram.error.TelegramError as exc:
+            outcome = 'failed'
+            logger.error(f'An error has occurred during broadcasting to {chat_id}: {exc}')
+        pipe = db.pipeline()
+        pipe.hincrby(_job_key(job_id), outcome, 1)
+        pipe.hincrby(_job_key(job_id), 'cursor', 1)
+        pipe.execute()
+        processed += 1
+        if time_budget and time.monotonic() - started > time_budget:
+            break
+    db.hincrbyfloat(_job_key(job_id), 'active_seconds', time.monotonic() - started)
+    if job['cursor'] + processed >= job['total']:
+        _finish(db, job_id)
+    return processed
+
+
+def format_status(job):
+    throughput = job['sent'] / job['active_seconds'] if job['active_seconds'] else 0
+    return (f'Broadcast #{job["id"]} ({job["state"]}): {job["cursor"]}/{job["total"]} processed, '
+            f'{job["sent"]} sent, {job["failed"]} failed, {throughput:.1f} msg/s')
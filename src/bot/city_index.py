@@ -0,0 +1,76 @@
+"""
+Lookup of city names as typed by users.
+
+Every spelling of a city that a user may reasonably type (with or without diacritics, any case, hyphen or
+space as a separator, no separator at all) is normalized and mapped to the city key used in schools data.
+The index also keeps every prefix of every spelling, so completion is a single dict lookup as well.
+"""
+import difflib
+import re
+
+import unidecode
+
+
+def normalize(name):
+    """'Frýdek - Místek' -> 'frydek mistek'"""
+    return ' '.join(re.findall(r'[a-z0-9]+', unidecode.unidecode(name).lower()))
+
+
+class CityIndex:
+
+    def __init__(self, schools):
+        self.cities = sorted(schools)
+        self._aliases = {}
+        self._prefixes = {}
+        for city in self.cities:
+            spellings = {normalize(city), normalize(schools[city].get('city_name') or city)}
+            # 'frydekmistek' and 'ustinadlabem' are valid spellings too
+            spellings |= {s.replace(' ', '') for s in spellings}
+            for spelling in spellings:
+                self._aliases[spelling] = city
+                for i in range(1, len(spelling) + 1):
+                    self._prefixes.setdefault(spelling[:i], set()).add(city)
+        self._prefixes = {prefix: sorted(cities) for prefix, cities in self._prefixes.items()}
+
+    def __len__(self):
+        return len(self.cities)
+
+    def lookup(self, name):
+        """Return city key for a user-typed city name or None if there is no such city"""
+        normalized = normalize(name)
+        return self._aliases.get(normalized) or self._aliases.get(normalized.replace(' ', ''))
+
+    def complete(self, prefix):
+        """Return sorted city keys starting with prefix"""
+        normalized = normalize(prefix)
+        if not normalized:
+            return []
+        return self._prefixes.get(normalized) or self._prefixes.get(normalized.replace(' ', ''), [])
+
+    def suggest(self, name, limit=3):
+        """Return up to limit city keys that the user has probably meant by a misspelled or unfinished name"""
+        completions = self.complete(name)
+        if completions:
+            return completions[:limit]
+        close_matches = difflib.get_close_matches(normalize(name), self._aliases.keys(), n=limit * 2, cutoff=0.7)
+        suggestions = []
+        for match in close_matches:
+            if self._aliases[match] not in suggestions:
+                suggestions.append(self._aliases[match])
+        return suggestions[:limit]
+
+
+_LAST_INDEX = (None, None)
+
+
+def get_index(schools):
+    """
+    Return the index for schools data. As long as the same data object is passed (the snapshot reader only
+    loads a new one when a new generation is published) the index is not rebuilt.
+    """
+    global _LAST_INDEX
+    indexed_schools, index = _LAST_INDEX
+    if schools is not indexed_schools:
+        index = CityIndex(schools)
+        _LAST_INDEX = (schools, index)
+    return index
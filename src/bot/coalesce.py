@@ -0,0 +1,61 @@
+"""
+Coalescing of status updates before they are sent to subscribers.
+
+When a cancellation frees a single slot a city flips open -> closed -> open within a couple of polls, and
+sending every edge to every subscriber only multiplies traffic. So only openings are delivered right away,
+anything else is held for a window and superseded by newer states meanwhile. Once the window is over the
+held state is compared to the last delivered one again, a flap that has ended where it started makes no
+message at all. Every chat's message is rendered from the same delivered and pending states, so a chat gets
+at most one message per window on top of openings.
+"""
+import os
+import time
+
+from checker import schools_data
+
+COALESCE_WINDOW = int(os.getenv('COALESCE_WINDOW', '60'))
+
+
+def has_openings(new_state, old_state):
+    """True if registration has opened in any city since old_state"""
+    return any(data['free_slots'] and (city not in old_state or not old_state[city]['free_slots'])
+               for city, data in new_state.items())
+
+
+class Coalescer:
+
+    def __init__(self, delivered=None, window=COALESCE_WINDOW, clock=time.monotonic):
+        # the state subscribers have last been told about
+        self.delivered = delivered or {}
+        self.window = window
+        self.clock = clock
+        self.pending = None
+        self.pending_since = None
+
+    def observe(self, state):
+        """Take a newly observed state, returns (new_state, prev_state) to deliver right away or None"""
+        if not self.delivered or has_openings(state, self.delivered):
+            # held changes go along with the opening
+            return self._flush(state)
+        if schools_data.has_changes(state, self.delivered):
+            if self.pending is None:
+                self.pending_since = self.clock()
+            self.pending = state
+        else:
+            # flapped back to what subscribers already know
+            self.pending = None
+            self.pending_since = None
+        return None
+
+    def due(self):
+        """Return (new_state, prev_state) of the held update once the window is over or None"""
+        if self.pending is not None and self.clock() - self.pending_since >= self.window:
+            return self._flush(self.pending)
+        return None
+
+    def _flush(self, state):
+        prev_state = self.delivered
+        self.delivered = state
+        self.pending = None
+        self.pending_since = None
+        return state, prev_state
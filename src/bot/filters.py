@@ -0,0 +1,181 @@
+"""
+Subscription filters: exam dates before a deadline and/or a minimum number of free slots.
+
+Filters are kept in the internal database as a hash of chat_id -> json and indexed in memory by deadline and by
+minimum slots, so that a change in a city only looks at chats whose filters the city can satisfy: with the earliest
+free exam date E and T free slots in total, chats with a deadline at or before E and chats asking for more than T
+slots are ruled out by bisecting the sorted lists and only chats with both filters are checked one by one.
+
+A filter applies to every city a chat tracks. A chat hears about a change in a city if its filter is satisfied by
+the city's state before or after the change, so whoever has been told about an opening is told about the closing
+as well. Cities with no exam dates known (detail pages are not fetched) can't be ruled out and always match.
+"""
+import bisect
+import datetime
+import json
+
+FILTERS_KEY = 'subscriptions:filters'
+# bumped on every change of filters, so that other processes know when to reload them
+FILTERS_VERSION_KEY = 'subscriptions:filters:version'
+_NOT_LOADED = object()
+DATE_FORMATS = ['%Y-%m-%d', '%d.%m.%Y', '%d/%m/%Y']
+# sorts after any chat_id, so that (value, _AFTER_ALL) bisects right after every entry with the value
+_AFTER_ALL = chr(0x10ffff)
+
+
+def parse_date(value):
+    """Return iso date of a user provided date or None"""
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def dates_known(state):
+    """Whether exam dates are known for any city, filters can't rule anything out until they are"""
+    return any(data.get('slots') is not None for data in state.values())
+
+
+def filter_to_str(flt):
+    parts = []
+    if flt.get('before'):
+        parts.append(f'exams before {flt["before"]}')
+    if flt.get('min_slots'):
+        parts.append(f'at least {flt["min_slots"]} free slots')
+    return ' with '.join(parts) if parts else 'no filters'
+
+
+class FilterIndex:
+
+    def __init__(self):
+        self.filters = {}
+        # sorted (deadline, chat_id), (min_slots, chat_id) and (deadline, min_slots, chat_id)
+        self._before = []
+        self._min_slots = []
+        self._both = []
+        # FILTERS_VERSION_KEY as of the last load
+        self.version = _NOT_LOADED
+
+    def __len__(self):
+        return len(self.filters)
+
+    def _entry(self, chat_id, flt):
+        if flt.get('before') and flt.get('min_slots'):
+            return self._both, (flt['before'], flt['min_slots'], chat_id)
+        if flt.get('before'):
+            return self._before, (flt['before'], chat_id)
+        return self._min_slots, (flt['min_slots'], chat_id)
+
+    def set(self, chat_id, flt):
+        chat_id = str(chat_id)
+        self.discard(chat_id)
+        if not flt.get('before') and not flt.get('min_slots'):
+            return
+        self.filters[chat_id] = flt
+        entries, entry = self._entry(chat_id, flt)
+        bisect.insort(entries, entry)
+
+    def discard(self, chat_id):
+        chat_id = str(chat_id)
+        flt = self.filters.pop(chat_id, None)
+        if flt:
+            entries, entry = self._entry(chat_id, flt)
+            del entries[bisect.bisect_left(entries, entry)]
+
+    def get(self, chat_id):
+        return self.filters.get(str(chat_id))
+
+    def matching(self, city_data):
+        """Return chat_ids with filters the city state satisfies"""
+        if not city_data or not city_data['free_slots']:
+            return set()
+        if city_data.get('slots') is None:
+            # nothing is known about exam dates, can't rule anybody out
+            return set(self.filters)
+        slots = sorted((date, free) for date, free in city_data['slots'] if free)
+        if not slots:
+            return set()
+        dates = [date for date, _ in slots]
+        free_before = [0]
+        for _, free in slots:
+            free_before.append(free_before[-1] + free)
+        earliest, total = dates[0], free_before[-1]
+        # deadlines have to be after the earliest date, minimums at most the total
+        res = {chat_id for _, chat_id in self._before[bisect.bisect_right(self._before, (earliest, _AFTER_ALL)):]}
+        enough = bisect.bisect_right(self._min_slots, (total, _AFTER_ALL))
+        res.update(chat_id for _, chat_id in self._min_slots[:enough])
+        for deadline, min_slots, chat_id in self._both[bisect.bisect_right(self._both, (earliest, float('inf'))):]:
+            if min_slots <= free_before[bisect.bisect_left(dates, deadline)]:
+                res.add(chat_id)
+        return res
+
+    def notifications(self, new_state, prev_state):
+        """Return Notifications of the change from prev_state to new_state"""
+        return Notifications(self, new_state, prev_state)
+
+    def load(self, db):
+        # NOTE(ivasilev) the version is read first, a change made during the load is picked up by the next refresh
+        self.version = db.get(FILTERS_VERSION_KEY)
+        self.filters = {}
+        self._before, self._min_slots, self._both = [], [], []
+        for chat_id, val in db.hgetall(FILTERS_KEY).items():
+            self.set(chat_id.decode('utf-8'), json.loads(val))
+        return self
+
+    def refresh(self, db):
+        """Load filters if they have changed since the last load, costs a GET otherwise"""
+        if self.version is _NOT_LOADED or db.get(FILTERS_VERSION_KEY) != self.version:
+            self.load(db)
+        return self
+
+    def save(self, db, chat_id, flt):
+        """Set the filter of a chat and store it, an empty filter removes it"""
+        self.set(chat_id, flt)
+        pipe = db.pipeline()
+        if str(chat_id) in self.filters:
+            pipe.hset(FILTERS_KEY, str(chat_id), json.dumps(flt))
+        else:
+            pipe.hdel(FILTERS_KEY, str(chat_id))
+        pipe.incr(FILTERS_VERSION_KEY)
+        pipe.execute()
+
+
+def _dates_unknown(city_data):
+    return bool(city_data) and bool(city_data['free_slots']) and city_data.get('slots') is None
+
+
+class Notifications:
+    """
+    Changed cities chats with filters are to hear about. The index picks the chats whose filters a changed city
+    satisfies, so the cost is in the matches and not in the number of filters. Cities with no exam dates known
+    satisfy every filter and are not looked up at all.
+    """
+
+    def __init__(self, index, new_state, prev_state):
+        self.filters = index.filters
+        prev_state = prev_state or {}
+        self.changed = set()
+        self.undecided = set()
+        # chat_id -> changed cities its filter is satisfied by
+        self.passing = {}
+        if not self.filters:
+            return
+        for city, data in new_state.items():
+            old = prev_state.get(city)
+            if (old['free_slots'] == data['free_slots']) if old is not None else not data['free_slots']:
+                continue
+            self.changed.add(city)
+            if _dates_unknown(data) or _dates_unknown(old):
+                self.undecided.add(city)
+                continue
+            for chat_id in index.matching(data) | index.matching(old):
+                self.passing.setdefault(chat_id, set()).add(city)
+
+    def cities(self, chat_id, cities):
+        """Drop the changed cities the filter of the chat rules out from cities the chat tracks"""
+        if chat_id not in self.filters:
+            return cities
+        passing = self.passing.get(chat_id, ())
+        return [c for c in cities if c not in self.changed or c in self.undecided or c in passing]
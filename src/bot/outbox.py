@@ -0,0 +1,229 @@
+"""
+Durable outbox for subscribers' notifications.
+
+Rendered messages are appended to a redis stream and delivered by sender workers reading it as a consumer
+group. An entry is acknowledged (and deleted) only after it has been handed over to telegram, entries of
+a crashed sender are claimed by the others once they have been idle for a while. So delivery is
+at-least-once and senders can run in as many threads and processes as needed.
+
+Run `python src/bot/outbox.py --senders N` to start extra senders in a separate process.
+"""
+import argparse
+import logging
+import os
+import random
+import socket
+import threading
+import time
+
+import redis
+import telegram
+
+import utils
+from utils import tracing
+
+STREAM = 'outbox'
+GROUP = 'senders'
+# how long an entry can stay unacknowledged before another sender takes it over
+CLAIM_IDLE_MS = int(os.getenv('OUTBOX_CLAIM_IDLE_MS', '60000'))
+READ_COUNT = 50
+READ_BLOCK_MS = 5000
+ENQUEUE_CHUNK = 1000
+# latest delivery latencies and per chat totals to see how fairly delivery order is spread
+LATENCY_KEY = 'outbox:latency'
+LATENCY_SUM_KEY = 'outbox:latency:sum'
+LATENCY_COUNT_KEY = 'outbox:latency:count'
+LATENCY_SAMPLES = 10000
+
+# set up logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def ensure_group(db, stream=STREAM, group=GROUP):
+    try:
+        db.xgroup_create(stream, group, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as exc:
+        # the group already exists
+        if 'BUSYGROUP' not in str(exc):
+            raise
+
+
+def fair_order(subscriptions, rand=None):
+    """
+    Return chat_ids of {chat_id: tracked cities} in delivery order: chats tracking chosen cities go first (the
+    update is about a city they have asked for), then chats tracking all cities. Order within each group is
+    shuffled anew for every update, so that the same chats don't always get the news last.
+    """
+    rand = rand or random.Random()
+    chosen = [chat_id for chat_id, cities in subscriptions.items() if cities]
+    everything = [chat_id for chat_id, cities in subscriptions.items() if not cities]
+    rand.shuffle(chosen)
+    rand.shuffle(everything)
+    return chosen + everything
+
+
+def enqueue(db, messages, stream=STREAM, created=None, trace=None):
+    """
+    Append (chat_id, text) messages to the outbox, returns number of messages appended. Delivery latency is
+    counted from created (time of change detection), from the moment of enqueueing otherwise. Some of the
+    deliveries are traced if trace context is passed.
+    """
+    total = 0
+    pipe = db.pipeline(transaction=False)
+    for chat_id, text in messages:
+        fields = {'chat_id': chat_id, 'text': text, 'created': created or time.time()}
+        if trace:
+            fields['trace'] = trace
+        pipe.xadd(stream, fields)
+        total += 1
+        if total % ENQUEUE_CHUNK == 0:
+            pipe.execute()
+    pipe.execute()
+    return total
+
+
+def consumer_name(num=0):
+    return f'{socket.gethostname()}-{os.getpid()}-{num}'
+
+
+def _read(db, consumer, count, block_ms, stream, group):
+    # entries abandoned by crashed senders go first
+    claimed = db.xautoclaim(stream, group, consumer, min_idle_time=CLAIM_IDLE_MS, start_id='0-0', count=count)[1]
+    if claimed:
+        return claimed
+    entries = db.xreadgroup(group, consumer, {stream: '>'}, count=count, block=block_ms)
+    return entries[0][1] if entries else []
+
+
+def deliver(bot, chat_id, text, on_unauthorized=None):
+    """Hand over a message to telegram, returns False if the message has to be retried later"""
+    for attempt in range(2):
+        try:
+            bot.send_message(chat_id=chat_id, text=text)
+            return True
+        except telegram.error.RetryAfter as exc:
+            logger.warning('Sending is throttled, waiting %s seconds', exc.retry_after)
+            time.sleep(exc.retry_after)
+        except telegram.error.Unauthorized:
+            # the user has unsubscribed for good - remove him from subscribers
+            if on_unauthorized:
+                on_unauthorized(chat_id)
+            logger.info(f'Removing {chat_id} from subscribers')
+            return True
+        except telegram.error.BadRequest as exc:
+            # NOTE(ivasilev) BadRequest is a NetworkError in python-telegram-bot, but retrying it won't help
+            logger.error(f'Message to {chat_id} has been rejected: {exc}')
+            return True
+        except telegram.error.NetworkError as exc:
+            # telegram is not reachable or has timed out, the entry stays pending and is delivered later
+            logger.error(f'Could not send a message to {chat_id}, will retry: {exc}')
+            return False
+        except telegram.error.TelegramError as exc:
+            logger.error(f'An error has occurred during sending a message to {chat_id}: {exc}')
+            return True
+    return False
+
+
+def record_latency(pipe, chat_id, latency):
+    pipe.lpush(LATENCY_KEY, round(latency, 3))
+    pipe.ltrim(LATENCY_KEY, 0, LATENCY_SAMPLES - 1)
+    pipe.hincrbyfloat(LATENCY_SUM_KEY, chat_id, latency)
+    pipe.hincrby(LATENCY_COUNT_KEY, chat_id, 1)
+
+
+def latency_stats(db):
+    """Percentiles of the latest delivery latencies and of average latency per chat"""
+    latencies = [float(latency) for latency in db.lrange(LATENCY_KEY, 0, -1)]
+    counts = db.hgetall(LATENCY_COUNT_KEY)
+    per_chat = [float(total) / int(counts[chat_id])
+                for chat_id, total in db.hgetall(LATENCY_SUM_KEY).items() if int(counts.get(chat_id, 0))]
+    return {'deliveries': len(latencies), 'p50': utils.percentile(latencies, 50),
+            'p99': utils.percentile(latencies, 99), 'chats': len(per_chat),
+            'chat_p50': utils.percentile(per_chat, 50), 'chat_p99': utils.percentile(per_chat, 99)}
+
+
+def format_latency_stats(stats):
+    return (f'Time to notify: p50 {stats["p50"]:.1f}s, p99 {stats["p99"]:.1f}s over {stats["deliveries"]} '
+            f'latest messages; average per chat: p50 {stats["chat_p50"]:.1f}s, p99 {stats["chat_p99"]:.1f}s '
+            f'over {stats["chats"]} chats')
+
+
+def consume(db, bot, consumer, count=READ_COUNT, block_ms=READ_BLOCK_MS, on_unauthorized=None,
+            stream=STREAM, group=GROUP):
+    """Deliver a batch of outbox entries, returns number of entries acknowledged"""
+    acked = 0
+    for entry_id, fields in _read(db, consumer, count, block_ms, stream, group):
+        # fields are empty if the entry has been deleted while pending
+        if fields and not deliver(bot, fields[b'chat_id'].decode('utf-8'), fields[b'text'].decode('utf-8'),
+                                  on_unauthorized):
+            continue
+        pipe = db.pipeline()
+        pipe.xack(stream, group, entry_id)
+        pipe.xdel(stream, entry_id)
+        if fields and b'created' in fields:
+            record_latency(pipe, fields[b'chat_id'].decode('utf-8'), time.time() - float(fields[b'created']))
+        if fields and b'trace' in fields and random.random() < tracing.DELIVERY_SAMPLE:
+            trace, enqueued = tracing.from_str(fields[b'trace'].decode('utf-8'))
+            if trace:
+                tracing.record('bot.deliver', enqueued, time.time_ns(), trace)
+        pipe.execute()
+        acked += 1
+    return acked
+
+
+def run_sender(db, bot, consumer, stop_event, on_unauthorized=None):
+    """Deliver outbox entries until stop_event is set"""
+    logger.info('Outbox sender %s has started', consumer)
+    has_group = False
+    while not stop_event.is_set():
+        try:
+            if not has_group:
+                ensure_group(db)
+                has_group = True
+            consume(db, bot, consumer, on_unauthorized=on_unauthorized)
+        except redis.exceptions.ConnectionError as exc:
+            logger.error('Outbox is not reachable: %s', exc)
+            stop_event.wait(READ_BLOCK_MS / 1000)
+        except redis.exceptions.ResponseError as exc:
+            # the group is gone if the stream has been flushed
+            logger.error('Outbox read has failed: %s', exc)
+            has_group = 'NOGROUP' not in str(exc)
+            stop_event.wait(READ_BLOCK_MS / 1000)
+        except Exception:
+            # NOTE(ivasilev) nobody would restart a dead sender thread, so it keeps going whatever happens
+            logger.exception('Unexpected error in outbox sender %s', consumer)
+            stop_event.wait(READ_BLOCK_MS / 1000)
+
+
+def start_senders(db, bot, num, on_unauthorized=None):
+    """Start num sender threads, returns an event to set to stop them"""
+    stop_event = threading.Event()
+    for i in range(num):
+        threading.Thread(target=run_sender, args=(db, bot, consumer_name(i), stop_event, on_unauthorized),
+                         daemon=True).start()
+    return stop_event
+
+
+def _parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--senders', help='Number of sender threads', default=1, type=int)
+    return parser.parse_args(args)
+
+
+def main():
+    parsed_args = _parse_args()
+    subscriptions = redis.from_url(os.getenv('REDIS_URL', 'redis://redis:6379'))
+    db = redis.from_url(os.getenv('REDIS_INTERNAL_URL', 'redis://redis:6379/1'))
+    bot = telegram.Bot(os.getenv('TELEGRAM_BOT_TOKEN'))
+    stop_event = start_senders(db, bot, parsed_args.senders, on_unauthorized=subscriptions.delete)
+    try:
+        while not stop_event.is_set():
+            stop_event.wait(1)
+    except KeyboardInterrupt:
+        stop_event.set()
+
+
+if __name__ == "__main__":
+    main()
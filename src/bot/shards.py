@@ -0,0 +1,235 @@
+"""
+Notification workers sharded by chat_id.
+
+Every worker owns a hash partition of chat_ids: it watches the same published schools snapshot as the bot,
+loads subscriptions of its own partition only and delivers the update to them. As partitions don't overlap,
+N workers together send exactly one message per subscriber. Per-shard progress is kept in redis: the last
+delivered state, the state being delivered and the chat_ids already served, so a restarted worker resumes
+the interrupted fan-out instead of starting it anew. A lease, renewed during the fan-out, makes sure only one
+process serves a shard.
+
+Run `python src/bot/shards.py --shards N` to run all N shards as local processes or
+`python src/bot/shards.py --shards N --shard I` to run a single shard (e.g. one per container).
+Set NOTIFY_SHARDS=N for the bot then, so that it leaves fan-out to the workers.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+import zlib
+
+import redis
+import telegram
+
+from bot import filters
+from bot import outbox
+from checker import schools_data
+from utils import targets
+
+POLL_INTERVAL = float(os.getenv('SHARD_POLL_INTERVAL', '1'))
+LEASE_MS = int(os.getenv('SHARD_LEASE_MS', '30000'))
+# a fan-out takes longer than the lease, so it is renewed on the way
+LEASE_RENEW_INTERVAL = LEASE_MS / 3 / 1000
+# chat_ids already served are kept for a day at most in case the fan-out is abandoned
+DONE_TTL = 24 * 60 * 60
+SCAN_COUNT = 1000
+# set by the bot when notifications are paused by admin
+PAUSED_KEY = 'notifications:paused'
+
+# set up logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def shard_of(chat_id, shards):
+    """Stable (unlike hash()) shard number of a chat_id"""
+    return zlib.crc32(str(chat_id).encode('utf-8')) % shards
+
+
+def load_shard(db, shard, shards):
+    """Return {chat_id: tracked cities} for subscribers in the shard, empty list means all cities"""
+    res = {}
+    chat_ids = []
+
+    def _load_batch():
+        for chat_id, val in zip(chat_ids, db.mget(chat_ids)):
+            if val is not None:
+                res[chat_id] = [c for c in val.decode('utf-8').split(',') if c.strip()]
+        chat_ids.clear()
+
+    for key in db.scan_iter(count=SCAN_COUNT):
+        chat_id = key.decode('utf-8')
+        if shard_of(chat_id, shards) == shard:
+            chat_ids.append(chat_id)
+        if len(chat_ids) >= SCAN_COUNT:
+            _load_batch()
+    if chat_ids:
+        _load_batch()
+    return res
+
+
+def _state_digest(state):
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+class ShardWorker:
+
+    def __init__(self, shard, shards, subscriptions, db, bot, schools_snapshot, developer_chat_id=None):
+        self.shard = shard
+        self.shards = shards
+        self.subscriptions = subscriptions
+        self.db = db
+        self.bot = bot
+        self.schools_snapshot = schools_snapshot
+        self.developer_chat_id = str(developer_chat_id) if developer_chat_id else None
+        self.consumer = outbox.consumer_name(shard)
+        self.filters = filters.FilterIndex()
+        self._prefix = f'shard:{shards}:{shard}'
+
+    def _get_state(self, name):
+        val = self.db.get(f'{self._prefix}:{name}')
+        return json.loads(val) if val is not None else None
+
+    def _set_state(self, name, state):
+        self.db.set(f'{self._prefix}:{name}', json.dumps(state))
+
+    def _hold_lease(self):
+        key = f'{self._prefix}:lease'
+        if self.db.set(key, self.consumer, nx=True, px=LEASE_MS):
+            return True
+        # NOTE(ivasilev) the lease may expire and go to another process between the check and the renewal, the
+        # transaction fails then instead of extending somebody else's lease
+        with self.db.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != self.consumer.encode('utf-8'):
+                    return False
+                pipe.multi()
+                pipe.pexpire(key, LEASE_MS)
+                pipe.execute()
+            except redis.WatchError:
+                return False
+        return True
+
+    def poll(self):
+        """Pick up a new snapshot and deliver pending update to the shard, returns number of messages sent"""
+        if not self._hold_lease():
+            return 0
+        if self.schools_snapshot.changed():
+            new_state = self.schools_snapshot.get()
+            delivered = self._get_state('delivered')
+            if delivered is None:
+                # the very first run of the shard, nothing to compare to
+                self._set_state('delivered', new_state)
+            elif new_state and schools_data.has_changes(new_state, delivered):
+                # a newer state supersedes the one being delivered, the rest of the shard gets the newest one
+                self._set_state('pending', new_state)
+                # delivery latency of a superseding state counts from the first undelivered change
+                self.db.set(f'{self._prefix}:pending_since', time.time(), nx=True)
+        pending = self._get_state('pending')
+        if pending is None:
+            return 0
+        return self._deliver(pending)
+
+    def _deliver(self, new_state):
+        prev_state = self._get_state('delivered')
+        done_key = f'{self._prefix}:done:{_state_digest(new_state)}'
+        done = {chat_id.decode('utf-8') for chat_id in self.db.smembers(done_key)}
+        paused = self.db.exists(PAUSED_KEY)
+        pending_since = float(self.db.get(f'{self._prefix}:pending_since') or 0)
+        sent = 0
+        subscriptions = load_shard(self.subscriptions, self.shard, self.shards)
+        notifications = self.filters.refresh(self.db).notifications(new_state, prev_state)
+        # "all cities" are the cities of the main target
+        main_cities = targets.main_cities(new_state)
+        lease_renewed = time.monotonic()
+        for chat_id in outbox.fair_order(subscriptions):
+            if chat_id in done:
+                continue
+            if time.monotonic() - lease_renewed >= LEASE_RENEW_INTERVAL:
+                if not self._hold_lease():
+                    # NOTE(ivasilev) another process serves the shard now, going on would send duplicates
+                    logger.warning('Shard %s/%s: lease has been lost, %s messages sent', self.shard, self.shards,
+                                   sent)
+                    return sent
+                lease_renewed = time.monotonic()
+            # NOTE(ivasilev) no cities means all of them to diff_to_str, a chat whose filter rules out every change
+            # gets no message
+            chosen_cities = notifications.cities(chat_id, subscriptions[chat_id] or main_cities)
+            message = (schools_data.diff_to_str(new_state, prev_state, chosen_cities, url_in_header=True)
+                       if chosen_cities else '')
+            pipe = self.db.pipeline()
+            if message and (not paused or chat_id == self.developer_chat_id):
+                if not outbox.deliver(self.bot, chat_id, message, on_unauthorized=self.subscriptions.delete):
+                    # throttled, the rest of the shard will be served on the next poll
+                    return sent
+                sent += 1
+                if pending_since:
+                    outbox.record_latency(pipe, chat_id, time.time() - pending_since)
+            pipe.sadd(done_key, chat_id)
+            pipe.expire(done_key, DONE_TTL)
+            pipe.execute()
+        pipe = self.db.pipeline()
+        pipe.set(f'{self._prefix}:delivered', json.dumps(new_state))
+        pipe.delete(f'{self._prefix}:pending', f'{self._prefix}:pending_since', done_key)
+        pipe.execute()
+        logger.info('Shard %s/%s: update has been delivered, %s messages sent', self.shard, self.shards, sent)
+        return sent
+
+
+def run_shard(shard, shards):
+    subscriptions = redis.from_url(os.getenv('REDIS_URL', 'redis://redis:6379'))
+    db = redis.from_url(os.getenv('REDIS_INTERNAL_URL', 'redis://redis:6379/1'))
+    bot = telegram.Bot(os.getenv('TELEGRAM_BOT_TOKEN'))
+    schools_snapshot = schools_data.StateReader(targets.load())
+    worker = ShardWorker(shard, shards, subscriptions, db, bot, schools_snapshot,
+                         developer_chat_id=os.getenv('DEVELOPER_CHAT_ID'))
+    logger.info('Serving shard %s/%s', shard, shards)
+    while True:
+        poll_safely(worker)
+        time.sleep(POLL_INTERVAL)
+
+
+def poll_safely(worker):
+    """Poll the worker, errors are logged and the next poll tries again, returns number of messages sent"""
+    try:
+        return worker.poll()
+    except redis.exceptions.ConnectionError as exc:
+        logger.error('Redis is not reachable: %s', exc)
+    except Exception:
+        # NOTE(ivasilev) nobody would restart a dead shard process, its chats would silently get no updates
+        logger.exception('Unexpected error in shard %s/%s', worker.shard, worker.shards)
+    return 0
+
+
+def _parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', help='Total number of shards', required=True, type=int)
+    parser.add_argument('--shard', help='Serve only this shard, all shards are run as processes otherwise',
+                        type=int)
+    return parser.parse_args(args)
+
+
+def main():
+    parsed_args = _parse_args()
+    if parsed_args.shard is not None:
+        run_shard(parsed_args.shard, parsed_args.shards)
+        return
+    processes = [multiprocessing.Process(target=run_shard, args=(shard, parsed_args.shards), daemon=True)
+                 for shard in range(parsed_args.shards)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+In-process cache of subscriptions.
+
+Subscriptions are read on every status update and changed only by /track and /notrack, so the bot keeps them in
+memory. The cache is loaded with a single scan, bounded with LRU eviction and kept coherent with redis keyspace
+notifications: every change of a key (by this bot or anyone else) makes the cache re-read it. Notifications are
+fire-and-forget, the ones sent while the listener was disconnected are lost, so the cache is reconciled with redis
+right after reconnecting and periodically: every subscription is re-read and differences repaired.
+
+As long as every subscriber fits into the cache the list of subscribers is served from memory too.
+"""
+import collections
+import logging
+import os
+import threading
+
+import redis
+
+CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', '200000'))
+RECONCILE_INTERVAL = int(os.getenv('SUBSCRIPTION_RECONCILE_INTERVAL', '300'))
+# keyspace events (K) of generic (g) and string ($) commands and of expired keys (x)
+NOTIFY_EVENTS = 'Kg$x'
+SCAN_COUNT = 1000
+RETRY_INTERVAL = 5
+
+# set up logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def enable_notifications(db, events=NOTIFY_EVENTS):
+    """Make redis publish keyspace events the cache relies on, returns False if redis doesn't allow that"""
+    try:
+        current = db.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+        missing = '' if 'A' in current and 'K' in current else ''.join(e for e in events if e not in current)
+        if missing:
+            db.config_set('notify-keyspace-events', current + missing)
+    except redis.ResponseError as exc:
+        # NOTE(ivasilev) managed redis services often disable CONFIG, periodic reconcile is all we have then
+        logger.warning('Could not enable keyspace notifications: %s', exc)
+        return False
+    return True
+
+
+class SubscriptionCache:
+
+    def __init__(self, db, max_size=CACHE_SIZE):
+        self.db = db
+        self.max_size = max_size
+        # chat_id -> tracked cities string, least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # bumped on every notification, a reconcile racing with a change doesn't overwrite it
+        self._version = 0
+        # set while every subscriber is in the cache
+        self.complete = False
+        self.stats = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _put(self, chat_id, value):
+        self._entries[chat_id] = value
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+            self.complete = False
+
+    def put(self, chat_id, value):
+        with self._lock:
+            self._put(str(chat_id), value)
+
+    def discard(self, chat_id):
+        with self._lock:
+            self._entries.pop(str(chat_id), None)
+
+    def get(self, chat_id):
+        """Return tracked cities string of chat_id ('' for all cities) or None if not subscribed"""
+        return self.get_many([chat_id]).get(str(chat_id))
+
+    def get_many(self, chat_ids):
+        """Return {chat_id: tracked cities string} of subscribed chat_ids"""
+        res = {}
+        missing = []
+        with self._lock:
+            for chat_id in map(str, chat_ids):
+                if chat_id in self._entries:
+                    self._entries.move_to_end(chat_id)
+                    res[chat_id] = self._entries[chat_id]
+                    self.stats['hits'] += 1
+                elif not self.complete:
+                    missing.append(chat_id)
+            complete = self.complete
+        if complete:
+            return res
+        self.stats['misses'] += len(missing)
+        for start in range(0, len(missing), SCAN_COUNT):
+            chunk = missing[start:start + SCAN_COUNT]
+            version = self._version
+            values = self.db.mget(chunk)
+            with self._lock:
+                for chat_id, val in zip(chunk, values):
+                    if val is not None:
+                        res[chat_id] = val.decode('utf-8')
+                        # a value read before a notification may be stale already, it is not cached then
+                        if version == self._version:
+                            self._put(chat_id, res[chat_id])
+        return res
+
+    def chat_ids(self):
+        """Return all subscribed chat_ids if they are all in the cache, None otherwise"""
+        with self._lock:
+            return list(self._entries) if self.complete else None
+
+    def _read_all(self):
+        """Return {chat_id: tracked cities string} of every subscriber or None if they don't fit into the cache"""
+        res = {}
+        chat_ids = []
+
+        def _read_batch():
+            for chat_id, val in zip(chat_ids, self.db.mget(chat_ids)):
+                if val is not None:
+                    res[chat_id] = val.decode('utf-8')
+            chat_ids.clear()
+
+        for key in self.db.scan_iter(count=SCAN_COUNT):
+            chat_ids.append(key.decode('utf-8'))
+            if len(chat_ids) >= SCAN_COUNT:
+                _read_batch()
+                if len(res) > self.max_size:
+                    return None
+        if chat_ids:
+            _read_batch()
+        return res if len(res) <= self.max_size else None
+
+    def load(self):
+        """Read every subscriber into the cache, returns number of subscribers loaded"""
+        version = self._version
+        entries = self._read_all()
+        with self._lock:
+            if entries is None:
+                logger.info('Subscribers don\'t fit into the cache of %s, keeping recently used ones', self.max_size)
+                return 0
+            if version != self._version:
+                # something has changed during the scan, next reconcile will try again
+                return 0
+            self._entries = collections.OrderedDict(entries)
+            self.complete = True
+        return len(entries)
+
+    def reconcile(self):
+        """Compare the cache to redis and repair differences, returns number of entries repaired"""
+        if not self.complete:
+            if self.load():
+                return 0
+            return self._reconcile_cached()
+        version = self._version
+        entries = self._read_all()
+        with self._lock:
+            if entries is None:
+                # subscribers have outgrown the cache
+                self.complete = False
+                return 0
+            if version != self._version:
+                return 0
+            # NOTE(ivasilev) managed redis disables DEBUG DIGEST, there's no cheaper digest to compare before reading
+            if entries == self._entries:
+                return 0
+            repaired = len(set(entries.items()) ^ set(self._entries.items()))
+            self._entries = collections.OrderedDict(entries)
+        self.stats['repaired'] += repaired
+        logger.warning('Subscription cache was out of sync with redis, %s entries repaired', repaired)
+        return repaired
+
+    def _reconcile_cached(self):
+        """Re-read entries of a partial cache"""
+        with self._lock:
+            chat_ids = list(self._entries)
+        repaired = 0
+        for start in range(0, len(chat_ids), SCAN_COUNT):
+            chunk = chat_ids[start:start + SCAN_COUNT]
+            version = self._version
+            values = self.db.mget(chunk)
+            with self._lock:
+                if version != self._version:
+                    continue
+                for chat_id, val in zip(chunk, values):
+                    cached = self._entries.get(chat_id)
+                    val = val.decode('utf-8') if val is not None else None
+                    if cached is None or cached == val:
+                        continue
+                    repaired += 1
+                    if val is None:
+                        del self._entries[chat_id]
+                    else:
+                        self._entries[chat_id] = val
+        self.stats['repaired'] += repaired
+        return repaired
+
+    def on_event(self, message):
+        """Handle a keyspace notification about a change of a subscription"""
+        chat_id = message['channel'].decode('utf-8').split(':', 1)[1]
+        val = self.db.get(chat_id)
+        with self._lock:
+            self._version += 1
+            self.stats['invalidations'] += 1
+            if val is None:
+                self._entries.pop(chat_id, None)
+            else:
+                self._put(chat_id, val.decode('utf-8'))
+
+    def _listen(self):
+        db_num = self.db.connection_pool.connection_kwargs.get('db', 0)
+        while not self._stop.is_set():
+            try:
+                pubsub = self.db.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f'__keyspace@{db_num}__:*')
+                # subscribed before reading, so no change slips in between; changes missed while disconnected
+                # are picked up here as well
+                self.reconcile()
+                while not self._stop.is_set():
+                    message = pubsub.get_message(timeout=1)
+                    if message:
+                        self.on_event(message)
+                pubsub.close()
+            except redis.ConnectionError as exc:
+                logger.warning('Lost keyspace notifications: %s', exc)
+                self._stop.wait(RETRY_INTERVAL)
+            except Exception:
+                # the thread must not die, the cache would silently go stale
+                logger.exception('Unexpected error while listening to keyspace notifications')
+                self._stop.wait(RETRY_INTERVAL)
+
+    def start(self):
+        """Enable keyspace notifications and start listening to them"""
+        enable_notifications(self.db)
+        self._thread = threading.Thread(target=self._listen, name='subscription-cache', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def format_stats(self):
+        return (f'Subscription cache: {len(self)} entries{" (all subscribers)" if self.complete else ""}, '
+                f'{self.stats["hits"]} hits, {self.stats["misses"]} misses, {self.stats["evictions"]} evictions, '
+                f'{self.stats["repaired"]} repaired')
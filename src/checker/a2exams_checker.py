@@ -1,20 +1,28 @@
 import argparse
 import asyncio
-import csv
 import datetime
+import functools
 import json
 import logging
 import os
 import sys
+import time
 
-from bs4 import BeautifulSoup
-import pytz
 import unidecode
 
+from checker import rollups
+# NOTE(ivasilev) The lightweight part of the checker lives in schools_data, so that the bot doesn't have to
+# load html parsers. The names are reexported here for backwards compatibility.
+from checker.schools_data import (BASEURL, LAST_FETCHED_JSON, diff_to_str, get_last_fetch_time_from_data,
+                                  get_schools_from_file, has_changes, load_schools)
 import utils
+from utils import breaker
+from utils import health
+from utils import snapshot
+from utils import targets
+from utils import tracing
 
 
-BASEURL = 'https://cestina-pro-cizince.cz/trvaly-pobyt/a2/online-prihlaska/'
 # interval to wait before repeating the request
 POLLING_INTERVAL = int(os.getenv('POLLING_INTERVAL', '25'))
 TZ = 'Europe/Prague'
@@ -24,7 +32,20 @@ URL_GET = os.getenv('URL_GET')
 TOKEN_GET = os.getenv('TOKEN_GET')
 URL_LAST_FETCHED_TS = os.getenv('URL_GET_TS', 'https://ciziproblem.cz/trvaly-pobyt/a2/lastupdate')
 LAST_FETCHED = os.path.join(OUTPUT_DIR, 'last_fetched.html')
-LAST_FETCHED_JSON = os.path.join(OUTPUT_DIR, 'last_fetched.json')
+# NOTE(ivasilev) Detail pages of open cities list exam dates, but they need a browser just like the main page
+# does nowadays. Only turn it on where a plain GET gets through (e.g. a mirror). Subscription filters (/filter) rely
+# on these dates and rule nothing out without them.
+FETCH_EXAM_SLOTS = os.getenv('FETCH_EXAM_SLOTS', 'no') in ('1', 'yes', 'true')
+# seconds a detail page may take, the parsed state is not published until all of them are there
+EXAM_SLOTS_TIMEOUT = int(os.getenv('EXAM_SLOTS_TIMEOUT', '15'))
+# the checker is not ready if the newest data it has parsed is older than that
+HEALTH_THRESHOLD = int(os.getenv('HEALTH_THRESHOLD', '300'))
+# how late the main loop may be on top of the polling interval, e.g. because of a slow download
+HEARTBEAT_SLACK = 120
+# fetch time of the newest data parsed, kept in memory for health checks
+LAST_DATA_TIME = None
+# pulls from the registry per target, the registry is not polled every cycle while it doesn't give a page
+PULL_BREAKERS = {}
 
 # set up logging
 logging.basicConfig()
@@ -33,6 +54,8 @@ logger.setLevel(logging.DEBUG)
 
 
 def _extract_data(html, tag, cls, strings_only=True):
+    # parsers are heavy to import and are needed only once there is some html to parse
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(html, features="lxml")
     all_tags = soup.find_all(tag, {'class': cls})
     return [t.text.split() if strings_only else t for t in all_tags]
@@ -111,15 +134,22 @@ def _html_to_exam_slots(html, tag='div', cls='terminy'):
     return res
 
 
-async def _html_to_schools(html, tag='li', cls=''):
+async def _html_to_schools(html, tag='li', cls='', timestamp=None):
+    """
+    Parse schools data from html, the time data has been fetched at is requested unless timestamp is given.
+    """
+    if timestamp is None:
+        timestamp = await get_last_fetch_time()
+    return _parse_schools(html, timestamp, tag=tag, cls=cls)
+
+
+def _parse_schools(html, timestamp, tag='li', cls=''):
     """
     In case layout changes this function only has to be tuned to extract necessary data.
     Returned value is a dict with no-diacrytics-city-name used as keys
     """
     res = {}
-    timestamp = datetime.datetime.now(tz=pytz.timezone(TZ)).timestamp()
     schools_data = _extract_data(html, tag, cls)
-    timestamp = await get_last_fetch_time()
     urls_data = _html_to_schools_urls(html)
     # Sometimes the name of a town consists of several words, account for that
     for city_info in schools_data:
@@ -151,104 +181,94 @@ def _parse_args(args, cities_choices):
     parser.add_argument('--city', help='City to track exams in', choices=cities_choices, action='append')
     parser.add_argument('--interval', help='Interval to poll a website with exams registration',
                         default=POLLING_INTERVAL, type=int)
+    parser.add_argument('--reprocess', help='Rebuild history from html snapshots in a directory or archive and exit')
+    parser.add_argument('--output-dir', help='Where to put rebuilt history',
+                        default=os.path.join(OUTPUT_DIR, 'reprocessed'))
+    parser.add_argument('--workers', help='Number of processes to parse snapshots with, all cores by default',
+                        type=int)
+    parser.add_argument('--no-resume', help='Start reprocessing anew even if it has been interrupted',
+                        action='store_true')
     return parser.parse_args(args)
 
 
-def get_schools_from_file(filename=LAST_FETCHED_JSON, tag='li', cls='', cities_filter=None):
-    """
-    Read last saved html and load exams registration data. No fetching here, just give what was saved last.
-    """
-    if not os.path.isfile(filename):
-        return {}
-    with open(filename) as f:
-        try:
-            res = json.loads(f.read())
-        except json.decoder.JSONDecodeError:
-            return {}
-    if not cities_filter:
-        return res
-    return {k:v for (k, v) in res.items() if k in cities_filter}
-
-
 def _dump_schools_to_file(filename, schools):
     # Save last fetched to filename_json
     if filename:
-        with open(filename, 'w') as f:
-            f.write(json.dumps(schools))
+        snapshot.publish(filename, json.dumps(schools))
 
 
-async def html_to_schools(html_file=LAST_FETCHED, filename_json=LAST_FETCHED_JSON, tag='li', cls=''):
+async def html_to_schools(html_file=LAST_FETCHED, filename_json=LAST_FETCHED_JSON, tag='li', cls='', html=None,
+                          timestamp=None):
     """
     Generate last_fetched.json from html data, save it locally and return exams registration data.
+    If html is passed then html_file is not read.
     """
-    with open(html_file) as f:
-        html = f.read()
-    res = await _html_to_schools(html, tag=tag, cls=cls)
-    _dump_schools_to_file(filename_json, res)
+    if html is None:
+        with open(html_file) as f:
+            html = f.read()
+    with tracing.span('checker.parse', tracing.extract(html)[0]) as trace:
+        res = await _html_to_schools(html, tag=tag, cls=cls, timestamp=timestamp)
+        if FETCH_EXAM_SLOTS:
+            await add_exam_slots(res)
+        # the bot picks the trace up from the json
+        for data in res.values():
+            data['trace'] = tracing.to_str(trace, time.time_ns())
+        _dump_schools_to_file(filename_json, res)
     return res
 
 
-async def fetch_exam_slots(url, tag='div', cls='terminy'):
-    # NOTE(ivasilev) This will need to be split between fetcher and checker.
-    # Currently this functionality is not supported
-    html = await fetch(url, retry_interval=5)
+def _slot_date(date):
+    """Iso date of an exam slot date like '09.03.2022, od 09:00' or None"""
+    try:
+        return datetime.datetime.strptime(date.split(',')[0].strip(), '%d.%m.%Y').date().isoformat()
+    except ValueError:
+        return None
+
+
+async def fetch_exam_slots(url, tag='div', cls='terminy', timeout=EXAM_SLOTS_TIMEOUT):
+    """Fetch and parse a city page, returns None if it could not be fetched in time"""
+    loop = asyncio.get_running_loop()
+    # NOTE(ivasilev) requests blocks, a thread keeps the event loop going while the page is downloaded
+    try:
+        html = await asyncio.wait_for(
+            loop.run_in_executor(None, functools.partial(utils.fetch_text, url, logger, timeout=timeout)), timeout)
+    except asyncio.TimeoutError:
+        return None
+    if not html:
+        return None
     return _html_to_exam_slots(html, tag=tag, cls=cls)
 
 
+async def add_exam_slots(schools_data, fetch_func=fetch_exam_slots):
+    """
+    Add exam dates with the number of free slots to cities with open registration as 'slots': [[iso date, free]].
+    Cities with no slots key are the ones nothing is known about. Detail pages are fetched all at once.
+    """
+    cities = [c for c in schools_data if schools_data[c]['free_slots'] and schools_data[c].get('url')]
+    fetched = await asyncio.gather(*(fetch_func(schools_data[city]['url']) for city in cities))
+    for city, exam_slots in zip(cities, fetched):
+        if exam_slots is None:
+            logger.warning('Could not fetch exam dates of %s', city)
+            continue
+        schools_data[city]['total_slots'] = exam_slots['total']
+        schools_data[city]['slots'] = [[_slot_date(date), num] for date, num in exam_slots['details']
+                                       if _slot_date(date)]
+    return schools_data
+
+
 async def fetch_schools_with_exam_slots(html, filename=LAST_FETCHED, filename_json=LAST_FETCHED_JSON):
-    # NOTE(ivasilev) This will need to be split between fetcher and checker.
-    # Currently this functionality is not supported
     schools_data = await _html_to_schools(html)
     # now fetch additional information for schools with open registration and update schools data
-    for city in [c for c in schools_data if schools_data[c]['free_slots']]:
-        exam_slots = await fetch_exam_slots(schools_data[city]['url'])
-        schools_data[city]['total_slots'] = exam_slots['total']
+    await add_exam_slots(schools_data)
     _dump_schools_to_file(filename_json, schools_data)
     return schools_data
 
 
-def diff_to_str(new_data, old_data=None, cities=None, url_in_header=False):
-    """
-    Return a human readable state of exams registration in chosen cities (no cities chosen means all cities).
-    If previous state is passed then only changes to the state will be accounted for.
-
-    Cities parameter should be actual keys in schools data - no diacrytics
-    """
-    cities = [c for c in cities if c in new_data] if cities else new_data.keys()
-    msg = ''
-    for city in cities:
-        city_czech_name = new_data[city]['city_name']
-        date = utils.timestamp_to_str(new_data[city]['timestamp'])
-        exam_slots_msg = '' if not new_data[city]['total_slots'] else f' {new_data[city]["total_slots"]} slots'
-        # Assume by default there will be nothing to show
-        m = ''
-        if not old_data:
-            # Just show current state
-            m = (f'{city_czech_name} :(' if not new_data[city]['free_slots'] else
-                 f'{city_czech_name} :){exam_slots_msg}')
-        elif old_data:
-            if city not in old_data and new_data[city]['free_slots']:
-                # A new city has appeared overnight and there are free exam slots
-                m = f'{city_czech_name} :){exam_slots_msg}'
-            elif old_data[city]['free_slots'] != new_data[city]['free_slots']:
-                m = (f'{city_czech_name} :('
-                     if not new_data[city]['free_slots'] else
-                     f'{city_czech_name} :){exam_slots_msg}')
-        if m:
-            msg += f'{m}\n'
-    if msg:
-        # Add date from last city processed
-        msg = f'Update from {date}:\n{msg}'
-        # If requested - add url
-        if url_in_header:
-            msg = f'{BASEURL}\n{msg}'
-    return msg
-
-
 def write_csv(schools, tracked_cities, filename=CSV_FILENAME):
     """
     Dump exams registration information into csv.
     """
+    import csv
     with open(filename, 'a', newline='') as csvfile:
         fieldnames = ['timestamp', 'free_slots', 'city', 'total_slots']
         writer = csv.DictWriter(csvfile, fieldnames)
@@ -260,80 +280,124 @@ def write_csv(schools, tracked_cities, filename=CSV_FILENAME):
                              'total_slots': schools[city]['total_slots']})
 
 
-def has_changes(new_data, old_data, chosen_cities=None):
-    """
-    A (hopefully) useful method to quickly check if the state has changed.
-    """
-    chosen_cities = chosen_cities or []
-    cities = [c for c in chosen_cities if c in new_data.keys()] or new_data.keys()
-    # if new cities have appeared -> check if there are any free slots
-    new_cities_appeared = set(cities) - set(old_data.keys())
-    if any(new_data[c]['free_slots'] for c in new_cities_appeared):
-        return True
-    # Filter against new cities and check for changes the usual way
-    cities_to_check = set(cities) & set(old_data.keys())
-    return any(old_data[c]['free_slots'] != new_data[c]['free_slots'] for c in cities_to_check)
-
-
-async def get_last_fetch_time(human_readable=False):
-    """
-    Return timestamp of the last modification to the last_fetched.html file or
-    a human-readable date and time if requested.
-    """
-    if not URL_LAST_FETCHED_TS:
-        # offline mode
-        return utils.get_modification_time(LAST_FETCHED, human_readable)
-    # Take real timestamp of data from centralized repo
-    ts = await utils.do_fetch(URL_LAST_FETCHED_TS, logger)
-    if not human_readable:
-        return ts
-    return utils.timestamp_to_str(ts)
+def _get_pull_breaker(target):
+    """Breaker of all registry requests made for the target, pages and timestamps alike"""
+    if target.name not in PULL_BREAKERS:
+        PULL_BREAKERS[target.name] = breaker.CircuitBreaker(f'Registry pull of {target.name}')
+    return PULL_BREAKERS[target.name]
 
 
-def get_last_fetch_time_from_data(human_readable=False):
+async def get_last_fetch_time(human_readable=False, target=None):
     """
-    Return timestamp of the data from the latest json file or a human-readable date and time if requested.
+    Return timestamp of the last modification to the last_fetched.html file (of the main target unless other
+    target is given) or a human-readable date and time if requested.
     """
-    new_data = get_schools_from_file()
-    # take timestamp from the first city for now
-    # XXX FIXME(ivasilev) One day there'll be a real date field
-    random_city_data = new_data[list(new_data.keys())[0]] if new_data.keys() else {}
-    ts = random_city_data.get('timestamp', '')
+    target = target or targets.Target('a2', None, main=True)
+    url = target.registry_url('url_get_ts', URL_LAST_FETCHED_TS)
+    if not url:
+        # offline mode
+        return utils.get_modification_time(target.last_fetched if not target.main else LAST_FETCHED, human_readable)
+    # Take real timestamp of data from centralized repo
+    pull_breaker = _get_pull_breaker(target)
+    if not pull_breaker.allow():
+        logger.warning("Registry is unreachable, next attempt in %s seconds", pull_breaker.retry_in())
+        return None
+    ts = await utils.do_fetch(url, logger)
+    if ts:
+        pull_breaker.success()
+    else:
+        pull_breaker.failure()
     if not human_readable:
         return ts
     return utils.timestamp_to_str(ts)
 
 
-async def get_latest_html(filename=LAST_FETCHED):
+async def get_latest_html(filename=LAST_FETCHED, target=None):
     """
-    Obtain latest html data with exam slots, save it as LAST_FETCHED and return obtained data as text.
+    Obtain latest html data with exam slots, save it as filename and return obtained data as text.
+    Pages of targets other than the main one are only requested from the registry endpoint of the target.
 
     2 different modes of operation are supported:
-      - if TOKEN_GET and URL_GET are set, then the data is fetched over network from a centralized registry;
-      - otherwise it expects new data to magically appear in LAST_FETCHED file and just displays its contents
+      - if TOKEN_GET and URL_GET (url_get of the target) are set, then the data is fetched over network from a
+        centralized registry;
+      - otherwise it expects new data to magically appear in filename and just displays its contents
     """
     html = None
-    if not URL_GET or not TOKEN_GET:
-        logger.info("Working in offline mode, just displaying contents of the %s file", LAST_FETCHED)
-        if os.path.isfile(LAST_FETCHED):
-            with open(LAST_FETCHED) as f:
+    target = target or targets.Target('a2', None, main=True)
+    url = target.registry_url('url_get', URL_GET)
+    if not url or not TOKEN_GET:
+        logger.info("Working in offline mode, just displaying contents of the %s file", filename)
+        if os.path.isfile(filename):
+            with open(filename) as f:
                 return f.read()
+        return None
     # online mode, fetch data from centralized repo as defined by URL_GET
-    logger.info("Working in online mode, fetching data from %s", URL_GET)
-    url = f'{URL_GET}?token={TOKEN_GET}'
-    html = await utils.do_fetch(url, logger)
+    pull_breaker = _get_pull_breaker(target)
+    if not pull_breaker.allow():
+        logger.warning("Registry is unreachable, next attempt in %s seconds", pull_breaker.retry_in())
+        return None
+    logger.info("Working in online mode, fetching data from %s", url)
+    html = await utils.do_fetch(f'{url}?token={TOKEN_GET}', logger)
     if html:
-        with open(LAST_FETCHED, 'w') as f:
-            f.write(html)
+        pull_breaker.success()
+        snapshot.publish(filename, html)
+    else:
+        pull_breaker.failure()
     if not html:
         logger.warning("No data fetched!")
     return html
 
 
+def _check_data_age():
+    if LAST_DATA_TIME is None:
+        return False, 'no data has been parsed yet'
+    age = time.time() - LAST_DATA_TIME
+    return age < HEALTH_THRESHOLD, f'newest data is {int(age)} s old'
+
+
+async def _poll_target(target, html_snapshot, last_traces, force=False):
+    """
+    Get the latest page of the target and parse it if it is a new one (or if forced to), returns parsed data or
+    None if there is nothing new.
+    """
+    poll_started = time.time_ns()
+    await get_latest_html(target.last_fetched, target=target)
+    poll_ended = time.time_ns()
+    if not force and not html_snapshot.changed():
+        logger.debug("No new snapshot of %s has been published, nothing to parse", target.last_fetched)
+        return None
+    html = html_snapshot.get()
+    if html is None:
+        # nothing has been fetched for the target yet
+        return None
+    trace, handed_over = tracing.extract(html)
+    if trace and trace != last_traces.get(target.name):
+        # the page has waited for the poll since the fetcher has published it
+        tracing.record('registry.wait', handed_over, max(handed_over, poll_started), trace, target=target.name)
+        tracing.record('checker.poll', poll_started, poll_ended, trace, target=target.name)
+        last_traces[target.name] = trace
+    timestamp = None if target.main else await get_last_fetch_time(target=target)
+    return await html_to_schools(target.last_fetched, filename_json=target.last_fetched_json,
+                                 tag=target.profile['tag'], cls=target.profile['cls'], html=html,
+                                 timestamp=timestamp)
+
+
 async def main():
     """The infinite loop of check html -> process it -> wait -> check html ..."""
+    parsed_args = _parse_args(sys.argv[1:], cities_choices=None)
+    if parsed_args.reprocess:
+        from checker import reprocess
+        chosen_cities = [unidecode.unidecode(c.lower().capitalize()) for c in parsed_args.city or []]
+        reprocess.reprocess(parsed_args.reprocess, parsed_args.output_dir, cities=chosen_cities,
+                            workers=parsed_args.workers, resume=not parsed_args.no_resume)
+        return
+    global LAST_DATA_TIME
+    tracing.SERVICE_NAME = 'checker'
+    health.add_check('data_age', _check_data_age)
+    health.serve()
     # fetch initial data to set everything up (default choices for cities etc)
     while not os.path.isfile(LAST_FETCHED):
+        health.heartbeat(POLLING_INTERVAL + HEARTBEAT_SLACK)
         await get_latest_html()
         # No file with data, let's wait a bit
         logging.debug("No file with data found, let's wait %s seconds", POLLING_INTERVAL)
@@ -342,13 +406,34 @@ async def main():
     all_cities = sorted(schools.keys())
     parsed_args = _parse_args(sys.argv[1:], cities_choices=all_cities)
     chosen_cities = [unidecode.unidecode(c.lower().capitalize()) for c in parsed_args.city or []]
+    all_targets = targets.load()
+    for target in all_targets:
+        os.makedirs(target.directory, exist_ok=True)
+    html_snapshots = {target.name: snapshot.SnapshotReader(target.last_fetched) for target in all_targets}
+    history = rollups.load_from_file()
+    last_traces = {}
     try:
         old_data = {}
         while True:
+            health.heartbeat(parsed_args.interval + len(all_targets) * HEARTBEAT_SLACK)
             await asyncio.sleep(parsed_args.interval)
-            # See if html has been updated
-            await get_latest_html()
-            new_data = await html_to_schools(LAST_FETCHED)
+            # See if html has been updated, the main target goes first so that its data is published without
+            # waiting for pulls of the other ones
+            new_data = await _poll_target(all_targets[0], html_snapshots[all_targets[0].name], last_traces,
+                                          force=not old_data)
+            # NOTE(ivasilev) other targets are only parsed and published, history and csv are kept for the main one
+            for target in all_targets[1:]:
+                await _poll_target(target, html_snapshots[target.name], last_traces)
+            health.report(registry={name: b.format_state() for name, b in PULL_BREAKERS.items()})
+            if new_data is None:
+                continue
+            if new_data:
+                LAST_DATA_TIME = max(float(data['timestamp'] or 0) for data in new_data.values())
+                health.report(data_time=utils.timestamp_to_str(LAST_DATA_TIME),
+                              open_cities=[c for c in new_data if new_data[c]['free_slots']])
+            # history of all cities is kept regardless of cities chosen
+            if rollups.update(history, new_data):
+                rollups.save(history)
             cities = schools.keys() if not chosen_cities else chosen_cities
             curr_date = utils.timestamp_to_str(datetime.datetime.now().timestamp())
             # Here date will be taken from data to reflect real state of things
@@ -0,0 +1,183 @@
+"""
+Batch reprocessing of archived html snapshots.
+
+Once the parser has been fixed after a layout change the derived data has to be rebuilt from saved pages. The
+snapshots of a directory, tar or zip archive (or the fetcher's own archive of pages) are ordered by the time
+they have been taken at and parsed by a pool of processes, results are consumed in the same order and streamed
+into the csv history and slot release rollups. Progress is checkpointed, so an interrupted run continues where
+it has stopped.
+
+Run `python src/checker/a2exams_checker.py --reprocess DIR_OR_ARCHIVE [--output-dir DIR]`
+"""
+import collections
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import tarfile
+import time
+import zipfile
+
+from checker import a2exams_checker
+from checker import rollups
+from checker import schools_data
+
+SNAPSHOT_SUFFIXES = ('.html', '.htm')
+CHECKPOINT_EVERY = int(os.getenv('REPROCESS_CHECKPOINT_EVERY', '200'))
+PROGRESS_INTERVAL = 10
+# snapshots being parsed or waiting to be consumed per worker, bounds memory taken by html in flight
+IN_FLIGHT_PER_WORKER = 4
+
+# set up logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def _is_fetcher_archive(source):
+    from fetcher import archive
+    return os.path.isfile(os.path.join(source, archive.INDEX_FILE))
+
+
+def list_snapshots(source):
+    """
+    Return [(timestamp, name)] of html snapshots in a directory, tar or zip archive or the fetcher's archive
+    ordered by time
+    """
+    res = []
+    if os.path.isdir(source) and _is_fetcher_archive(source):
+        from fetcher import archive
+        # names are page digests here
+        res = list(archive.SnapshotArchive(source, max_bytes=0).entries())
+    elif os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for filename in files:
+                if filename.endswith(SNAPSHOT_SUFFIXES):
+                    path = os.path.join(root, filename)
+                    res.append((os.path.getmtime(path), os.path.relpath(path, source)))
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            res = [(datetime.datetime(*info.date_time).timestamp(), info.filename) for info in archive.infolist()
+                   if info.filename.endswith(SNAPSHOT_SUFFIXES)]
+    elif tarfile.is_tarfile(source):
+        with tarfile.open(source) as archive:
+            res = [(member.mtime, member.name) for member in archive.getmembers()
+                   if member.isfile() and member.name.endswith(SNAPSHOT_SUFFIXES)]
+    else:
+        raise ValueError(f'{source} is neither a directory nor a tar or zip archive')
+    return sorted(res)
+
+
+def read_snapshots(source, snapshots):
+    """Yield (timestamp, name, html) for the given snapshots of source in the given order"""
+    if os.path.isdir(source) and _is_fetcher_archive(source):
+        from fetcher import archive
+        snapshot_archive = archive.SnapshotArchive(source, max_bytes=0)
+        for timestamp, digest in snapshots:
+            yield timestamp, digest, snapshot_archive.get(digest)
+    elif os.path.isdir(source):
+        for timestamp, name in snapshots:
+            with open(os.path.join(source, name), errors='replace') as f:
+                yield timestamp, name, f.read()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for timestamp, name in snapshots:
+                yield timestamp, name, archive.read(name).decode('utf-8', 'replace')
+    else:
+        with tarfile.open(source) as archive:
+            for timestamp, name in snapshots:
+                yield timestamp, name, archive.extractfile(name).read().decode('utf-8', 'replace')
+
+
+def _parse_snapshot(timestamp, name, html):
+    """Runs in a worker process"""
+    try:
+        return timestamp, name, a2exams_checker._parse_schools(html, timestamp)
+    except Exception as exc:
+        logger.error('Could not parse %s: %s', name, exc)
+        return timestamp, name, {}
+
+
+def _parse_in_order(pool, snapshots, in_flight):
+    """Parse snapshots in the pool, yield results in the order of snapshots with at most in_flight pending"""
+    pending = collections.deque()
+    for snapshot in snapshots:
+        pending.append(pool.submit(_parse_snapshot, *snapshot))
+        if len(pending) >= in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _load_checkpoint(filename, source, total):
+    if not os.path.isfile(filename):
+        return None
+    with open(filename) as f:
+        checkpoint = json.load(f)
+    if checkpoint['source'] != source or checkpoint['total'] != total:
+        logger.warning('Checkpoint %s belongs to another run, starting over', filename)
+        return None
+    return checkpoint
+
+
+def _save_checkpoint(filename, checkpoint):
+    tmp = f'{filename}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, filename)
+
+
+def reprocess(source, output_dir, cities=None, workers=None, resume=True):
+    """
+    Rebuild csv history and rollups in output_dir from html snapshots of source, returns number of snapshots
+    processed in this run
+    """
+    source = os.path.abspath(source)
+    os.makedirs(output_dir, exist_ok=True)
+    csv_filename = os.path.join(output_dir, os.path.basename(a2exams_checker.CSV_FILENAME))
+    rollups_filename = os.path.join(output_dir, os.path.basename(rollups.ROLLUPS_JSON))
+    checkpoint_filename = os.path.join(output_dir, 'reprocess.checkpoint')
+    snapshots = list_snapshots(source)
+    checkpoint = _load_checkpoint(checkpoint_filename, source, len(snapshots)) if resume else None
+    if checkpoint:
+        logger.info('Resuming after %s of %s snapshots', checkpoint['done'], checkpoint['total'])
+        # rows written after the checkpoint will be written again
+        with open(csv_filename, 'a') as f:
+            f.truncate(checkpoint['csv_size'])
+    else:
+        checkpoint = {'source': source, 'total': len(snapshots), 'done': 0, 'csv_size': 0, 'prev_state': {},
+                      'rollups': rollups.empty()}
+        open(csv_filename, 'w').close()
+    workers = workers or os.cpu_count()
+    todo = snapshots[checkpoint['done']:]
+    started = last_progress = time.monotonic()
+    processed = 0
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        for timestamp, name, schools in _parse_in_order(pool, read_snapshots(source, todo),
+                                                        workers * IN_FLIGHT_PER_WORKER):
+            if not schools:
+                logger.warning('No schools data in %s', name)
+            else:
+                rollups.update(checkpoint['rollups'], schools)
+                prev_state = checkpoint['prev_state']
+                tracked = [c for c in cities if c in schools] if cities else list(schools)
+                if not prev_state or schools_data.has_changes(schools, prev_state, tracked):
+                    a2exams_checker.write_csv(schools, tracked, filename=csv_filename)
+                    checkpoint['prev_state'] = schools
+            processed += 1
+            checkpoint['done'] += 1
+            if checkpoint['done'] % CHECKPOINT_EVERY == 0:
+                checkpoint['csv_size'] = os.path.getsize(csv_filename)
+                _save_checkpoint(checkpoint_filename, checkpoint)
+            if time.monotonic() - last_progress > PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                rate = processed / (last_progress - started)
+                logger.info('Reprocessed %s/%s snapshots, %.1f/s, %d s left', checkpoint['done'], checkpoint['total'],
+                            rate, (checkpoint['total'] - checkpoint['done']) / rate)
+    rollups.save(checkpoint['rollups'], rollups_filename)
+    if os.path.isfile(checkpoint_filename):
+        os.unlink(checkpoint_filename)
+    logger.info('Reprocessed %s snapshots in %.1f s, results are in %s', processed, time.monotonic() - started,
+                output_dir)
+    return processed
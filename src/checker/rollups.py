@@ -0,0 +1,130 @@
+"""
+Slot release history rolled up per city.
+
+Every observation of schools data is folded into a small fixed-size summary per city as soon as it arrives:
+how many times registration has opened by hour of day and by weekday, how long it stayed open and when it
+opened last. The checker publishes the rollups next to the schools json, so the bot answers /stats and
+/forecast from them without going through the history.
+"""
+import datetime
+import json
+import os
+import time
+
+from utils import snapshot
+
+OUTPUT_DIR = os.getenv('OUTPUT_DIR', 'output')
+ROLLUPS_JSON = os.path.join(OUTPUT_DIR, 'rollups.json')
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+
+def _empty_city(city_name):
+    return {'city_name': city_name,
+            'openings': 0,
+            'by_hour': [0] * 24,
+            'by_weekday': [0] * 7,
+            # set while registration is open
+            'open_since': None,
+            'last_opened': None,
+            'last_closed': None,
+            'last_open_seconds': None,
+            'total_open_seconds': 0,
+            'longest_open_seconds': 0}
+
+
+def empty():
+    return {'updated': None, 'cities': {}}
+
+
+def load(text):
+    """Load rollups from json text, broken json means no history"""
+    try:
+        return json.loads(text)
+    except json.decoder.JSONDecodeError:
+        return empty()
+
+
+def load_from_file(filename=ROLLUPS_JSON):
+    if not os.path.isfile(filename):
+        return empty()
+    with open(filename) as f:
+        return load(f.read())
+
+
+def save(rollups, filename=ROLLUPS_JSON):
+    snapshot.publish(filename, json.dumps(rollups))
+
+
+def update(rollups, schools):
+    """Fold an observation of schools data into rollups in place, returns cities that have opened or closed"""
+    changed = []
+    for city, data in schools.items():
+        city_rollup = rollups['cities'].setdefault(city, _empty_city(data.get('city_name') or city))
+        timestamp = float(data.get('timestamp') or time.time())
+        if data['free_slots'] and city_rollup['open_since'] is None:
+            opened = datetime.datetime.fromtimestamp(timestamp)
+            city_rollup['openings'] += 1
+            city_rollup['by_hour'][opened.hour] += 1
+            city_rollup['by_weekday'][opened.weekday()] += 1
+            city_rollup['open_since'] = city_rollup['last_opened'] = timestamp
+            changed.append(city)
+        elif not data['free_slots'] and city_rollup['open_since'] is not None:
+            # observations may come slightly out of order, a negative duration is no duration
+            duration = max(0, timestamp - city_rollup['open_since'])
+            city_rollup['last_open_seconds'] = duration
+            city_rollup['total_open_seconds'] += duration
+            city_rollup['longest_open_seconds'] = max(city_rollup['longest_open_seconds'], duration)
+            city_rollup['last_closed'] = timestamp
+            city_rollup['open_since'] = None
+            changed.append(city)
+        rollups['updated'] = max(rollups['updated'] or 0, timestamp)
+    return changed
+
+
+def _plural(num, word):
+    return f'{num} {word}' if num == 1 else f'{num} {word}s'
+
+
+def _duration_to_str(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f'{seconds} s'
+    if seconds < 3600:
+        return f'{seconds // 60} min'
+    if seconds < 86400:
+        return f'{seconds // 3600} h {seconds % 3600 // 60} min'
+    return f'{seconds // 86400} d {seconds % 86400 // 3600} h'
+
+
+def stats_to_str(city_rollup, now=None):
+    """Human readable history of a city"""
+    now = now or time.time()
+    name = city_rollup['city_name']
+    if not city_rollup['openings']:
+        return f'{name}: registration has not opened yet'
+    msg = f'{name}: registration has opened {_plural(city_rollup["openings"], "time")}'
+    if city_rollup['open_since'] is not None:
+        msg += f', open right now for {_duration_to_str(now - city_rollup["open_since"])}'
+    else:
+        msg += f', last time {_duration_to_str(now - city_rollup["last_opened"])} ago'
+    closings = city_rollup['openings'] - (city_rollup['open_since'] is not None)
+    if closings:
+        msg += (f', stays open for {_duration_to_str(city_rollup["total_open_seconds"] / closings)} on average'
+                f' ({_duration_to_str(city_rollup["longest_open_seconds"])} at most)')
+    return msg
+
+
+def _top(counts, limit):
+    """Indices of up to limit largest non-zero counts"""
+    return [i for i in sorted(range(len(counts)), key=lambda i: -counts[i])[:limit] if counts[i]]
+
+
+def forecast_to_str(city_rollup, hours=3, weekdays=2):
+    """Human readable summary of when registration usually opens in a city"""
+    name = city_rollup['city_name']
+    if not city_rollup['openings']:
+        return f'{name}: no openings seen yet, nothing to base a forecast on'
+    top_weekdays = ', '.join(WEEKDAYS[i] for i in _top(city_rollup['by_weekday'], weekdays))
+    top_hours = ', '.join(f'{i:02d}:00-{(i + 1) % 24:02d}:00' for i in _top(city_rollup['by_hour'], hours))
+    return (f'{name}: slots usually appear on {top_weekdays} at {top_hours} '
+            f'(based on {_plural(city_rollup["openings"], "opening")})')
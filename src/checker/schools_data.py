@@ -0,0 +1,129 @@
+"""
+Exams registration data as published by the checker.
+
+Just the reading and comparing part of the checker with no html parsing, so that the bot can use it without
+loading any parsers.
+"""
+import json
+import os
+
+import utils
+from utils import snapshot
+from utils import targets
+
+
+BASEURL = 'https://cestina-pro-cizince.cz/trvaly-pobyt/a2/online-prihlaska/'
+OUTPUT_DIR = os.getenv('OUTPUT_DIR', 'output')
+LAST_FETCHED_JSON = os.path.join(OUTPUT_DIR, 'last_fetched.json')
+# readers of published json snapshots, one per file
+_SCHOOLS_SNAPSHOTS = {}
+
+
+def load_schools(text):
+    """Load exams registration data from json text, broken json means no data."""
+    try:
+        return json.loads(text)
+    except json.decoder.JSONDecodeError:
+        return {}
+
+
+def get_schools_from_file(filename=LAST_FETCHED_JSON, tag='li', cls='', cities_filter=None):
+    """
+    Read last saved html and load exams registration data. No fetching here, just give what was saved last.
+
+    The file is only re-read when a new snapshot has been published, so the returned data is shared between
+    callers and must not be modified in place.
+    """
+    if filename not in _SCHOOLS_SNAPSHOTS:
+        _SCHOOLS_SNAPSHOTS[filename] = snapshot.SnapshotReader(filename, loader=load_schools, default={})
+    res = _SCHOOLS_SNAPSHOTS[filename].get()
+    if not cities_filter:
+        return res
+    return {k:v for (k, v) in res.items() if k in cities_filter}
+
+
+class StateReader:
+    """
+    Reads published data of every target as one state (see utils.targets) with the interface of SnapshotReader.
+    The state is only rebuilt once a target has published new data.
+    """
+
+    def __init__(self, all_targets):
+        self.readers = [(target, snapshot.SnapshotReader(target.last_fetched_json, loader=load_schools, default={}))
+                        for target in all_targets]
+        self.data = None
+
+    def changed(self):
+        return self.data is None or any(reader.changed() for _, reader in self.readers)
+
+    def get(self):
+        if self.changed():
+            self.data = targets.merge([(target, reader.get()) for target, reader in self.readers])
+        return self.data
+
+
+def diff_to_str(new_data, old_data=None, cities=None, url_in_header=False):
+    """
+    Return a human readable state of exams registration in chosen cities (no cities chosen means all cities).
+    If previous state is passed then only changes to the state will be accounted for.
+
+    Cities parameter should be actual keys in schools data - no diacrytics
+    """
+    cities = [c for c in cities if c in new_data] if cities else new_data.keys()
+    msg = ''
+    for city in cities:
+        city_czech_name = new_data[city]['city_name']
+        date = utils.timestamp_to_str(new_data[city]['timestamp'])
+        exam_slots_msg = '' if not new_data[city]['total_slots'] else f' {new_data[city]["total_slots"]} slots'
+        # Assume by default there will be nothing to show
+        m = ''
+        if not old_data:
+            # Just show current state
+            m = (f'{city_czech_name} :(' if not new_data[city]['free_slots'] else
+                 f'{city_czech_name} :){exam_slots_msg}')
+        elif old_data:
+            if city not in old_data and new_data[city]['free_slots']:
+                # A new city has appeared overnight and there are free exam slots
+                m = f'{city_czech_name} :){exam_slots_msg}'
+            elif old_data[city]['free_slots'] != new_data[city]['free_slots']:
+                m = (f'{city_czech_name} :('
+                     if not new_data[city]['free_slots'] else
+                     f'{city_czech_name} :){exam_slots_msg}')
+        if m:
+            msg += f'{m}\n'
+    if msg:
+        # Add date from last city processed
+        msg = f'Update from {date}:\n{msg}'
+        # If requested - add url
+        if url_in_header:
+            msg = f'{BASEURL}\n{msg}'
+    return msg
+
+
+def has_changes(new_data, old_data, chosen_cities=None):
+    """
+    A (hopefully) useful method to quickly check if the state has changed.
+    """
+    chosen_cities = chosen_cities or []
+    cities = [c for c in chosen_cities if c in new_data.keys()] or new_data.keys()
+    # if new cities have appeared -> check if there are any free slots
+    new_cities_appeared = set(cities) - set(old_data.keys())
+    if any(new_data[c]['free_slots'] for c in new_cities_appeared):
+        return True
+    # Filter against new cities and check for changes the usual way
+    cities_to_check = set(cities) & set(old_data.keys())
+    return any(old_data[c]['free_slots'] != new_data[c]['free_slots'] for c in cities_to_check)
+
+
+def get_last_fetch_time_from_data(human_readable=False):
+    """
+    Return timestamp of the data from the latest json file or a human-readable date and time if requested.
+    """
+    new_data = get_schools_from_file()
+    # take timestamp from the first city for now
+    # XXX FIXME(ivasilev) One day there'll be a real date field
+    random_city_data = new_data[list(new_data.keys())[0]] if new_data.keys() else {}
+    ts = random_city_data.get('timestamp', '')
+    if not human_readable:
+        return ts
+    return utils.timestamp_to_str(ts)
@@ -0,0 +1,171 @@
+"""
+The fetcher, the checker and the bot in a single process.
+
+A small deployment doesn't need three containers handing files over through ./output and a bot looking at them
+every 20 seconds. Here everything runs in one asyncio process: a fetched page goes to the parser over an in-memory
+queue, parsed data is handed to the bot as is (utils.snapshot.MemorySnapshot) and the bot is told to look at it
+right away. No html or json is written or read on the way from a page load to the outbox. Parsed data and history
+are still written to the usual files, but after the bot has been told, so that a restart knows what subscribers
+have heard about and /stats, shard workers and reprocessing keep working.
+
+    python src/embedded/a2exams_embedded.py
+
+The separate fetcher, checker and bot with file based hand-over remain the way to scale out.
+"""
+import argparse
+import asyncio
+import copy
+import datetime
+import functools
+import json
+import logging
+import os
+import sys
+import time
+
+from bot import a2exams_bot
+from checker import a2exams_checker
+from checker import rollups
+from checker import schools_data
+from fetcher import a2exams_fetcher
+from fetcher import browser_worker
+from fetcher import hedge
+from utils import health
+from utils import snapshot
+from utils import targets
+from utils import tracing
+
+POLLING_INTERVAL = int(os.getenv('POLLING_INTERVAL', '25'))
+# pages waiting for the parser, the oldest one is dropped if the parser falls that far behind
+QUEUE_SIZE = 16
+SCHEDULE_TICK = 1
+
+# set up logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def _enqueue(queue, item):
+    """Put item into the queue dropping the oldest one if it is full"""
+    if queue.full():
+        queue.get_nowait()
+        logger.warning('Parser is falling behind, the oldest page has been dropped')
+    queue.put_nowait(item)
+
+
+async def fetch_pages(schedule, pages):
+    """Fetch pages of targets as scheduled and hand them over to the parser"""
+    while True:
+        health.heartbeat(POLLING_INTERVAL + 2 * browser_worker.FETCH_DEADLINE)
+        target, wait = schedule.next(time.monotonic())
+        if wait:
+            await asyncio.sleep(min(wait, SCHEDULE_TICK))
+            continue
+        schedule.started(target, time.monotonic())
+        html = await a2exams_fetcher.fetch(target.url, fetch_func=a2exams_fetcher.target_fetch_func(target),
+                                           attempts=1)
+        schedule.done(target, bool(html), time.monotonic())
+        if not html:
+            logger.warning('No new data of %s has been fetched! Will retry later', target.name)
+            continue
+        fetched_at = time.time()
+        a2exams_fetcher.LAST_SUCCESSES[target.name] = fetched_at
+        if target.main:
+            a2exams_fetcher.LAST_SUCCESS = fetched_at
+        _enqueue(pages, (target, html, fetched_at))
+
+
+def _persist(target, parsed, history=None, rollups_filename=rollups.ROLLUPS_JSON):
+    try:
+        snapshot.publish(target.last_fetched_json, json.dumps(parsed))
+        if history is not None:
+            rollups.save(history, rollups_filename)
+    except OSError as exc:
+        logger.error('Could not save data of %s: %s', target.name, exc)
+
+
+def _persisted(target, future):
+    """Done callback of _persist, nobody awaits it, so anything it has not handled itself is logged here"""
+    if not future.cancelled() and future.exception():
+        logger.error('Could not save data of %s', target.name, exc_info=future.exception())
+
+
+async def parse_pages(all_targets, pages, state, history, history_state, on_new_state,
+                      rollups_filename=rollups.ROLLUPS_JSON):
+    """Parse pages handed over by fetch_pages, publish data of all targets as one state and call on_new_state()"""
+    loop = asyncio.get_running_loop()
+    states = {target.name: schools_data.get_schools_from_file(target.last_fetched_json) for target in all_targets}
+    while True:
+        target, html, fetched_at = await pages.get()
+        # NOTE(ivasilev) parsing is CPU bound, a thread keeps it from holding up fetches
+        parsed = await loop.run_in_executor(None, functools.partial(
+            a2exams_checker._parse_schools, html, fetched_at, tag=target.profile['tag'], cls=target.profile['cls']))
+        if not parsed:
+            logger.warning('No cities have been found on the page of %s', target.name)
+            continue
+        states[target.name] = parsed
+        state.publish(targets.merge([(t, states[t.name]) for t in all_targets]))
+        on_new_state()
+        history_changed = target.main and rollups.update(history, parsed)
+        if history_changed:
+            # the bot reads history from another thread, it gets a copy that is not going to change
+            history_state.publish(copy.deepcopy(history))
+        persisting = loop.run_in_executor(None, _persist, target, parsed,
+                                          history_state.data if history_changed else None, rollups_filename)
+        persisting.add_done_callback(functools.partial(_persisted, target))
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--interval', help='Interval to poll a website with exams registration',
+                        default=POLLING_INTERVAL, type=int)
+    return parser.parse_args(args)
+
+
+async def _run(all_targets, state, history, history_state, on_new_state):
+    pages = asyncio.Queue(QUEUE_SIZE)
+    schedule = targets.Schedule(all_targets, default_backoff=a2exams_fetcher.DEFAULT_BACKOFF, now=time.monotonic())
+    await asyncio.gather(fetch_pages(schedule, pages),
+                         parse_pages(all_targets, pages, state, history, history_state, on_new_state))
+
+
+def main():
+    parsed_args = _parse_args(sys.argv[1:])
+    tracing.SERVICE_NAME = 'embedded'
+    all_targets = targets.load(interval=parsed_args.interval)
+    for target in all_targets:
+        os.makedirs(target.directory, exist_ok=True)
+    # data saved before a restart is what subscribers have last been told about
+    state = snapshot.MemorySnapshot(schools_data.StateReader(all_targets).get())
+    history = rollups.load_from_file()
+    history_state = snapshot.MemorySnapshot(copy.deepcopy(history))
+    a2exams_bot.SCHOOLS_SNAPSHOT = state.reader(default={})
+    a2exams_bot.SCHOOLS = state.reader(default={})
+    a2exams_bot.FRESHNESS_SNAPSHOT = state.reader(default={})
+    a2exams_bot.ROLLUPS_SNAPSHOT = history_state.reader(default=rollups.empty())
+    updater, senders = a2exams_bot.build()
+    inform_job = updater.job_queue.get_jobs_by_name('inform_about_change')[0]
+
+    def _inform_now():
+        # NOTE(ivasilev) the job is moved to now and not run on the side, so it never runs twice at once
+        inform_job.job.modify(next_run_time=datetime.datetime.now(datetime.timezone.utc))
+
+    if hedge.HEDGING:
+        a2exams_fetcher.HEDGER = hedge.Hedger(has_spare=a2exams_fetcher._has_spare_browser)
+    health.add_check('last_fetch', a2exams_fetcher._check_last_fetch)
+    health.add_check('browser', a2exams_fetcher._check_browser, endpoint=health.LIVENESS)
+    health.serve()
+    updater.start_polling()
+    try:
+        asyncio.run(_run(all_targets, state, history, history_state, _inform_now))
+    except KeyboardInterrupt:
+        sys.exit('Interrupted by user.')
+    finally:
+        updater.stop()
+        senders.set()
+        a2exams_fetcher._stop_browser_pool()
+
+
+if __name__ == "__main__":
+    main()
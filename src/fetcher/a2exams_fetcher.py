@@ -10,22 +10,29 @@ functionality has been moved into a separate module.
 """
 import argparse
 import asyncio
+import concurrent.futures
 import datetime
+import functools
+import json
 import logging
 import os
 import random
+import signal
 import sys
+import time
 import urllib
-import urllib3
-
-from pyvirtualdisplay import Display
-import requests
-from selenium import webdriver
-from selenium.common.exceptions import WebDriverException
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.wait import WebDriverWait
 
+from fetcher import archive
+from fetcher import browser_worker
+from fetcher import hedge
+from fetcher import spool
 import utils
+from utils import breaker
+from utils import health
+from utils import profiler
+from utils import snapshot
+from utils import targets
+from utils import tracing
 
 
 URL = os.getenv('URL', 'https://cestina-pro-cizince.cz/trvaly-pobyt/a2/online-prihlaska/')
@@ -38,15 +45,60 @@ TOKEN_POST = os.getenv('TOKEN_POST')
 PROXY = os.getenv('PROXY', 'no')
 OUTPUT_DIR = os.getenv('OUTPUT_DIR', 'output')
 LAST_FETCHED = os.path.join(OUTPUT_DIR, 'last_fetched.html')
-HEALTH = os.path.join(OUTPUT_DIR, 'healthy')
+# the fetcher is not ready if the last successful fetch is older than that
 HEALTH_THRESHOLD = int(os.getenv('HEALTH_THRESHOLD', '60'))
 PAGE_LOAD_LIMIT_SECONDS = 20
 # Initial time to wait if the fetch didn't get through
 DEFAULT_BACKOFF = int(os.getenv('DEFAULT_BACKOFF', '120'))
+# 'lean' skips heavy resources and reports readiness as soon as the towns list is rendered,
+# 'full' loads the page like a regular browser and polls for the towns list
+LOAD_PROFILE = os.getenv('LOAD_PROFILE', 'lean')
+BLOCKED_RESOURCES = [r for r in os.getenv('BLOCKED_RESOURCES', 'image,font,stylesheet').split(',') if r]
+# NOTE(ivasilev) Never block google.com/gstatic.com, recaptcha lives there
+BLOCKED_HOSTS = [h for h in os.getenv(
+    'BLOCKED_HOSTS', 'www.googletagmanager.com,www.google-analytics.com,connect.facebook.net').split(',') if h]
+PAGE_LOAD_STRATEGY = os.getenv('PAGE_LOAD_STRATEGY', 'eager')
+TIMINGS_FILE = os.path.join(OUTPUT_DIR, 'page_load_timings.jsonl')
+RECAPTCHA_SELECTOR = "iframe[name^='a-'][src^='https://www.google.com/recaptcha/api2/anchor?']"
+_RESOURCE_PREFERENCES = {
+    'image': {'permissions.default.image': 2},
+    'font': {'gfx.downloadable_fonts.enabled': False, 'browser.display.use_document_fonts': 0},
+    'stylesheet': {'permissions.default.stylesheet': 2},
+}
+# Resolves with 'ready' or 'captcha' as soon as the element or the recaptcha iframe appears in DOM
+_READINESS_SCRIPT = """
+var elementId = arguments[0], captchaSelector = arguments[1], done = arguments[arguments.length - 1];
+function state() {
+    if (document.getElementById(elementId)) return 'ready';
+    if (document.querySelector(captchaSelector)) return 'captcha';
+    return null;
+}
+if (state()) { done(state()); return; }
+var observer = new MutationObserver(function() {
+    var current = state();
+    if (current) { observer.disconnect(); done(current); }
+});
+observer.observe(document.documentElement, {childList: true, subtree: true});
+"""
 
-# globals to reuse for browser page displaying
+# globals to reuse for browser page displaying, these live in the browser worker process
 DISPLAY = None
 BROWSER = None
+# supervisor of the browser worker processes shared by all targets
+BROWSER_POOL = None
+# every fetched page goes here, off the event loop and one page at a time
+ARCHIVE = None
+ARCHIVER = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='archiver')
+# pushes to the registry, pushes made while it is unreachable go to the spool
+PUSH_BREAKER = breaker.CircuitBreaker('Registry push')
+SPOOL = None
+# hedges slow page loads with a spare browser, set up by main() unless HEDGING=no
+HEDGER = None
+# time of the last successful fetch of the main target and of every target, kept in memory for health checks
+LAST_SUCCESS = None
+LAST_SUCCESSES = {}
+# the main loop looks at the schedule at least that often
+SCHEDULE_TICK = 1
 
 # set up logging
 logging.basicConfig()
@@ -70,6 +122,9 @@ def _get_browser(force=False):
     global BROWSER
     if not force and BROWSER:
         return BROWSER
+    # NOTE(ivasilev) Browser related modules are only needed in the browser worker process
+    from pyvirtualdisplay import Display
+    from selenium import webdriver
     DISPLAY = Display(visible=0, size=(1420, 1080))
     DISPLAY.start()
     logger.info('Initialized virtual display')
@@ -82,13 +137,13 @@ def _get_browser(force=False):
     options.set_preference('general.useragent.override', useragent)
     options.set_preference('dom.webdriver.enabled', False)
     options.set_preference('useAutomationExtension', False)
-    if PROXY not in ('0', 'None', 'no'):
-        logger.info('Setting up browser proxy %s', PROXY)
-        ip, port = PROXY.rsplit(':', 1)
-        options.set_preference('network.proxy.type', 1)
-        options.set_preference('network.proxy.socks', ip)
-        options.set_preference('network.proxy.socks_port', int(port))
-        options.set_preference('network.proxy.socks_remote_dns', True)
+    proxy = PROXY if PROXY not in ('0', 'None', 'no') else None
+    if proxy:
+        logger.info('Setting up browser proxy %s', proxy)
+    for name, value in _load_profile_preferences(LOAD_PROFILE, BLOCKED_RESOURCES, BLOCKED_HOSTS, proxy).items():
+        options.set_preference(name, value)
+    if LOAD_PROFILE == 'lean':
+        options.set_capability('pageLoadStrategy', PAGE_LOAD_STRATEGY)
     BROWSER = webdriver.Firefox(options=options)
     BROWSER.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
     # emulate some user actions tbd
@@ -96,19 +151,87 @@ def _get_browser(force=False):
     return BROWSER
 
 
-async def _do_fetch_with_browser(url, wait_for_javascript=PAGE_LOAD_LIMIT_SECONDS, wait_for_id='select-town'):
+def _load_profile_preferences(profile, blocked_resources, blocked_hosts, proxy=None):
+    """Firefox preferences for the page load profile and proxy settings"""
+    preferences = {}
+    if profile == 'lean':
+        for resource in blocked_resources:
+            preferences.update(_RESOURCE_PREFERENCES.get(resource, {}))
+    if profile == 'lean' and blocked_hosts:
+        # NOTE(ivasilev) Firefox has no setting to block hosts, but a proxy autoconfig script can route them
+        # to a closed port, everything else goes directly or through the socks proxy
+        route = f'SOCKS5 {proxy}' if proxy else 'DIRECT'
+        pac = ('function FindProxyForURL(url, host) {'
+               f' var blocked = {json.dumps(blocked_hosts)};'
+               ' for (var i = 0; i < blocked.length; i++) {'
+               '  if (dnsDomainIs(host, blocked[i])) return "PROXY 127.0.0.1:9";'
+               ' }'
+               f' return "{route}";'
+               '}')
+        preferences['network.proxy.type'] = 2
+        preferences['network.proxy.autoconfig_url'] = f'data:text/javascript,{urllib.parse.quote(pac)}'
+        preferences['network.proxy.socks_remote_dns'] = True
+    elif proxy:
+        ip, port = proxy.rsplit(':', 1)
+        preferences.update({'network.proxy.type': 1,
+                            'network.proxy.socks': ip,
+                            'network.proxy.socks_port': int(port),
+                            'network.proxy.socks_remote_dns': True})
+    return preferences
+
+
+def _has_recaptcha(browser):
+    from selenium.webdriver.common.by import By
+    captcha = browser.find_elements(By.CSS_SELECTOR, RECAPTCHA_SELECTOR)
+    return bool(captcha)
+
+
+def _wait_until_ready(browser, wait_for_javascript, wait_for_id):
+    """Wait for the element or recaptcha to appear and return 'ready' or 'captcha' respectively"""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.wait import WebDriverWait
+    if LOAD_PROFILE == 'lean':
+        browser.set_script_timeout(wait_for_javascript)
+        return browser.execute_async_script(_READINESS_SCRIPT, wait_for_id, RECAPTCHA_SELECTOR)
+    WebDriverWait(browser, wait_for_javascript).until(
+            lambda x: _has_recaptcha(x) or x.find_element(By.ID, wait_for_id))
+    return 'captcha' if _has_recaptcha(browser) else 'ready'
+
+
+def _record_timings(url, timings, filename=TIMINGS_FILE):
+    """Append page load timings to a jsonl file to compare load profiles"""
+    record = {'timestamp': time.time(), 'profile': LOAD_PROFILE, 'url': url}
+    record.update(timings)
+    logger.debug('Page load timings: %s', record)
+    try:
+        with open(filename, 'a') as f:
+            f.write(f'{json.dumps(record)}\n')
+    except OSError as err:
+        logger.warning('Could not record page load timings: %s', err)
 
-    def _has_recaptcha(browser):
-        captcha = browser.find_elements(By.CSS_SELECTOR,
-                                        "iframe[name^='a-'][src^='https://www.google.com/recaptcha/api2/anchor?']")
-        return bool(captcha)
+
+async def _do_fetch_with_browser(url, wait_for_javascript=PAGE_LOAD_LIMIT_SECONDS, wait_for_id='select-town'):
+    from selenium.common.exceptions import WebDriverException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.wait import WebDriverWait
+    import urllib3
 
     browser = _get_browser()
     try:
+        started = time.monotonic()
         browser.get(url)
-        WebDriverWait(browser, wait_for_javascript).until(
-                lambda x: _has_recaptcha(x) or x.find_element(By.ID, wait_for_id))
-        if _has_recaptcha(browser):
+        loaded = time.monotonic()
+        state = _wait_until_ready(browser, wait_for_javascript, wait_for_id)
+        ready = time.monotonic()
+        navigation = browser.execute_script(
+            "var n = performance.getEntriesByType('navigation')[0];"
+            "return n ? [n.domContentLoadedEventEnd, n.loadEventEnd] : [0, 0];")
+        _record_timings(url, {'get_ms': round((loaded - started) * 1000),
+                              'ready_ms': round((ready - started) * 1000),
+                              'dom_content_loaded_ms': round(navigation[0]),
+                              'load_ms': round(navigation[1]),
+                              'captcha': state == 'captcha'})
+        if state == 'captcha':
             # if recaptcha has been discovered -> give ample time to solve it, let's say 3x the maximum
             logger.warning('Recaptcha has been hit, solve it please to continue')
             # 120 magic constant means 2 mins recaptcha form is valid
@@ -122,32 +245,86 @@ async def _do_fetch_with_browser(url, wait_for_javascript=PAGE_LOAD_LIMIT_SECOND
     return page_source
 
 
-async def fetch(url, filename=None, retry_interval=POLLING_INTERVAL, fetch_func=_do_fetch_with_browser, attempts=3):
+def _fetch_in_worker(url, wait_for_id='select-town'):
+    """Runs in the browser worker process"""
+    return asyncio.run(_do_fetch_with_browser(url, wait_for_id=wait_for_id))
+
+
+def _get_browser_pool():
+    global BROWSER_POOL
+    if not BROWSER_POOL:
+        BROWSER_POOL = browser_worker.BrowserPool(_fetch_in_worker, closer=_close_browser)
+    return BROWSER_POOL
+
+
+def _stop_browser_pool():
+    global BROWSER_POOL
+    if BROWSER_POOL:
+        BROWSER_POOL.stop()
+        BROWSER_POOL = None
+
+
+async def _do_fetch_with_worker(url, wait_for_id='select-town', cancel=None):
+    """
+    Fetch url with a browser of the pool in a worker process without blocking the event loop, setting the cancel
+    event stops the fetch.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(_get_browser_pool().fetch, url, cancel=cancel,
+                                                              wait_for_id=wait_for_id))
+
+
+def _has_spare_browser():
+    return BROWSER_POOL is None or BROWSER_POOL.idle() > 0
+
+
+async def fetch(url, filename=None, retry_interval=POLLING_INTERVAL, fetch_func=_do_fetch_with_worker, attempts=3):
     """
     Fetches recent version of registration website. If request fails for some reason will retry N times.
-    Return html and saves it in a file if filename parameter is passed.
+    Return html and saves it in a file if filename parameter is passed, the saved html carries the id of the
+    trace started by the fetch.
     """
-    res = await fetch_func(url=url)
-    attempts_left = attempts
-    while attempts_left and not res:
-        attempts_left -= 1
-        retry_in = int(retry_interval / 3 + random.randint(1, int(2 * retry_interval / 3)))
-        print(f"Looks like connection error, will try {url} again later in {retry_in}")
-        await asyncio.sleep(retry_in)
+    with tracing.span('fetcher.fetch', url=url) as trace:
         res = await fetch_func(url=url)
+        attempts_left = attempts
+        while attempts_left and not res:
+            attempts_left -= 1
+            retry_in = int(retry_interval / 3 + random.randint(1, max(1, int(2 * retry_interval / 3))))
+            print(f"Looks like connection error, will try {url} again later in {retry_in}")
+            await asyncio.sleep(retry_in)
+            res = await fetch_func(url=url)
     # record new data if there is any
     if filename and res:
-        with open(filename, 'w') as f:
-            f.write(res)
+        page = res
+        with tracing.span('fetcher.publish', trace):
+            res = tracing.inject(res, trace, time.time_ns())
+            snapshot.publish(filename, res)
+        # NOTE(ivasilev) the page is archived as fetched, a trace comment would make every page unique. Compression
+        # takes tens of milliseconds (more when the dictionary is retrained), so it is done after publishing and in
+        # a thread of its own not to delay detection
+        if archive.ARCHIVE_MAX_MB:
+            asyncio.get_running_loop().run_in_executor(ARCHIVER, _archive_page, page, time.time())
     return res
 
 
-def get_last_fetch_time(human_readable=False):
+def _archive_page(html, timestamp=None):
+    global ARCHIVE
+    if not archive.ARCHIVE_MAX_MB:
+        return
+    try:
+        if ARCHIVE is None:
+            ARCHIVE = archive.SnapshotArchive()
+        ARCHIVE.put(html, timestamp)
+    except OSError as exc:
+        logger.error('Could not archive the page: %s', exc)
+
+
+def get_last_fetch_time(human_readable=False, filename=LAST_FETCHED):
     """
-    Return timestamp of the last modification to the last_fetched.html file or
-    a human-readable date and time if requested.
+    Return timestamp of the last modification to the last_fetched.html file (of the main target unless other
+    filename is given) or a human-readable date and time if requested.
     """
-    last_fetched = os.path.getmtime(LAST_FETCHED)
+    last_fetched = os.path.getmtime(filename)
     if not human_readable:
         return last_fetched
     return utils.timestamp_to_str(last_fetched)
@@ -162,14 +339,78 @@ def get_time_since_last_fetched():
     return current - last_fetch_time
 
 
-def post(html, url=URL_POST, token=TOKEN_POST, substitute_baseurl=True, old_url=URL):
+def _push(url, payload, params=None, headers=None):
+    """POST payload to the registry, returns the response"""
+    import requests
+    proxies = {} if PROXY in ('0', 'None', 'no') else {'https': f'socks5h://{PROXY}'}
+    if proxies:
+        logger.info("Using proxy %s for request", PROXY)
+    all_headers = {'Cache-Control': 'no-cache',
+                   'Pragma': 'no-cache',
+                   'User-agent': utils.get_useragent(),
+                   'Content-Type': 'application/octet-stream'}
+    all_headers.update(headers or {})
+    return requests.post(url, data=payload, params=params, proxies=proxies, headers=all_headers)
+
+
+def _rejected(status_code):
+    """Whether the registry has refused a push for good, timeouts and throttling pass on retry"""
+    return 400 <= status_code < 500 and status_code not in (408, 429)
+
+
+def _get_spool():
+    global SPOOL
+    if SPOOL is None:
+        SPOOL = spool.Spool()
+    return SPOOL
+
+
+def _spool_push(data, url):
+    try:
+        # NOTE(ivasilev) the token is not written to disk, replay uses the current one
+        entry = {key: value for key, value in data.items() if key != 'token'}
+        # pages of targets go to endpoints of their own, the url tells where to replay the push to
+        entry['url'] = url
+        _get_spool().put(entry)
+    except OSError as exc:
+        logger.error('Could not spool the push, it is lost: %s', exc)
+
+
+def _replay_spool(url, token):
+    """
+    Send pushes spooled for url to the registry in one compressed batch in the order they have been made, returns
+    False if they are still in the spool. Pushes the registry refuses for good are dropped, they'd never pass.
+    """
+    entries = [(filename, entry) for filename, entry in _get_spool().load() if entry.pop('url', url) == url]
+    if not entries:
+        return True
+    try:
+        resp = _push(url, spool.batch([entry for _, entry in entries]), params={'token': token, 'batch': len(entries)},
+                     headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+    except Exception as exc:
+        logger.error('Some unexpected exception during replay of spooled pushes has occured %s..', exc)
+        return False
+    if not resp.ok and not _rejected(resp.status_code):
+        logger.error('Replay of %s spooled pushes was unsuccessful, will retry after the next push', len(entries))
+        return False
+    _get_spool().remove(filename for filename, _ in entries)
+    if resp.ok:
+        logger.info('%s spooled pushes have been replayed', len(entries))
+    else:
+        logger.error('Registry has rejected %s spooled pushes (%s), they are dropped', len(entries), resp.status_code)
+    return True
+
+
+def post(html, url=URL_POST, token=TOKEN_POST, substitute_baseurl=True, old_url=URL, target=None):
+    """
+    Push html of the target (the main one by default) to the registry endpoint url.
+    While the registry is unreachable pushes are spooled and not sent, they are replayed once it is back. Replay goes
+    after the fresh page and doesn't hold it up, a failed replay is retried after the next push.
+    """
     if not url or not token:
         logger.warn("Both url and token have to be set, no data will be pushed!")
         return
     try:
-        proxies = {} if PROXY in ('0', 'None', 'no') else {'https': f'socks5h://{PROXY}'}
-        if proxies:
-            logger.info("Using proxy %s for request", PROXY)
         if substitute_baseurl:
             # change URL's baseurl to URL_POST
             original_baseurl = urllib.parse.urlparse(old_url).hostname
@@ -178,19 +419,31 @@ def post(html, url=URL_POST, token=TOKEN_POST, substitute_baseurl=True, old_url=
         data = {'token': token,
                 # XXX FIXME If date can be extracted from html this would be much better than setting
                 # it explicitly
-                'date': get_last_fetch_time(human_readable=False),
+                'date': get_last_fetch_time(human_readable=False) if not target or target.main else
+                        get_last_fetch_time(human_readable=False, filename=target.last_fetched),
                 'html': html}
-        resp = requests.post(url, data=data, proxies=proxies,
-                             headers={'Cache-Control': 'no-cache',
-                                      'Pragma': 'no-cache',
-                                      'User-agent': utils.get_useragent(),
-                                      'Content-Type': 'application/octet-stream'})
-        if not resp.ok:
-            logger.error('Push was unsuccessful')
-        return html
     except Exception as exc:
         logger.error('Some unexpected exception during push has occured %s..', exc)
         return
+    if not PUSH_BREAKER.allow():
+        logger.warning('Registry is unreachable, spooling the push, next attempt in %s seconds',
+                       PUSH_BREAKER.retry_in())
+        _spool_push(data, url)
+        return
+    try:
+        ok = _push(url, data).ok
+    except Exception as exc:
+        logger.error('Some unexpected exception during push has occured %s..', exc)
+        ok = False
+    if not ok:
+        logger.error('Push was unsuccessful')
+        PUSH_BREAKER.failure()
+        _spool_push(data, url)
+        return
+    PUSH_BREAKER.success()
+    # NOTE(ivasilev) replay is best effort, it is not what tells whether the registry is up
+    _replay_spool(url, token)
+    return html
 
 
 def _parse_args(args):
@@ -200,67 +453,131 @@ def _parse_args(args):
     return parser.parse_args(args)
 
 
-def _remove_health_file(a_file):
-    if os.path.isfile(a_file):
-        os.unlink(a_file)
-    else:
-        logger.debug('No such file %s', a_file)
+def _check_last_fetch():
+    if LAST_SUCCESS is None:
+        return False, 'nothing has been fetched yet'
+    age = time.time() - LAST_SUCCESS
+    return age < HEALTH_THRESHOLD, f'last successful fetch {int(age)} s ago'
 
 
-def _create_health_file(a_file):
-    if not os.path.isfile(HEALTH):
-        with open(HEALTH, 'w') as f:
-            f.write('alive')
-    else:
-        logger.debug('File %s already exists', a_file)
+def _check_target(target):
+    """Readiness check of a target other than the main one, it may be polled less often than the main one"""
+    threshold = max(HEALTH_THRESHOLD, 2 * target.interval)
+
+    def _check():
+        if target.name not in LAST_SUCCESSES:
+            return False, 'nothing has been fetched yet'
+        age = time.time() - LAST_SUCCESSES[target.name]
+        return age < threshold, f'last successful fetch {int(age)} s ago'
+    return _check
+
+
+def _check_browser():
+    # NOTE(ivasilev) a dead worker is replaced on the next fetch, so this is informational only
+    if not BROWSER_POOL:
+        return True, 'not started'
+    return True, [{'alive': worker.is_alive(), 'busy': worker.busy, 'pages': worker.pages,
+                   'restarts': worker.restarts} for worker in BROWSER_POOL.workers]
+
+
+def _profile_on_signal(signum, frame):
+    if not profiler.start(profiler.PROFILE_SECONDS, 'fetcher'):
+        logger.warning('A profile is being taken already')
+
 
+def target_fetch_func(target, fetch_func=_do_fetch_with_worker):
+    """fetch_func set up for the page of the target, hedged if hedging is on"""
+    fetch_func = functools.partial(fetch_func, wait_for_id=target.profile['wait_for_id'])
+    if HEDGER:
+        fetch_func = functools.partial(HEDGER.fetch, fetch_func)
+    return fetch_func
 
-async def run_once(retry_interval=POLLING_INTERVAL, fetch_func=_do_fetch_with_browser, attempts=1):
+
+async def run_once(retry_interval=POLLING_INTERVAL, fetch_func=_do_fetch_with_worker, attempts=1, target=None):
     """
+    Fetch the page of the target (the main one by default).
     Returns new_data if some has been fetched successfully or None if fetch failed after K attepmts.
     """
-    new_data = await fetch(url=URL, retry_interval=retry_interval, filename=LAST_FETCHED, fetch_func=fetch_func,
-                           attempts=attempts)
+    global LAST_SUCCESS
+    target = target or targets.Target('a2', URL, main=True)
+    new_data = await fetch(url=target.url, retry_interval=retry_interval, filename=target.last_fetched,
+                           fetch_func=target_fetch_func(target, fetch_func), attempts=attempts)
     if new_data:
+        LAST_SUCCESSES[target.name] = time.time()
+        if target.main:
+            LAST_SUCCESS = LAST_SUCCESSES[target.name]
         # push new data to the centralized portal
-        logger.info('[%s] New data has been successfully fetched', get_last_fetch_time(human_readable=True))
-        res = post(new_data, url=URL_POST, token=TOKEN_POST)
+        logger.info('[%s] New data of %s has been successfully fetched',
+                    utils.timestamp_to_str(LAST_SUCCESSES[target.name]), target.name)
+        url = target.registry_url('url_post', URL_POST)
+        if not url and not target.main:
+            # NOTE(ivasilev) the main endpoint would take the page for the A2 one, the checker reads it locally then
+            logger.debug('No registry endpoint for %s, the page is not pushed', target.name)
+            return new_data
+        with tracing.span('fetcher.post', tracing.extract(new_data)[0], target=target.name):
+            res = post(new_data, url=url, token=TOKEN_POST, old_url=target.url, target=target)
         if not res:
             logger.warning('No data has been pushed!')
         return new_data
-    logger.warning('No new data has been fetched! Will retry later')
-    # update health check file
-    if get_time_since_last_fetched() < HEALTH_THRESHOLD:
-        logger.debug('State: healthy')
-        _create_health_file(HEALTH)
-    else:
-        logger.warning('State: unhealthy, last fetch was > %s seconds ago', HEALTH_THRESHOLD)
-        _remove_health_file(HEALTH)
+    logger.warning('No new data of %s has been fetched! Will retry later', target.name)
+
+
+async def _run_target(target, schedule, slots):
+    try:
+        fetch_result = await run_once(target=target)
+    except Exception as exc:
+        logger.error('Unexpected error during fetch of %s: %s', target.name, exc)
+        fetch_result = None
+    finally:
+        slots.release()
+    # a failed fetch backs the target off, the successful one resets its backoff
+    schedule.done(target, bool(fetch_result), time.monotonic())
+    health.report(backoff={name: backoff for name, backoff in schedule.backoff.items() if backoff})
+    if HEDGER:
+        health.report(hedging=HEDGER.format_stats())
+    health.report(registry=PUSH_BREAKER.format_state(), spooled=len(SPOOL) if SPOOL else 0)
 
 
 async def main():
-    """ The infinite loop of fetch -> push -> wait -> fetch -> push ... """
-    backoff = 0
+    """ The infinite loop of fetch -> push -> wait -> fetch -> push ... for every target """
+    global HEDGER
+    global LAST_SUCCESS
     parsed_args = _parse_args(sys.argv[1:])
-    # clear healthcheck state if it's present from previous runs
-    _remove_health_file(HEALTH)
+    tracing.SERVICE_NAME = 'fetcher'
+    # kill -USR2 <pid> profiles the fetcher for PROFILE_SECONDS, see output/profiles
+    signal.signal(signal.SIGUSR2, _profile_on_signal)
+    all_targets = targets.load(interval=parsed_args.interval)
+    for target in all_targets:
+        os.makedirs(target.directory, exist_ok=True)
+        if os.path.isfile(target.last_fetched):
+            LAST_SUCCESSES[target.name] = get_last_fetch_time(filename=target.last_fetched)
+        if not target.main:
+            health.add_check(f'last_fetch_{target.name}', _check_target(target))
+    LAST_SUCCESS = LAST_SUCCESSES.get(all_targets[0].name)
+    health.add_check('last_fetch', _check_last_fetch)
+    health.add_check('browser', _check_browser, endpoint=health.LIVENESS)
+    health.serve()
+    if hedge.HEDGING:
+        # NOTE(ivasilev) with a single browser there is nothing to hedge with, BROWSER_POOL_SIZE=2 enables hedging
+        HEDGER = hedge.Hedger(has_spare=_has_spare_browser)
+    schedule = targets.Schedule(all_targets, default_backoff=DEFAULT_BACKOFF, now=time.monotonic())
+    # as many targets are fetched at once as there are browsers
+    slots = asyncio.Semaphore(browser_worker.POOL_SIZE)
     try:
         while True:
-            if backoff:
-                logger.warning(f'Waiting {backoff} seconds before next attempt')
-                await asyncio.sleep(backoff)
-            fetch_result = await run_once()
-            if fetch_result:
-                # fetch is successfull, fetcher is operational again and backoff can be reset
-                backoff = 0
-            else:
-                # increase backoff and to wait till retry next time
-                backoff = backoff * 2 + DEFAULT_BACKOFF
-            # Wait a bit before the next check
-            await asyncio.sleep(parsed_args.interval)
+            # a fetch runs on its own, but the loop must not be blocked for longer than a fetch with a retry
+            health.heartbeat(POLLING_INTERVAL + 2 * browser_worker.FETCH_DEADLINE)
+            target, wait = schedule.next(time.monotonic())
+            if wait or slots.locked():
+                await asyncio.sleep(SCHEDULE_TICK if slots.locked() else min(wait, SCHEDULE_TICK))
+                continue
+            await slots.acquire()
+            schedule.started(target, time.monotonic())
+            asyncio.ensure_future(_run_target(target, schedule, slots))
     except KeyboardInterrupt:
         sys.exit('Interrupted by user.')
-        _close_browser()
+    finally:
+        _stop_browser_pool()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,253 @@
+"""
+Content-addressed archive of every fetched page.
+
+Pages are stored once per content (most fetches return exactly the same page) under their sha256, every page
+is a separate zstd frame so any of them can be read without touching the others. Pages are alike, so they
+are compressed with a dictionary trained on the pages themselves, retrained every now and then as the site
+changes. An index of fixed-size (fetch time, digest) records is appended on every fetch and binary searched
+to find what the page looked like at any moment. Once the archive has grown past its limit the oldest
+fetches are evicted together with pages nobody refers to anymore and dictionaries no page is compressed with.
+
+Run `python src/fetcher/archive.py --at '2023-06-06 09:00' > page.html` to get the page as of that moment.
+"""
+import argparse
+import datetime
+import hashlib
+import logging
+import os
+import struct
+import sys
+import time
+
+import zstandard
+
+OUTPUT_DIR = os.getenv('OUTPUT_DIR', 'output')
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', os.path.join(OUTPUT_DIR, 'archive'))
+# 0 disables archiving
+ARCHIVE_MAX_MB = int(os.getenv('ARCHIVE_MAX_MB', '500'))
+COMPRESSION_LEVEL = 19
+DICT_SIZE = 64 * 1024
+# a dictionary is (re)trained after that many new distinct pages
+DICT_TRAINING_SAMPLES = 32
+# the trainer can't take pages as a whole, they are cut into chunks
+TRAINING_CHUNK = 16 * 1024
+# eviction frees some room at once instead of running on every put
+EVICT_TO = 0.9
+INDEX_FILE = 'index.bin'
+_RECORD = struct.Struct('<d32s')
+
+# set up logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class SnapshotArchive:
+
+    def __init__(self, directory=ARCHIVE_DIR, max_bytes=ARCHIVE_MAX_MB * 2 ** 20, level=COMPRESSION_LEVEL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.level = level
+        self._objects_dir = os.path.join(directory, 'objects')
+        self._dicts_dir = os.path.join(directory, 'dicts')
+        self._index = os.path.join(directory, INDEX_FILE)
+        os.makedirs(self._objects_dir, exist_ok=True)
+        os.makedirs(self._dicts_dir, exist_ok=True)
+        self._dicts = {}
+        self._dict = self._latest_dict()
+        self._compressor = None
+        # distinct pages stored since the dictionary has been trained, the samples for the next one
+        self._samples = []
+        self.size = sum(entry.stat().st_size for root in os.scandir(self._objects_dir) if root.is_dir()
+                        for entry in os.scandir(root.path))
+        self.size += sum(os.path.getsize(self._dict_path(dict_id)) for dict_id in self._dict_ids())
+
+    def __len__(self):
+        return os.path.getsize(self._index) // _RECORD.size if os.path.isfile(self._index) else 0
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects_dir, digest[:2], digest)
+
+    def _dict_path(self, dict_id):
+        return os.path.join(self._dicts_dir, f'{dict_id}.zdict')
+
+    def _dict_ids(self):
+        return sorted(int(name.split('.')[0]) for name in os.listdir(self._dicts_dir) if name.endswith('.zdict'))
+
+    def _latest_dict(self):
+        dict_ids = self._dict_ids()
+        return self._load_dict(dict_ids[-1]) if dict_ids else None
+
+    def _load_dict(self, dict_id):
+        if dict_id not in self._dicts:
+            with open(self._dict_path(dict_id), 'rb') as f:
+                self._dicts[dict_id] = zstandard.ZstdCompressionDict(f.read())
+        return self._dicts[dict_id]
+
+    def _train_dict(self):
+        chunks = [page[i:i + TRAINING_CHUNK] for page in self._samples for i in range(0, len(page), TRAINING_CHUNK)]
+        try:
+            new_dict = zstandard.train_dictionary(DICT_SIZE, chunks)
+        except zstandard.ZstdError as exc:
+            logger.warning('Could not train a compression dictionary: %s', exc)
+            return
+        dict_id = new_dict.dict_id()
+        # the id is derived from the content, the pages may not have changed enough to train a different one
+        if not os.path.isfile(self._dict_path(dict_id)):
+            with open(self._dict_path(dict_id), 'wb') as f:
+                f.write(new_dict.as_bytes())
+            self.size += len(new_dict.as_bytes())
+        self._dicts[dict_id] = new_dict
+        self._dict = new_dict
+        self._compressor = None
+        logger.info('Trained compression dictionary %s on %s pages', dict_id, len(self._samples))
+
+    def _compress(self, data):
+        if not self._compressor:
+            self._compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self._dict)
+        return self._compressor.compress(data)
+
+    def put(self, page, timestamp=None):
+        """Archive a page fetched at timestamp (now by default), returns its digest"""
+        data = page.encode('utf-8') if isinstance(page, str) else page
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.isfile(path):
+            compressed = self._compress(data)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(compressed)
+            os.replace(tmp, path)
+            self.size += len(compressed)
+            self._samples.append(data)
+            if len(self._samples) >= DICT_TRAINING_SAMPLES:
+                self._train_dict()
+                self._samples = []
+        with open(self._index, 'ab') as f:
+            f.write(_RECORD.pack(timestamp or time.time(), bytes.fromhex(digest)))
+        if self.max_bytes and self.size > self.max_bytes:
+            self.evict(int(self.max_bytes * EVICT_TO))
+        return digest
+
+    def get(self, digest):
+        """Return the page with the digest"""
+        with open(self._object_path(digest), 'rb') as f:
+            compressed = f.read()
+        dict_id = zstandard.get_frame_parameters(compressed).dict_id
+        decompressor = zstandard.ZstdDecompressor(dict_data=self._load_dict(dict_id) if dict_id else None)
+        return decompressor.decompress(compressed).decode('utf-8')
+
+    def _record(self, f, i):
+        f.seek(i * _RECORD.size)
+        timestamp, digest = _RECORD.unpack(f.read(_RECORD.size))
+        return timestamp, digest.hex()
+
+    def at(self, timestamp):
+        """Return (fetch time, digest) of the last page fetched at or before timestamp or None"""
+        total = len(self)
+        if not total:
+            return None
+        with open(self._index, 'rb') as f:
+            lo, hi = 0, total
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._record(f, mid)[0] <= timestamp:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return self._record(f, lo - 1) if lo else None
+
+    def get_at(self, timestamp):
+        """Return the page as it was at timestamp or None if the archive doesn't go that far back"""
+        found = self.at(timestamp)
+        return self.get(found[1]) if found else None
+
+    def entries(self):
+        """Yield (fetch time, digest) of all fetches in fetch order"""
+        if not os.path.isfile(self._index):
+            return
+        with open(self._index, 'rb') as f:
+            while True:
+                record = f.read(_RECORD.size)
+                if len(record) < _RECORD.size:
+                    break
+                timestamp, digest = _RECORD.unpack(record)
+                yield timestamp, digest.hex()
+
+    def evict(self, target_bytes):
+        """Drop the oldest fetches until pages nobody refers to anymore free enough room"""
+        entries = list(self.entries())
+        sizes = {}
+        for _, digest in entries:
+            if digest not in sizes and os.path.isfile(self._object_path(digest)):
+                sizes[digest] = os.path.getsize(self._object_path(digest))
+        last_use = {digest: i for i, (_, digest) in enumerate(entries)}
+        # a page can go once the last fetch referring to it has been dropped
+        keep_from = 0
+        size = self.size
+        for i, (_, digest) in enumerate(entries):
+            if size <= target_bytes:
+                break
+            keep_from = i + 1
+            if last_use[digest] == i:
+                size -= sizes.get(digest, 0)
+        tmp = f'{self._index}.tmp'
+        with open(tmp, 'wb') as f:
+            for timestamp, digest in entries[keep_from:]:
+                f.write(_RECORD.pack(timestamp, bytes.fromhex(digest)))
+        os.replace(tmp, self._index)
+        kept = {digest for _, digest in entries[keep_from:]}
+        for digest in {digest for _, digest in entries[:keep_from]} - kept:
+            os.unlink(self._object_path(digest))
+            self.size -= sizes.get(digest, 0)
+        self._evict_dicts(kept)
+        logger.info('Evicted %s oldest fetches, the archive takes %.1f MB now', keep_from, self.size / 2 ** 20)
+
+    def _evict_dicts(self, digests):
+        """Delete dictionaries none of the pages with the digests is compressed with, except the current one"""
+        used = {self._dict.dict_id()} if self._dict else set()
+        for digest in digests:
+            with open(self._object_path(digest), 'rb') as f:
+                # the dictionary id is in the frame header, at most 18 bytes long
+                used.add(zstandard.get_frame_parameters(f.read(18)).dict_id)
+        for dict_id in set(self._dict_ids()) - used:
+            self.size -= os.path.getsize(self._dict_path(dict_id))
+            os.unlink(self._dict_path(dict_id))
+            self._dicts.pop(dict_id, None)
+            logger.info('Deleted compression dictionary %s, no page uses it anymore', dict_id)
+
+
+
+def _parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def _parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', help='Archive directory', default=ARCHIVE_DIR)
+    parser.add_argument('--at', help='Print the page as of this time (timestamp or iso date)')
+    parser.add_argument('--list', help='List fetches', action='store_true')
+    return parser.parse_args(args)
+
+
+def main():
+    parsed_args = _parse_args()
+    archive = SnapshotArchive(parsed_args.dir, max_bytes=0)
+    if parsed_args.at:
+        page = archive.get_at(_parse_time(parsed_args.at))
+        if page is None:
+            sys.exit(f'The archive starts later than {parsed_args.at}')
+        sys.stdout.write(page)
+    elif parsed_args.list:
+        for timestamp, digest in archive.entries():
+            print(datetime.datetime.fromtimestamp(timestamp).isoformat(), digest)
+    else:
+        print(f'{len(archive)} fetches, {archive.size / 2 ** 20:.1f} MB')
+
+
+if __name__ == "__main__":
+    main()
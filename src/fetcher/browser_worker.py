@@ -0,0 +1,212 @@
+"""
+Supervised browser running in a child process.
+
+Firefox leaks memory when kept open for days and a hung page load can block forever, so the browser is not
+driven from the fetcher's own process. A worker process serves fetch requests sent over a pipe, the
+supervisor gives every fetch a hard deadline and kills the whole process group (worker, geckodriver, firefox
+and the virtual display) if it isn't met. The worker is also recycled once it has served too many pages or
+its process tree has grown past a memory ceiling. A dead worker is replaced on the next fetch.
+
+Pages of all monitored targets are fetched by a pool of a fixed number of workers, a worker is only started when
+fetches overlap and every started one is busy.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+# hard limit for a single fetch including a possible recaptcha wait
+FETCH_DEADLINE = int(os.getenv('FETCH_DEADLINE', '180'))
+MAX_RSS_MB = int(os.getenv('BROWSER_MAX_RSS_MB', '1500'))
+MAX_PAGES = int(os.getenv('BROWSER_MAX_PAGES', '200'))
+QUIT_TIMEOUT = 15
+# how often a fetch being waited for is checked for cancellation
+CANCEL_CHECK_INTERVAL = 0.2
+# browsers shared by all targets, every one of them costs a firefox
+POOL_SIZE = int(os.getenv('BROWSER_POOL_SIZE', '1'))
+
+# set up logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def _serve(conn, handler, closer):
+    """Worker process main loop: fetch url with handler (and fetch options) for every request until told to quit"""
+    # NOTE(ivasilev) A separate process group lets the supervisor kill everything the browser has spawned
+    os.setpgrp()
+    try:
+        while True:
+            try:
+                request = conn.recv()
+            except (EOFError, KeyboardInterrupt):
+                break
+            if request[0] == 'quit':
+                break
+            try:
+                result = handler(request[1], **request[2])
+            except Exception as exc:
+                logger.error('Unexpected error during fetch in browser worker: %s', exc)
+                result = None
+            conn.send(result)
+    finally:
+        if closer:
+            closer()
+
+
+def _process_group_rss(pgid):
+    """Resident memory in bytes of all processes of a process group, 0 if /proc is not available"""
+    total = 0
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    for pid in filter(str.isdigit, os.listdir('/proc') if os.path.isdir('/proc') else []):
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # comm may contain spaces, the fields after it are space separated
+                fields = f.read().rsplit(')', 1)[1].split()
+            if int(fields[2]) != pgid:
+                continue
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            # the process has just exited
+            continue
+    return total
+
+
+class BrowserWorker:
+
+    def __init__(self, handler, closer=None, deadline=FETCH_DEADLINE, max_rss_mb=MAX_RSS_MB, max_pages=MAX_PAGES):
+        self.handler = handler
+        self.closer = closer
+        self.deadline = deadline
+        self.max_rss_mb = max_rss_mb
+        self.max_pages = max_pages
+        self.process = None
+        self.conn = None
+        self.pages = 0
+        self.restarts = 0
+        self.busy = False
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    def is_alive(self):
+        return bool(self.process and self.process.is_alive())
+
+    def _start(self):
+        ctx = multiprocessing.get_context('spawn')
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_serve, args=(child_conn, self.handler, self.closer), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.pages = 0
+        self.restarts += 1
+        logger.info('Browser worker %s has started', self.process.pid)
+
+    def _wait_for_result(self, cancel):
+        """Return True once the worker has responded, False if the deadline has passed or cancel has been set"""
+        if cancel is None:
+            return self.conn.poll(self.deadline)
+        deadline = time.monotonic() + self.deadline
+        while not cancel.is_set():
+            if self.conn.poll(max(0, min(CANCEL_CHECK_INTERVAL, deadline - time.monotonic()))):
+                return True
+            if time.monotonic() >= deadline:
+                return False
+        return False
+
+    def fetch(self, url, cancel=None, **options):
+        """
+        Fetch url in the worker, returns page source or None if fetch has failed, missed the deadline or has been
+        cancelled by setting the cancel event (the worker is killed then, a browser can't abandon a page load).
+        """
+        if not self.is_alive():
+            self._start()
+        self.busy = True
+        try:
+            self.conn.send(('fetch', url, options))
+            if not self._wait_for_result(cancel):
+                if cancel is not None and cancel.is_set():
+                    logger.info('Fetch of %s by browser worker %s has been cancelled, killing it', url, self.pid)
+                else:
+                    logger.error('Browser worker %s has not responded in %s seconds, killing it', self.pid,
+                                 self.deadline)
+                self.kill()
+                return None
+            result = self.conn.recv()
+        except (EOFError, OSError) as exc:
+            logger.error('Browser worker %s has died: %s', self.pid, exc)
+            self.kill()
+            return None
+        finally:
+            self.busy = False
+        self.pages += 1
+        self._recycle_if_needed()
+        return result
+
+    def rss_mb(self):
+        return _process_group_rss(self.pid) / 2 ** 20 if self.is_alive() else 0
+
+    def _recycle_if_needed(self):
+        rss_mb = self.rss_mb()
+        if self.pages >= self.max_pages or rss_mb > self.max_rss_mb:
+            logger.info('Recycling browser worker %s after %s pages, %d MB resident', self.pid, self.pages, rss_mb)
+            self.stop()
+
+    def stop(self):
+        """Ask the worker to close the browser and quit, kill it if it doesn't"""
+        if not self.process:
+            return
+        try:
+            self.conn.send(('quit',))
+        except OSError:
+            pass
+        self.process.join(QUIT_TIMEOUT)
+        self.kill()
+
+    def kill(self):
+        if not self.process:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            # the group is gone already or the worker hasn't managed to create it
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+        self.process = None
+        self.conn = None
+
+    def state(self):
+        return {'pid': self.pid, 'alive': self.is_alive(), 'busy': self.busy, 'pages': self.pages,
+                'restarts': self.restarts, 'rss_mb': round(self.rss_mb(), 1)}
+
+
+class BrowserPool:
+    """Fixed number of browser workers, a fetch is served by whichever worker is idle"""
+
+    def __init__(self, handler, closer=None, size=POOL_SIZE, **kwargs):
+        self.workers = [BrowserWorker(handler, closer=closer, **kwargs) for _ in range(max(1, size))]
+        # the last used worker goes first, so a browser is only started when fetches overlap
+        self._idle = queue.LifoQueue()
+        for worker in self.workers:
+            self._idle.put(worker)
+
+    def idle(self):
+        """Number of workers not fetching anything right now"""
+        return self._idle.qsize()
+
+    def fetch(self, url, cancel=None, **options):
+        """Fetch url in an idle worker waiting for one if all are busy, see BrowserWorker.fetch"""
+        worker = self._idle.get()
+        try:
+            return worker.fetch(url, cancel=cancel, **options)
+        finally:
+            self._idle.put(worker)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
@@ -0,0 +1,110 @@
+"""
+Hedged page fetches.
+
+Most page loads take a few seconds, but every now and then one gets stuck until the load limit and the retry after
+it adds tens of seconds on top. A fetch that is still going past the p90 of recent successful loads is hedged: the
+same page is requested once more with a spare browser of the pool, whichever load finishes first wins and the other
+one is cancelled (its browser is killed, the next fetch starts a fresh one). A load that fails early is hedged right
+away instead of waiting for the retry.
+
+Hedges are paid for with tokens: every fetch earns HEDGE_RATIO of a token and a hedge costs one, so the site gets
+at most that many extra requests per fetch, HEDGE_BURST tokens can be saved up for a bad streak.
+"""
+import asyncio
+import collections
+import logging
+import os
+import threading
+import time
+
+import utils
+
+HEDGING = os.getenv('HEDGING', 'yes') not in ('0', 'no', 'off')
+HEDGE_RATIO = float(os.getenv('HEDGE_RATIO', '0.1'))
+HEDGE_BURST = float(os.getenv('HEDGE_BURST', '3'))
+HEDGE_PERCENTILE = 90
+# no hedging until that many loads have been seen and never earlier than HEDGE_MIN_DELAY
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '2'))
+LATENCY_WINDOW = 200
+
+# set up logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class Hedger:
+
+    def __init__(self, has_spare=None, ratio=HEDGE_RATIO, burst=HEDGE_BURST, min_samples=HEDGE_MIN_SAMPLES,
+                 min_delay=HEDGE_MIN_DELAY, window=LATENCY_WINDOW):
+        # tells whether there is an idle browser to hedge with
+        self.has_spare = has_spare or (lambda: True)
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.latencies = collections.deque(maxlen=window)
+        self.stats = collections.Counter()
+
+    def delay(self):
+        """Seconds a load may take before it is hedged, None until enough loads have been seen"""
+        if len(self.latencies) < self.min_samples:
+            return None
+        return max(self.min_delay, utils.percentile(self.latencies, HEDGE_PERCENTILE))
+
+    def _take_token(self):
+        if self.tokens < 1 or not self.has_spare():
+            self.stats['hedges_skipped'] += 1
+            return False
+        self.tokens -= 1
+        self.stats['hedges'] += 1
+        return True
+
+    async def fetch(self, fetch_func, url):
+        """
+        Fetch url with fetch_func(url=url, cancel=threading.Event) hedging a slow or failed load, returns the
+        first page fetched or None if every load has failed.
+        """
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+        self.stats['fetches'] += 1
+        started = time.monotonic()
+        delay = self.delay()
+        # task -> (kind, started, cancel event)
+        attempts = {}
+
+        def _start(kind):
+            cancel = threading.Event()
+            attempts[asyncio.ensure_future(fetch_func(url=url, cancel=cancel))] = (kind, time.monotonic(), cancel)
+
+        _start('primary')
+        hedged = False
+        result = None
+        while attempts and not result:
+            timeout = None if hedged or delay is None else max(0, started + delay - time.monotonic())
+            done, _ = await asyncio.wait(list(attempts), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.info('Loading %s takes longer than %.1f s, hedging', url, delay)
+            for task in done:
+                kind, attempt_started, _ = attempts.pop(task)
+                try:
+                    result = task.result()
+                except Exception as exc:
+                    logger.error('Unexpected error during %s fetch of %s: %s', kind, url, exc)
+                if result:
+                    self.latencies.append(time.monotonic() - attempt_started)
+                    self.stats[f'{kind}_wins'] += 1
+                    break
+            if not result and not hedged:
+                # slow or failed early, either way the spare browser is the best bet
+                hedged = True
+                if self._take_token():
+                    _start('hedge')
+        for task, (kind, _, cancel) in attempts.items():
+            logger.debug('Cancelling %s fetch of %s', kind, url)
+            cancel.set()
+        return result
+
+    def format_stats(self):
+        return dict(self.stats, tokens=round(self.tokens, 2), delay=self.delay())
@@ -0,0 +1,78 @@
+"""
+On-disk spool of pushes the registry has not received.
+
+While the registry is unreachable every push the fetcher would have made is kept here as a gzipped json file. The
+spool holds SPOOL_MAX_ENTRIES pushes at most, the oldest ones are dropped first as they matter the least. Once the
+registry is back the whole spool is sent in one compressed batch in the order pushes have been made, right after
+the fresh page, which is never held up by the replay. Every push keeps the date it has been fetched at, so the
+registry can tell the replayed pages from the latest one.
+"""
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+
+OUTPUT_DIR = os.getenv('OUTPUT_DIR', 'output')
+SPOOL_DIR = os.path.join(OUTPUT_DIR, 'spool')
+SPOOL_MAX_ENTRIES = int(os.getenv('SPOOL_MAX_ENTRIES', '100'))
+SUFFIX = '.json.gz'
+
+# set up logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class Spool:
+
+    def __init__(self, directory=SPOOL_DIR, max_entries=SPOOL_MAX_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._filenames())
+
+    def _filenames(self):
+        """Spooled files, oldest first"""
+        return sorted(f for f in os.listdir(self.directory) if f.endswith(SUFFIX))
+
+    def put(self, entry):
+        """Spool a push (a dict of its fields), returns the number of pushes dropped to stay within the limit"""
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(gzip.compress(json.dumps(entry).encode('utf-8')))
+        # NOTE(ivasilev) names sort by time, so the directory listing is the order of pushes
+        os.replace(tmp_filename, os.path.join(self.directory, f'{time.time_ns():020d}{SUFFIX}'))
+        dropped = self._filenames()[:-self.max_entries] if self.max_entries else []
+        for filename in dropped:
+            os.unlink(os.path.join(self.directory, filename))
+        if dropped:
+            logger.warning('Spool is full, %s oldest pushes have been dropped', len(dropped))
+        return len(dropped)
+
+    def load(self):
+        """Return [(filename, entry)] of spooled pushes, oldest first"""
+        res = []
+        for filename in self._filenames():
+            try:
+                with open(os.path.join(self.directory, filename), 'rb') as f:
+                    res.append((filename, json.loads(gzip.decompress(f.read()))))
+            except (OSError, ValueError) as exc:
+                logger.error('Dropping unreadable spooled push %s: %s', filename, exc)
+                os.unlink(os.path.join(self.directory, filename))
+        return res
+
+    def remove(self, filenames):
+        for filename in filenames:
+            try:
+                os.unlink(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+
+
+def batch(entries):
+    """Gzipped json list of entries to send at once"""
+    return gzip.compress(json.dumps(entries).encode('utf-8'))
@@ -1,41 +1,106 @@
 import datetime
+import json
+import logging
+import math
 import os
 import random
-import requests
+import threading
+import time
 
-import fake_useragent
+from utils import snapshot
 
 DATETIME_FORMAT = '%d/%m/%Y %H:%M:%S'
-UA = fake_useragent.UserAgent(browsers=['firefox'])
-UA.update()
+# Catalog of user agents to choose from, refreshed in background from fake-useragent data
+USERAGENTS_FILE = os.getenv('USERAGENTS_FILE', os.path.join(os.getenv('OUTPUT_DIR', 'output'), 'useragents.json'))
+# Catalog age in seconds after which it is refreshed, 0 means never refresh
+USERAGENTS_REFRESH_INTERVAL = int(os.getenv('USERAGENTS_REFRESH_INTERVAL', str(24 * 60 * 60)))
+# Used until the catalog is there
+FALLBACK_USERAGENTS = [
+    'Mozilla/5.0 (iPad; CPU iPad OS 10_3_4 like Mac OS X) AppleWebKit/536.1 (KHTML, like Gecko) CriOS/26.0.877.0 Mobile/13Z933 Safari/536.1',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 13.2; rv:111.0) Gecko/20100101 Firefox/111.0',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:107.0) Gecko/20100101 Firefox/107.0',
+]
+USERAGENTS = None
+_USERAGENTS_LOCK = threading.Lock()
 
+logger = logging.getLogger(__name__)
 
-def get_useragent(ua=UA):
+
+def _load_useragents(filename):
+    try:
+        with open(filename) as f:
+            useragents = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    return [ua for ua in useragents if isinstance(ua, str) and ua] or None
+
+
+def _fetch_useragents():
+    """Build a list of user agents from fake-useragent data, this does network I/O"""
+    import fake_useragent
+    ua = fake_useragent.UserAgent(browsers=['firefox'])
+    ua.update()
     # NOTE(ivasilev) Setting useragent with ua.random is a great idea in theory but in practice it leads to
-    # recaptcha warnings as recaptcha needs latest version of browsers to run. So let's hardcode it here to
-    # something 100% acceptable and configure fake-useragent with custom data file later
-    # useragent = ua.random
-    useragents_firefox = UA.data_browsers['firefox'][0:3]
-    useragents_safari_ipad = [ua for ua in UA.data_browsers['safari'] if 'iPad' in ua][0:2]
-    useragents = useragents_firefox + useragents_safari_ipad
-    # useragents = [
-    #        'Mozilla/5.0 (iPad; CPU iPad OS 10_3_4 like Mac OS X) AppleWebKit/536.1 (KHTML, like Gecko) CriOS/26.0.877.0 Mobile/13Z933 Safari/536.1',
-    #        'Mozilla/5.0 (Macintosh; Intel Mac OS X 13.2; rv:111.0) Gecko/20100101 Firefox/111.0',
-    #        'Mozilla/5.0 (X11; Linux x86_64; rv:107.0) Gecko/20100101 Firefox/107.0',
-    #        ]
-    useragent = useragents[random.randint(0, len(useragents) - 1)]
-    return useragent
+    # recaptcha warnings as recaptcha needs latest version of browsers to run. So let's stick to latest firefox
+    # and safari on ipad.
+    useragents_firefox = ua.data_browsers['firefox'][0:3]
+    useragents_safari_ipad = [u for u in ua.data_browsers['safari'] if 'iPad' in u][0:2]
+    return useragents_firefox + useragents_safari_ipad
 
 
-async def do_fetch(url, logger, proxy=None):
+def refresh_useragents(filename=USERAGENTS_FILE):
+    """Rebuild the user agents catalog and save it to filename, returns True on success"""
+    global USERAGENTS
+    try:
+        useragents = _fetch_useragents()
+    except Exception as exc:
+        logger.warning('Could not refresh user agents catalog: %s', exc)
+        return False
+    if not useragents:
+        return False
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    snapshot.publish(filename, json.dumps(useragents))
+    USERAGENTS = useragents
+    logger.info('User agents catalog %s has been refreshed', filename)
+    return True
+
+
+def _refresh_useragents_periodically(filename, interval):
+    while True:
+        try:
+            age = time.time() - os.path.getmtime(filename)
+        except OSError:
+            age = interval
+        if age >= interval:
+            refresh_useragents(filename)
+            age = 0
+        time.sleep(interval - age)
+
+
+def get_useragent():
+    """Random user agent from the catalog, the catalog is loaded on the first call"""
+    global USERAGENTS
+    with _USERAGENTS_LOCK:
+        if USERAGENTS is None:
+            USERAGENTS = _load_useragents(USERAGENTS_FILE) or list(FALLBACK_USERAGENTS)
+            if USERAGENTS_REFRESH_INTERVAL:
+                threading.Thread(target=_refresh_useragents_periodically,
+                                 args=(USERAGENTS_FILE, USERAGENTS_REFRESH_INTERVAL), daemon=True).start()
+    return random.choice(USERAGENTS)
+
+
+def fetch_text(url, logger, proxy=None, timeout=None):
+    """Blocking GET of url, returns the text of the response or None if it has failed"""
+    import requests
     try:
         proxies = {} if proxy in ('0', 'None', 'no', None) else {'https': f'socks5h://{proxy}'}
         if proxies:
             logger.info("Using proxy %s for request", proxy)
-        resp = requests.get(url, proxies=proxies, headers={'Cache-Control': 'no-cache',
-                                                           'Pragma': 'no-cache',
-                                                           'User-agent': get_useragent()})
-    except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+        resp = requests.get(url, proxies=proxies, timeout=timeout, headers={'Cache-Control': 'no-cache',
+                                                                            'Pragma': 'no-cache',
+                                                                            'User-agent': get_useragent()})
+    except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout):
         return
     except Exception as exc:
         logger.error('Some unexpected exception has occured %s..', exc)
@@ -44,6 +109,10 @@ async def do_fetch(url, logger, proxy=None):
         return resp.text
 
 
+async def do_fetch(url, logger, proxy=None):
+    return fetch_text(url, logger, proxy=proxy)
+
+
 def timestamp_to_str(timestamp, dt_format=DATETIME_FORMAT):
     """Convert timestamp to a human-readable format"""
     try:
@@ -58,3 +127,9 @@ def get_modification_time(filename, human_readable=False):
     if not human_readable:
         return modified_ts
     return timestamp_to_str(modified_ts)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values, 0 if there are none"""
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)] if values else 0
@@ -0,0 +1,82 @@
+"""
+Circuit breaker for calls to the central registry.
+
+After BREAKER_THRESHOLD failures in a row the breaker opens and calls are not made at all. Once the probe delay has
+passed a single call is let through as a probe: if it succeeds the breaker closes, otherwise it opens again with
+the delay doubled (up to BREAKER_MAX_DELAY). A registry outage thus costs a request every now and then and not one
+every polling cycle.
+"""
+import logging
+import os
+import time
+
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', '3'))
+BREAKER_BASE_DELAY = int(os.getenv('BREAKER_BASE_DELAY', '30'))
+BREAKER_MAX_DELAY = int(os.getenv('BREAKER_MAX_DELAY', '900'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# set up logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, threshold=BREAKER_THRESHOLD, base_delay=BREAKER_BASE_DELAY, max_delay=BREAKER_MAX_DELAY,
+                 clock=time.monotonic):
+        self.name = name
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.failures = 0
+        self.delay = base_delay
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return CLOSED
+        return HALF_OPEN if self.probing else OPEN
+
+    def allow(self):
+        """Whether a call may be made now, every allowed call has to be followed by success() or failure()"""
+        if self.opened_at is None:
+            return True
+        if self.probing or self.clock() < self.opened_at + self.delay:
+            return False
+        self.probing = True
+        return True
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info('%s has recovered after %s failures', self.name, self.failures)
+        self.failures = 0
+        self.delay = self.base_delay
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing:
+            self.delay = min(self.max_delay, self.delay * 2)
+        elif self.opened_at is not None or self.failures < self.threshold:
+            return
+        self.opened_at = self.clock()
+        self.probing = False
+        logger.warning('%s has failed %s times in a row, next attempt in %s seconds', self.name, self.failures,
+                       self.delay)
+
+    def format_state(self):
+        return {'state': self.state, 'failures': self.failures, 'retry_in': self.retry_in()}
+
+    def retry_in(self):
+        """Seconds until the next probe, 0 if calls are let through"""
+        if self.opened_at is None:
+            return 0
+        return max(0, int(self.opened_at + self.delay - self.clock()))
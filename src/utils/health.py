@@ -0,0 +1,136 @@
+"""
+Liveness and readiness endpoints served by a thread of the service itself.
+
+`/healthz` tells whether the process is alive, i.e. its main loop keeps going, `/readyz` whether it does its job
+(pages get fetched, redis is reachable etc). Both answer 200 or 503 with a json body of all checks and whatever
+state the service has reported. Checks only look at what the service keeps in memory anyway, so probing costs no
+disk I/O and can be done as often as orchestration likes:
+
+    curl -s localhost:8080/readyz
+
+The service calls heartbeat(timeout) every time its main loop comes around, promising to be back within timeout,
+report(...) to publish its state and add_check(...) for anything else worth checking on every probe.
+"""
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+# 0 disables the endpoints
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', '8080'))
+HEALTH_HOST = os.getenv('HEALTH_HOST', '0.0.0.0')
+# time to get to the first heartbeat
+STARTUP_GRACE = int(os.getenv('HEALTH_STARTUP_GRACE', '300'))
+LIVENESS = '/healthz'
+READINESS = '/readyz'
+
+_LOCK = threading.Lock()
+_STATE = {}
+_CHECKS = {LIVENESS: {}, READINESS: {}}
+# the main loop is considered stuck after that (monotonic) time
+_DEADLINE = None
+
+# set up logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def heartbeat(timeout):
+    """The main loop has come around and promises to be back within timeout seconds"""
+    global _DEADLINE
+    _DEADLINE = time.monotonic() + timeout
+
+
+def report(**values):
+    """Publish state values to be shown by both endpoints"""
+    with _LOCK:
+        _STATE.update(values)
+
+
+def add_check(name, check, endpoint=READINESS):
+    """
+    Evaluate check on every probe of the endpoint, it returns True if everything is fine or (ok, detail).
+    Liveness checks are readiness checks as well.
+    """
+    with _LOCK:
+        _CHECKS[endpoint][name] = check
+
+
+def reset():
+    global _DEADLINE
+    with _LOCK:
+        _STATE.clear()
+        for checks in _CHECKS.values():
+            checks.clear()
+    _DEADLINE = None
+
+
+def _main_loop():
+    if _DEADLINE is None:
+        return True, 'no heartbeat yet'
+    overdue = time.monotonic() - _DEADLINE
+    return overdue <= 0, f'overdue by {int(overdue)} s' if overdue > 0 else 'running'
+
+
+def _run_check(check):
+    try:
+        res = check()
+    except Exception as exc:
+        return False, f'{type(exc).__name__}: {exc}'
+    return res if isinstance(res, tuple) else (bool(res), None)
+
+
+def status(endpoint):
+    """Return (ok, body) for the endpoint"""
+    with _LOCK:
+        checks = dict(_CHECKS[LIVENESS])
+        if endpoint == READINESS:
+            checks.update(_CHECKS[READINESS])
+        state = dict(_STATE)
+    results = {'main_loop': _main_loop()}
+    results.update((name, _run_check(check)) for name, check in checks.items())
+    ok = all(res[0] for res in results.values())
+    body = {'status': 'ok' if ok else 'failing',
+            'checks': {name: {'ok': res[0], 'detail': res[1]} for name, res in results.items()},
+            'state': state}
+    return ok, body
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        endpoint = self.path.split('?')[0]
+        if endpoint not in (LIVENESS, READINESS):
+            self.send_error(404)
+            return
+        ok, body = status(endpoint)
+        payload = json.dumps(body, default=str).encode('utf-8')
+        self.send_response(200 if ok else 503)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # NOTE(ivasilev) probes come every few seconds, no need to log every one of them
+        pass
+
+
+def serve(port=HEALTH_PORT, host=HEALTH_HOST):
+    """Start serving the endpoints in a background thread, returns the server or None"""
+    if not port:
+        return None
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    except OSError as exc:
+        logger.error('Could not serve health endpoints on port %s: %s', port, exc)
+        return None
+    server.daemon_threads = True
+    if _DEADLINE is None:
+        heartbeat(STARTUP_GRACE)
+    threading.Thread(target=server.serve_forever, name='health', daemon=True).start()
+    logger.info('Serving %s and %s on port %s', LIVENESS, READINESS, server.server_address[1])
+    return server
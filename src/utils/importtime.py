@@ -0,0 +1,79 @@
+"""
+Import-time budget of the entry points.
+
+Containers are restarted on every failed health check, so a slow startup means a longer blind spot. Every
+entry point is imported in a fresh interpreter with `-X importtime` and the cumulative time is compared to
+its budget; the slowest modules are reported to see what has crept in.
+
+Run `python -m utils.importtime` from src, it exits with a non-zero code if any budget is exceeded.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# cumulative import time budgets in milliseconds
+BUDGETS_MS = {
+    'bot.a2exams_bot': int(os.getenv('BOT_IMPORT_BUDGET_MS', '1000')),
+    'checker.a2exams_checker': int(os.getenv('CHECKER_IMPORT_BUDGET_MS', '300')),
+    'fetcher.a2exams_fetcher': int(os.getenv('FETCHER_IMPORT_BUDGET_MS', '300')),
+}
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module, python=sys.executable):
+    """Import module in a fresh interpreter, returns {module name: (self ms, cumulative ms)}"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SRC_DIR, os.getenv('PYTHONPATH')])))
+    res = subprocess.run([python, '-X', 'importtime', '-c', f'import {module}'],
+                         capture_output=True, text=True, env=env, check=True)
+    timings = {}
+    for line in res.stderr.splitlines():
+        # import time:       self [us] |  cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        timings[name.strip()] = (int(self_us) / 1000, int(cumulative_us) / 1000)
+    return timings
+
+
+def loaded_modules(module, python=sys.executable):
+    """Return top-level packages loaded by importing module in a fresh interpreter"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SRC_DIR, os.getenv('PYTHONPATH')])))
+    res = subprocess.run([python, '-c', f'import sys, {module}; print(" ".join(sys.modules))'],
+                         capture_output=True, text=True, env=env, check=True)
+    return {name.split('.')[0] for name in res.stdout.split()}
+
+
+def report(module, timings, top=10):
+    lines = [f'{module}: {timings[module][1]:.1f} ms (budget {BUDGETS_MS.get(module, "-")} ms)']
+    # only top-level packages, their submodules are included in the cumulative time. site is imported by
+    # the interpreter itself and doesn't count.
+    packages = sorted(((cumulative, name) for name, (_, cumulative) in timings.items()
+                       if '.' not in name and name not in (module, 'site')), reverse=True)
+    for cumulative, name in packages[:top]:
+        lines.append(f'  {cumulative:8.1f} ms  {name}')
+    return '\n'.join(lines)
+
+
+def _parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('modules', nargs='*', help='Modules to check, all entry points by default')
+    parser.add_argument('--top', help='Number of slowest packages to report', default=10, type=int)
+    return parser.parse_args(args)
+
+
+def main():
+    parsed_args = _parse_args()
+    over_budget = []
+    for module in parsed_args.modules or BUDGETS_MS:
+        timings = measure(module)
+        print(report(module, timings, parsed_args.top))
+        if module in BUDGETS_MS and timings[module][1] > BUDGETS_MS[module]:
+            over_budget.append(module)
+    if over_budget:
+        print(f'Import time budget exceeded: {", ".join(over_budget)}')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
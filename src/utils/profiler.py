@@ -0,0 +1,106 @@
+"""
+On-demand sampling profiler.
+
+Nothing runs until a profile is requested: then a thread wakes up every few milliseconds for the given number of
+seconds and records the stacks of all other threads of the process. The result is written in the collapsed stacks
+format (`thread;module:function;... count` per line) which flamegraph.pl, speedscope.app and inferno turn into a
+flamegraph. Only the python process itself is sampled, the browser of the fetcher lives in a process of its own.
+
+The bot starts it with /adminprofile [seconds], the fetcher on SIGUSR2 (`kill -USR2 <pid>`).
+"""
+import collections
+import datetime
+import logging
+import os
+import sys
+import threading
+import time
+
+OUTPUT_DIR = os.getenv('OUTPUT_DIR', 'output')
+PROFILES_DIR = os.path.join(OUTPUT_DIR, 'profiles')
+PROFILE_SECONDS = int(os.getenv('PROFILE_SECONDS', '30'))
+MAX_PROFILE_SECONDS = 300
+SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+
+_LOCK = threading.Lock()
+
+# set up logging
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def _frame_name(frame):
+    module = frame.f_globals.get('__name__', '?')
+    return f'{module}:{frame.f_code.co_name}'
+
+
+def sample(seconds, interval=SAMPLE_INTERVAL):
+    """Sample stacks of all other threads for seconds, returns Counter of collapsed stacks"""
+    stacks = collections.Counter()
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def collapsed(stacks):
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+def summary(stacks, limit=10):
+    """Functions the most samples have been taken in (on top of the stack)"""
+    total = sum(stacks.values())
+    if not total:
+        return 'No samples'
+    leaves = collections.Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    return '\n'.join(f'{count * 100 / total:5.1f}% {leaf}' for leaf, count in leaves.most_common(limit))
+
+
+def save(stacks, service, directory=None):
+    """Write collapsed stacks to the profiles directory, returns the filename"""
+    directory = directory or PROFILES_DIR
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, f'{service}-{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}.collapsed')
+    with open(filename, 'w') as f:
+        f.write(collapsed(stacks))
+    return filename
+
+
+def start(seconds, service, on_done=None, directory=None):
+    """
+    Profile the process for seconds in a background thread, save the profile and call on_done(filename, stacks).
+    Returns False if a profile is being taken already.
+    """
+    if not _LOCK.acquire(blocking=False):
+        return False
+    seconds = max(1, min(seconds, MAX_PROFILE_SECONDS))
+
+    def _run():
+        try:
+            logger.info('Profiling for %s seconds', seconds)
+            stacks = sample(seconds)
+            filename = save(stacks, service, directory)
+            logger.info('Profile of %s samples has been saved to %s', sum(stacks.values()), filename)
+            if on_done:
+                on_done(filename, stacks)
+        except Exception as exc:
+            logger.error('Profiling has failed: %s', exc)
+        finally:
+            _LOCK.release()
+
+    threading.Thread(target=_run, name='profiler', daemon=True).start()
+    return True
@@ -0,0 +1,167 @@
+"""
+Atomic publication of the snapshot files shared between fetcher, checker and bot.
+
+A snapshot is replaced by renaming a fully written temporary file over it, so a reader never sees a
+half-written page or json. Every publication also bumps a generation counter that lives in a tiny
+`<snapshot>.gen` sidecar updated in place. Readers keep the sidecar memory-mapped and only open the
+snapshot itself once the generation has moved.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+GENERATION_SUFFIX = '.gen'
+_GENERATION = struct.Struct('<Q')
+
+
+def _generation_file(filename):
+    return f'{filename}{GENERATION_SUFFIX}'
+
+
+def _bump_generation(filename):
+    fd = os.open(_generation_file(filename), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        # NOTE(ivasilev) fetchers of several targets or a reprocessing run may publish the same file, an unlocked
+        # read-modify-write would lose an increment and readers would never see the last publication
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        raw = os.pread(fd, _GENERATION.size, 0)
+        generation = _GENERATION.unpack(raw)[0] + 1 if len(raw) == _GENERATION.size else 1
+        # NOTE(ivasilev) The counter is rewritten in place (and not renamed) so that mappings held by
+        # readers keep pointing to the live value
+        os.pwrite(fd, _GENERATION.pack(generation), 0)
+    finally:
+        # closing the descriptor releases the lock
+        os.close(fd)
+    return generation
+
+
+def publish(filename, data):
+    """
+    Atomically replace filename with data (str or bytes) and return the new generation of the snapshot.
+    """
+    dirname = os.path.dirname(filename) or '.'
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix=f'.{os.path.basename(filename)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates files readable by owner only, but snapshots are shared between containers
+        os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+        raise
+    return _bump_generation(filename)
+
+
+def get_generation(filename):
+    """Return current generation of a snapshot, 0 if it has never been published."""
+    try:
+        with open(_generation_file(filename), 'rb') as f:
+            raw = f.read(_GENERATION.size)
+    except FileNotFoundError:
+        return 0
+    return _GENERATION.unpack(raw)[0] if len(raw) == _GENERATION.size else 0
+
+
+class SnapshotReader:
+    """
+    Polls a published snapshot and reloads it only when its generation moves.
+
+    Files that were not written by publish() (no generation sidecar yet) fall back to inode, mtime and
+    size of the snapshot as generation, which still costs a stat and not a read.
+    """
+
+    def __init__(self, filename, loader=None, default=None):
+        self.filename = filename
+        self.loader = loader or (lambda text: text)
+        self.default = default
+        self.generation = None
+        self.data = default
+        self._mapping = None
+
+    def _map_generation(self):
+        try:
+            with open(_generation_file(self.filename), 'rb') as f:
+                self._mapping = mmap.mmap(f.fileno(), _GENERATION.size, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # no sidecar or it is not fully written yet
+            self._mapping = None
+        return self._mapping
+
+    def current_generation(self):
+        mapping = self._mapping or self._map_generation()
+        if mapping is not None:
+            return _GENERATION.unpack(mapping[:_GENERATION.size])[0]
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def changed(self):
+        """Check if a new snapshot has been published since the last get()."""
+        return self.current_generation() != self.generation
+
+    def get(self):
+        """Return loaded contents of the snapshot, the file is only read if the generation has moved."""
+        generation = self.current_generation()
+        if generation == self.generation:
+            return self.data
+        try:
+            with open(self.filename) as f:
+                self.data = self.loader(f.read())
+        except FileNotFoundError:
+            self.data = self.default
+        self.generation = generation
+        return self.data
+
+    def close(self):
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+
+
+class MemorySnapshot:
+    """
+    In-process counterpart of a published snapshot for services running in a single process (see embedded): data
+    is handed over as is, no file is written or read.
+    """
+
+    def __init__(self, data=None):
+        self.data = data
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def publish(self, data):
+        with self._lock:
+            self.data = data
+            self.generation += 1
+            return self.generation
+
+    def reader(self, default=None):
+        return MemoryReader(self, default=default)
+
+
+class MemoryReader:
+    """Reader of a MemorySnapshot with the interface of SnapshotReader, every consumer should have its own"""
+
+    def __init__(self, source, default=None):
+        self.source = source
+        self.default = default
+        self.generation = None
+        self.data = default
+
+    def changed(self):
+        return self.source.generation != self.generation
+
+    def get(self):
+        with self.source._lock:
+            self.data = self.source.data if self.source.data is not None else self.default
+            self.generation = self.source.generation
+        return self.data
@@ -0,0 +1,152 @@
+"""
+Registration pages being monitored.
+
+Out of the box it is the A2 permanent residence page only. TARGETS lists more of them, as json text or a path to
+a json file:
+
+    [{"name": "a2", "url": "https://cestina-pro-cizince.cz/trvaly-pobyt/a2/online-prihlaska/"},
+     {"name": "obcanstvi", "url": "https://cestina-pro-cizince.cz/obcanstvi/online-prihlaska/", "interval": 60}]
+
+Every target has a parser profile (what to wait for in the browser and which tags hold cities), a polling interval
+and files of its own. The first target is the main one: its files are the ones services have always used, its
+cities are keyed by name as before and "all cities" subscriptions mean its cities. Cities of other targets are
+keyed `<target>/<city>` in the data the bot sees, so subscriptions, filters and the fan-out work for them unchanged.
+
+Pages of a target go through the central registry only if the target has registry endpoints of its own (`url_post`
+for the fetcher, `url_get` and `url_get_ts` for the checker), the main target falls back to URL_POST, URL_GET and
+URL_GET_TS. Other targets never fall back to the endpoints of the main one: the registry would take their pages for
+the A2 page. Without endpoints the checker reads pages the fetcher has saved locally.
+
+All targets share the fetcher's browser pool and a single polling budget: the schedule hands out at most
+POLLING_BUDGET fetches a minute in total (0 means no limit on top of intervals), the most overdue target first.
+Adding a target adds a schedule entry and a couple of files, not a browser.
+"""
+import json
+import os
+
+DEFAULT_URL = os.getenv('URL', 'https://cestina-pro-cizince.cz/trvaly-pobyt/a2/online-prihlaska/')
+TARGETS = os.getenv('TARGETS')
+POLLING_INTERVAL = int(os.getenv('POLLING_INTERVAL', '25'))
+POLLING_BUDGET = int(os.getenv('POLLING_BUDGET', '0'))
+# Initial time to wait if a fetch of a target didn't get through
+DEFAULT_BACKOFF = int(os.getenv('DEFAULT_BACKOFF', '120'))
+OUTPUT_DIR = os.getenv('OUTPUT_DIR', 'output')
+KEY_SEPARATOR = '/'
+# how to fetch and parse a page, the layout of the A2 page is shared by other pages of the same site
+PROFILES = {
+    'a2': {'wait_for_id': 'select-town', 'tag': 'li', 'cls': ''},
+}
+
+
+class Target:
+
+    def __init__(self, name, url, profile='a2', interval=None, title=None, main=False, url_post=None, url_get=None,
+                 url_get_ts=None):
+        if profile not in PROFILES:
+            raise ValueError(f'Unknown parser profile {profile} of target {name}')
+        if KEY_SEPARATOR in name:
+            raise ValueError(f'Target name {name} must not contain {KEY_SEPARATOR}')
+        self.name = name
+        self.url = url
+        self.profile = PROFILES[profile]
+        self.interval = interval or POLLING_INTERVAL
+        self.title = title or name
+        self.main = main
+        # registry endpoints of the target, see registry_url()
+        self.url_post = url_post
+        self.url_get = url_get
+        self.url_get_ts = url_get_ts
+        # NOTE(ivasilev) the main target keeps the files every deployment already has
+        self.directory = OUTPUT_DIR if main else os.path.join(OUTPUT_DIR, name)
+
+    def __repr__(self):
+        return f'Target({self.name})'
+
+    @property
+    def last_fetched(self):
+        return os.path.join(self.directory, 'last_fetched.html')
+
+    @property
+    def last_fetched_json(self):
+        return os.path.join(self.directory, 'last_fetched.json')
+
+    def key(self, city):
+        """Key of a city of the target in the data the bot sees"""
+        return city if self.main else f'{self.name}{KEY_SEPARATOR}{city}'
+
+    def registry_url(self, endpoint, default=None):
+        """
+        Registry endpoint ('url_post', 'url_get' or 'url_get_ts') of the target, the main target falls back to the
+        given default, None means pages of the target don't go through the registry
+        """
+        return getattr(self, endpoint) or (default if self.main else None)
+
+
+def load(spec=TARGETS, interval=POLLING_INTERVAL):
+    """Return the list of targets, the main one first, targets with no interval of their own get the given one"""
+    if not spec:
+        return [Target('a2', DEFAULT_URL, interval=interval, main=True)]
+    if os.path.isfile(spec):
+        with open(spec) as f:
+            spec = f.read()
+    entries = json.loads(spec)
+    if not entries:
+        raise ValueError('No targets to monitor')
+    names = [entry['name'] for entry in entries]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Target names must be unique: {names}')
+    return [Target(entry['name'], entry['url'], profile=entry.get('profile', 'a2'),
+                   interval=entry.get('interval', interval), title=entry.get('title'), main=i == 0,
+                   url_post=entry.get('url_post'), url_get=entry.get('url_get'), url_get_ts=entry.get('url_get_ts'))
+            for i, entry in enumerate(entries)]
+
+
+def main_cities(state):
+    """Cities of the main target in the data the bot sees, the ones "all cities" subscriptions track"""
+    return [city for city in state if KEY_SEPARATOR not in city]
+
+
+def merge(states):
+    """Merge [(target, schools data)] into the data the bot sees"""
+    res = {}
+    for target, state in states:
+        if target.main:
+            res.update(state)
+            continue
+        for city, data in state.items():
+            res[target.key(city)] = dict(data, city_name=f'{target.title}: {data["city_name"]}')
+    return res
+
+
+class Schedule:
+    """
+    Decides which target to fetch next. A target is due an interval after its last fetch (plus a backoff if that
+    has failed), the most overdue one goes first and fetches of all targets together are spaced to stay within
+    the polling budget.
+    """
+
+    def __init__(self, targets, budget=POLLING_BUDGET, default_backoff=DEFAULT_BACKOFF, now=0):
+        self.targets = targets
+        self.spacing = 60 / budget if budget else 0
+        self.default_backoff = default_backoff
+        self.due = {target.name: now for target in targets}
+        self.backoff = {target.name: 0 for target in targets}
+        self._last_start = None
+
+    def next(self, now):
+        """Return (target, seconds to wait before fetching it), infinite wait if every target is being fetched"""
+        target = min(self.targets, key=lambda t: self.due[t.name])
+        at = self.due[target.name]
+        if self._last_start is not None:
+            at = max(at, self._last_start + self.spacing)
+        return target, max(0, at - now)
+
+    def started(self, target, now):
+        self._last_start = now
+        # a target being fetched is not due until the fetch is done
+        self.due[target.name] = float('inf')
+
+    def done(self, target, ok, now):
+        backoff = 0 if ok else self.backoff[target.name] * 2 + self.default_backoff
+        self.backoff[target.name] = backoff
+        self.due[target.name] = now + target.interval + backoff
@@ -0,0 +1,199 @@
+"""
+Detection-to-delivery tracing.
+
+Every fetch starts a trace, its id travels with the data through every stage: as an html comment in the fetched
+page (through the registry to the checker), as a field of the schools json (to the bot) and of outbox entries (to
+senders). Each stage appends its spans to a local trace file, one OTLP/JSON ExportTraceServiceRequest per line,
+the same format the OpenTelemetry collector's file exporter writes, so the files can be fed to any OTLP tooling.
+Services on different machines write files of their own, the report merges them:
+
+    python -m utils.tracing output/traces.jsonl checker-output/traces.jsonl
+
+breaks latency down per stage and shows the end-to-end time from the start of a fetch to delivery. A trace file is
+rolled over to `<file>.1` once it has grown past TRACES_MAX_MB, pass both files to the report to see all spans kept.
+"""
+import argparse
+import collections
+import contextlib
+import json
+import logging
+import os
+import re
+import secrets
+import time
+
+import utils
+
+OUTPUT_DIR = os.getenv('OUTPUT_DIR', 'output')
+TRACES_FILE = os.getenv('TRACES_FILE', os.path.join(OUTPUT_DIR, 'traces.jsonl'))
+TRACING = os.getenv('TRACING', 'yes') not in ('0', 'no', 'off')
+# the trace file is rolled over to <file>.1 once it has grown past that, 0 means no limit
+TRACES_MAX_MB = float(os.getenv('TRACES_MAX_MB', '50'))
+ROLLOVER_SUFFIX = '.1'
+# share of outbox deliveries that get a span, there is one per subscriber otherwise
+DELIVERY_SAMPLE = float(os.getenv('TRACE_DELIVERY_SAMPLE', '0.01'))
+# set by every service on start
+SERVICE_NAME = 'a2exams'
+_HTML_MARK = re.compile(r'<!-- a2exams-trace: ([0-9a-f]{32})-([0-9a-f]{16})-(\d+) -->')
+
+logger = logging.getLogger(__name__)
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def new_trace_id():
+    return secrets.token_hex(16)
+
+
+def record(name, start_ns, end_ns, parent=None, span_id=None, trace_id=None, error=None, **attributes):
+    """
+    Write a span that has started and ended at the given times, parent is (trace_id, span_id) of the span it
+    belongs to, a new trace is started without one. Returns (trace_id, span_id) of the span.
+    """
+    trace_id = parent[0] if parent else trace_id or new_trace_id()
+    context = (trace_id, span_id or secrets.token_hex(8))
+    if not TRACING:
+        return context
+    data = {'traceId': trace_id,
+            'spanId': context[1],
+            'name': name,
+            'kind': 1,
+            'startTimeUnixNano': str(start_ns),
+            'endTimeUnixNano': str(end_ns),
+            'attributes': [_attribute(key, value) for key, value in attributes.items()],
+            'status': {'code': 2, 'message': error} if error else {'code': 1}}
+    if parent and parent[1]:
+        data['parentSpanId'] = parent[1]
+    line = {'resourceSpans': [{'resource': {'attributes': [_attribute('service.name', SERVICE_NAME)]},
+                               'scopeSpans': [{'scope': {'name': 'a2exams'}, 'spans': [data]}]}]}
+    try:
+        os.makedirs(os.path.dirname(TRACES_FILE) or '.', exist_ok=True)
+        with open(TRACES_FILE, 'a') as f:
+            f.write(json.dumps(line) + '\n')
+            size = f.tell()
+        if TRACES_MAX_MB and size > TRACES_MAX_MB * 2 ** 20:
+            # NOTE(ivasilev) a single previous file is kept, so traces take twice the limit at most
+            os.replace(TRACES_FILE, TRACES_FILE + ROLLOVER_SUFFIX)
+    except OSError as exc:
+        logger.warning('Could not write a span: %s', exc)
+    return context
+
+
+@contextlib.contextmanager
+def span(name, parent=None, **attributes):
+    """Record a span of the code inside, `with span('fetch') as context:` gives (trace_id, span_id) of it"""
+    context = (parent[0] if parent else new_trace_id(), secrets.token_hex(8))
+    start_ns = time.time_ns()
+    error = None
+    try:
+        yield context
+    except Exception as exc:
+        error = f'{type(exc).__name__}: {exc}'
+        raise
+    finally:
+        record(name, start_ns, time.time_ns(), parent, span_id=context[1], trace_id=context[0], error=error,
+               **attributes)
+
+
+def to_str(context, at_ns):
+    """Serialize trace context together with the time the data has been handed over at"""
+    return f'{context[0]}-{context[1]}-{at_ns}'
+
+
+def from_str(value):
+    """Return ((trace_id, span_id), handed over at ns) or (None, None)"""
+    try:
+        trace_id, span_id, at_ns = value.split('-')
+        return (trace_id, span_id), int(at_ns)
+    except (AttributeError, ValueError):
+        return None, None
+
+
+def inject(html, context, at_ns):
+    """Append the trace context to a page as an html comment"""
+    return f'{html}\n<!-- a2exams-trace: {to_str(context, at_ns)} -->\n'
+
+
+def extract(html):
+    """Return ((trace_id, span_id), handed over at ns) from a page or (None, None)"""
+    found = _HTML_MARK.search(html[-200:]) if html else None
+    if not found:
+        return None, None
+    return (found.group(1), found.group(2)), int(found.group(3))
+
+
+def load_spans(filenames):
+    """Yield spans of trace files as flat dicts with start/end in seconds"""
+    for filename in filenames:
+        with open(filename) as f:
+            for line in f:
+                try:
+                    request = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    # a line that is being written right now
+                    continue
+                for resource_spans in request.get('resourceSpans', []):
+                    for scope_spans in resource_spans.get('scopeSpans', []):
+                        for s in scope_spans.get('spans', []):
+                            yield {'trace_id': s['traceId'], 'name': s['name'],
+                                   'start': int(s['startTimeUnixNano']) / 1e9,
+                                   'end': int(s['endTimeUnixNano']) / 1e9}
+
+
+def breakdown(spans, last_stage=None):
+    """
+    Return (stages, end_to_end): per stage count and p50/p99 of duration ordered by when stages happen in a
+    trace and p50/p99 of time from the start of a trace to the end of its last span (of last_stage if given)
+    """
+    traces = collections.defaultdict(list)
+    for s in spans:
+        traces[s['trace_id']].append(s)
+    durations = collections.defaultdict(list)
+    offsets = collections.defaultdict(list)
+    end_to_end = []
+    for trace_spans in traces.values():
+        start = min(s['start'] for s in trace_spans)
+        for s in trace_spans:
+            durations[s['name']].append(s['end'] - s['start'])
+            offsets[s['name']].append(s['start'] - start)
+        ends = [s['end'] for s in trace_spans if not last_stage or s['name'] == last_stage]
+        if ends and len({s['name'] for s in trace_spans}) > 1:
+            end_to_end.append(max(ends) - start)
+    stages = [{'stage': name, 'count': len(durations[name]), 'p50': utils.percentile(durations[name], 50),
+               'p99': utils.percentile(durations[name], 99)}
+              for name in sorted(durations, key=lambda name: utils.percentile(offsets[name], 50))]
+    return stages, {'traces': len(end_to_end), 'p50': utils.percentile(end_to_end, 50),
+                    'p99': utils.percentile(end_to_end, 99)}
+
+
+def report(filenames, last_stage=None):
+    stages, end_to_end = breakdown(load_spans(filenames), last_stage)
+    lines = [f'{"stage":<28} {"count":>7} {"p50, s":>9} {"p99, s":>9}']
+    lines.extend(f'{s["stage"]:<28} {s["count"]:>7} {s["p50"]:>9.3f} {s["p99"]:>9.3f}' for s in stages)
+    lines.append(f'End to end over {end_to_end["traces"]} traces: p50 {end_to_end["p50"]:.3f} s, '
+                 f'p99 {end_to_end["p99"]:.3f} s')
+    return '\n'.join(lines)
+
+
+def _parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', help='Trace files', nargs='*', default=[TRACES_FILE])
+    parser.add_argument('--last-stage', help='Count end to end time up to the end of this stage')
+    return parser.parse_args(args)
+
+
+def main():
+    parsed_args = _parse_args()
+    print(report(parsed_args.files, parsed_args.last_stage))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Fan-out throughput benchmark against the fake Telegram Bot API.
+
+Redis is seeded with synthetic subscriptions (some track all cities, some a few of them), a status change is
+"detected" and the bot's own code delivers it: `_do_inform` plus outbox senders for notifications or a
+broadcast job paced like the bot paces it. Reported are messages per second and p50/p99 time-to-deliver
+counted from the moment the change was detected.
+
+    PYTHONPATH=src python tests/benchmark_fanout.py --subscribers 50000 --senders 4 --rate-limit 30
+
+Without --redis-url an in-process fakeredis is used, which hides redis round trips.
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import sys
+import time
+
+import fakeredis
+import redis
+import telegram
+from telegram.utils.request import Request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_telegram  # noqa: E402
+from bot import a2exams_bot  # noqa: E402
+from bot import broadcast  # noqa: E402
+from bot import outbox  # noqa: E402
+
+LAST_FETCHED_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'last_fetched.json')
+FIRST_CHAT_ID = 10 ** 9
+SEED_CHUNK = 10000
+
+
+def seed_subscriptions(db, subscribers, cities, tracked_share, rand):
+    """Fill the subscriptions database, tracked_share of subscribers choose 1-3 cities, the rest track all"""
+    db.flushdb()
+    chat_ids = [str(FIRST_CHAT_ID + i) for i in range(subscribers)]
+    for start in range(0, subscribers, SEED_CHUNK):
+        db.mset({chat_id: ','.join(rand.sample(cities, rand.randint(1, 3))) if rand.random() < tracked_share else ''
+                 for chat_id in chat_ids[start:start + SEED_CHUNK]})
+    return chat_ids
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def _report(fake, detected, expected, finished):
+    latencies = [ts - detected for _, _, ts in fake.messages]
+    duration = finished - detected
+    return {'messages': expected,
+            'delivered': fake.stats['sent'],
+            'blocked': fake.stats['blocked'],
+            'throttled': fake.stats['throttled'],
+            'seconds': round(duration, 2),
+            'msgs_per_sec': round(fake.stats['sent'] / duration, 1) if duration else 0,
+            'p50_s': round(percentile(latencies, 50), 2),
+            'p99_s': round(percentile(latencies, 99), 2)}
+
+
+def run_outbox(fake, bot, new_state, prev_state, senders, timeout):
+    stop_event = outbox.start_senders(a2exams_bot.REDIS_INTERNAL, bot, senders,
+                                      on_unauthorized=a2exams_bot._unsubscribe)
+    try:
+        detected = time.time()
+        expected = a2exams_bot._do_inform(None, a2exams_bot._get_all_subscribers(), new_state, prev_state,
+                                          detected)
+        enqueued = time.time()
+        fake.wait_for(expected, timeout)
+        res = _report(fake, detected, expected, time.time())
+        res['enqueue_seconds'] = round(enqueued - detected, 2)
+        # as recorded by the senders themselves
+        res['recorded_p99_s'] = round(outbox.latency_stats(a2exams_bot.REDIS_INTERNAL)['p99'], 2)
+        return res
+    finally:
+        stop_event.set()
+
+
+def run_broadcast(fake, bot, timeout):
+    db = a2exams_bot.REDIS_INTERNAL
+    detected = time.time()
+    chat_ids = a2exams_bot._get_all_subscribers()
+    job_id = broadcast.start(db, 'Benchmark broadcast', chat_ids)
+    deadline = detected + timeout
+    # the same pace the bot's repeating job keeps
+    while broadcast.get_job(db, job_id)['state'] == broadcast.RUNNING and time.time() < deadline:
+        started = time.time()
+        broadcast.send_batch(db, bot, job_id, limit=a2exams_bot.BROADCAST_RATE * a2exams_bot.BROADCAST_INTERVAL,
+                             time_budget=a2exams_bot.BROADCAST_INTERVAL, on_unauthorized=a2exams_bot._unsubscribe)
+        time.sleep(max(0, a2exams_bot.BROADCAST_INTERVAL - (time.time() - started)))
+    return _report(fake, detected, len(chat_ids), time.time())
+
+
+def _parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', choices=('outbox', 'broadcast'), default='outbox')
+    parser.add_argument('--subscribers', default=10000, type=int)
+    parser.add_argument('--tracked-share', help='Share of subscribers tracking chosen cities only', default=0.7,
+                        type=float)
+    parser.add_argument('--opened', help='Number of cities where registration opens', default=3, type=int)
+    parser.add_argument('--senders', help='Outbox sender threads', default=a2exams_bot.OUTBOX_SENDERS, type=int)
+    parser.add_argument('--rate-limit', help='Fake API messages per second, 0 for no limit', default=0, type=int)
+    parser.add_argument('--blocked-rate', help='Share of users who have blocked the bot', default=0.01, type=float)
+    parser.add_argument('--jitter', help='Min,max seconds the fake API takes to respond', default='0.005,0.05')
+    parser.add_argument('--redis-url', help='Use a real redis, db N and N+1 are flushed!')
+    parser.add_argument('--timeout', help='Give up after that many seconds', default=3600, type=float)
+    parser.add_argument('--seed', default=42, type=int)
+    return parser.parse_args(args)
+
+
+def main():
+    args = _parse_args()
+    rand = random.Random(args.seed)
+    if args.redis_url:
+        a2exams_bot.REDIS = redis.from_url(args.redis_url)
+        db_num = a2exams_bot.REDIS.connection_pool.connection_kwargs.get('db', 0)
+        a2exams_bot.REDIS_INTERNAL = redis.from_url(args.redis_url, db=db_num + 1)
+    else:
+        server = fakeredis.FakeServer()
+        a2exams_bot.REDIS = fakeredis.FakeRedis(server=server, db=0)
+        a2exams_bot.REDIS_INTERNAL = fakeredis.FakeRedis(server=server, db=1)
+    a2exams_bot.REDIS_INTERNAL.flushdb()
+    with open(LAST_FETCHED_JSON) as f:
+        prev_state = json.load(f)
+    new_state = copy.deepcopy(prev_state)
+    for city in rand.sample(sorted(new_state), args.opened):
+        new_state[city]['free_slots'] = True
+    seed_subscriptions(a2exams_bot.REDIS, args.subscribers, sorted(prev_state), args.tracked_share, rand)
+
+    fake = fake_telegram.FakeTelegram(rate_limit=args.rate_limit, blocked_rate=args.blocked_rate,
+                                      jitter=tuple(float(x) for x in args.jitter.split(',')), seed=args.seed)
+    fake.start()
+    bot = telegram.Bot(fake_telegram.TOKEN, base_url=fake.base_url,
+                       request=Request(con_pool_size=args.senders + 4))
+    try:
+        if args.scenario == 'outbox':
+            res = run_outbox(fake, bot, new_state, prev_state, args.senders, args.timeout)
+        else:
+            res = run_broadcast(fake, bot, args.timeout)
+    finally:
+        fake.stop()
+    res['subscribers'] = args.subscribers
+    for key, value in res.items():
+        print(f'{key}: {value}')
+
+
+if __name__ == "__main__":
+    main()
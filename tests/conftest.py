@@ -14,3 +14,21 @@ def main_page_html():
 def city_page_html():
     with open(CITY_PAGE) as f:
         return f.read()
+
+
+@pytest.fixture(autouse=True)
+def traces_file(tmp_path, monkeypatch):
+    # spans of code under test don't end up in output/
+    filename = str(tmp_path / 'traces.jsonl')
+    monkeypatch.setattr('utils.tracing.TRACES_FILE', filename)
+    return filename
+
+
+@pytest.fixture(autouse=True)
+def useragents_file(tmp_path, monkeypatch):
+    # no user agents are fetched over the network and no catalog ends up in output/
+    filename = str(tmp_path / 'useragents.json')
+    monkeypatch.setattr('utils.USERAGENTS_FILE', filename)
+    monkeypatch.setattr('utils.USERAGENTS_REFRESH_INTERVAL', 0)
+    monkeypatch.setattr('utils.USERAGENTS', None)
+    return filename
@@ -0,0 +1,131 @@
+"""
+Local stand-in of the Telegram Bot API.
+
+Point python-telegram-bot at it with `telegram.Bot(token, base_url=fake.base_url)`. Messages are accepted and
+recorded with the time they have arrived. Like the real API it throttles senders exceeding a rate limit
+with 429 and `retry_after` (RetryAfter), answers 403 (Unauthorized) for chats that have blocked the bot and
+takes its time to respond, so fan-out can be measured without spamming real users.
+"""
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+TOKEN = '123456:fake-token'
+
+
+class FakeTelegram:
+
+    def __init__(self, rate_limit=30, retry_after=1, blocked=None, blocked_rate=0, jitter=(0, 0), seed=None):
+        # messages per second across all chats, 0 means no limit
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.blocked = set(str(chat_id) for chat_id in blocked or [])
+        self.blocked_rate = blocked_rate
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        # (chat_id, text, timestamp) of every accepted message
+        self.messages = []
+        self.stats = {'sent': 0, 'throttled': 0, 'blocked': 0}
+        self._window = (0, 0)
+        self._cond = threading.Condition()
+        self._server = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self, host='127.0.0.1', port=0):
+        fake = self
+
+        class Handler(_Handler):
+            telegram = fake
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def wait_for(self, attempts, timeout=None):
+        """Wait until that many messages have been handled (sent or rejected as blocked), returns success"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.stats['sent'] + self.stats['blocked'] >= attempts, timeout)
+
+    def _is_blocked(self, chat_id):
+        if chat_id in self.blocked:
+            return True
+        if self.blocked_rate and self.random.random() < self.blocked_rate:
+            # a user who has blocked the bot stays blocked
+            self.blocked.add(chat_id)
+            return True
+        return False
+
+    def _throttled(self):
+        if not self.rate_limit:
+            return False
+        second, count = self._window
+        now = int(time.time())
+        if now != second:
+            second, count = now, 0
+        self._window = (second, count + 1)
+        return count >= self.rate_limit
+
+    def send_message(self, chat_id, text):
+        """Returns (http status, api response)"""
+        with self._cond:
+            if self._is_blocked(chat_id):
+                self.stats['blocked'] += 1
+                self._cond.notify_all()
+                return 403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+            if self._throttled():
+                self.stats['throttled'] += 1
+                return 429, {'ok': False, 'error_code': 429,
+                             'description': f'Too Many Requests: retry after {self.retry_after}',
+                             'parameters': {'retry_after': self.retry_after}}
+            self.stats['sent'] += 1
+            self.messages.append((chat_id, text, time.time()))
+            message_id = len(self.messages)
+            self._cond.notify_all()
+        return 200, {'ok': True, 'result': {'message_id': message_id, 'date': int(time.time()), 'text': text,
+                                            'chat': {'id': int(chat_id), 'type': 'private'}}}
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    telegram = None
+
+    def do_POST(self):
+        fake = self.telegram
+        time.sleep(fake.random.uniform(*fake.jitter))
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(body or '{}')
+        else:
+            params = {k: v[0] for k, v in urllib.parse.parse_qs(body).items()}
+        method = self.path.rsplit('/', 1)[-1]
+        if method == 'sendMessage':
+            status, response = fake.send_message(str(params.get('chat_id')), params.get('text'))
+        elif method == 'getMe':
+            status, response = 200, {'ok': True, 'result': {'id': 123456, 'is_bot': True, 'first_name': 'Fake',
+                                                            'username': 'fake_bot'}}
+        else:
+            status, response = 200, {'ok': True, 'result': True}
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,144 @@
+"""
+Load test of the fetcher against the local stand-in of the registration website.
+
+N fetch loops hammer the stand-in for a while through the fetcher's own fetch() with retries. Midway the
+site goes down for a bit and towns open and close at random. The report gives throughput, latency percentiles,
+how long it took to get the first good page after the outage and how long openings stayed unnoticed.
+
+    PYTHONPATH=src python tests/load_test_fetcher.py --duration 120 --workers 2 --outage-at 30 --outage 20
+
+`--mode browser` (the default) drives firefox in supervised browser workers exactly like the fetcher does,
+`--mode http` fetches with plain GET requests to check the harness on a machine without a browser.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import standin_site  # noqa: E402
+from fetcher import a2exams_fetcher  # noqa: E402
+from fetcher import browser_worker  # noqa: E402
+
+
+def _http_get(url, timeout=a2exams_fetcher.PAGE_LOAD_LIMIT_SECONDS):
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as resp:
+            return resp.read().decode('utf-8')
+    except (urllib.error.URLError, OSError):
+        return None
+
+
+def _make_fetch_func(mode, workers):
+    """Return an async fetch function for the mode, every fetch loop gets its own browser"""
+    loop = asyncio.get_running_loop()
+    if mode == 'http':
+        async def fetch_func(url):
+            return await loop.run_in_executor(None, _http_get, url)
+        return fetch_func
+    worker = browser_worker.BrowserWorker(a2exams_fetcher._fetch_in_worker, closer=a2exams_fetcher._close_browser)
+    workers.append(worker)
+
+    async def fetch_func(url):
+        return await loop.run_in_executor(None, worker.fetch, url)
+    return fetch_func
+
+
+async def _fetch_loop(url, fetch_func, deadline, results, retry_interval, attempts):
+    while time.time() < deadline:
+        started = time.time()
+        html = await a2exams_fetcher.fetch(url, fetch_func=fetch_func, retry_interval=retry_interval,
+                                           attempts=attempts)
+        results.append((started, time.time(), bool(html)))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def summarize(results, events, outage_end=None):
+    """Compute report numbers from (started, finished, ok) fetch results and (ts, town, opened) site events"""
+    latencies = [finished - started for started, finished, ok in results if ok]
+    duration = (max(r[1] for r in results) - min(r[0] for r in results)) if results else 0
+    summary = {'fetches': len(results),
+               'ok': len(latencies),
+               'throughput_per_min': round(len(latencies) / duration * 60, 2) if duration else 0,
+               'p50_s': round(percentile(latencies, 50), 2),
+               'p90_s': round(percentile(latencies, 90), 2),
+               'p99_s': round(percentile(latencies, 99), 2)}
+    if outage_end:
+        recovered = [finished for _, finished, ok in results if ok and finished >= outage_end]
+        summary['recovery_s'] = round(min(recovered) - outage_end, 2) if recovered else None
+    # an opening is noticed by the first good page requested after it has happened
+    delays = []
+    for ts, _, opened in events:
+        noticed = [finished for started, finished, ok in results if ok and started >= ts]
+        if opened and noticed:
+            delays.append(min(noticed) - ts)
+    summary['openings'] = sum(1 for event in events if event[2])
+    summary['detection_p50_s'] = round(statistics.median(delays), 2) if delays else None
+    return summary
+
+
+async def run(args):
+    site = standin_site.StandinSite(latency=(args.min_latency, args.max_latency), error_rate=args.error_rate,
+                                    captcha_rate=args.captcha_rate, captcha_seconds=args.captcha_seconds,
+                                    opening_rate=args.opening_rate, seed=args.seed)
+    url = site.start()
+    deadline = time.time() + args.duration
+    results = []
+    workers = []
+    outage_end = None
+    loops = [asyncio.ensure_future(_fetch_loop(url, _make_fetch_func(args.mode, workers), deadline, results,
+                                               args.retry_interval, args.attempts))
+             for _ in range(args.workers)]
+    try:
+        if args.outage:
+            await asyncio.sleep(args.outage_at)
+            site.outage(args.outage)
+            outage_end = time.time() + args.outage
+        await asyncio.gather(*loops)
+    finally:
+        site.stop()
+        for worker in workers:
+            worker.stop()
+    summary = summarize(results, site.events, outage_end)
+    summary.update(site.stats)
+    return summary
+
+
+def _parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=('browser', 'http'), default='browser')
+    parser.add_argument('--duration', help='Seconds to run the test for', default=60, type=float)
+    parser.add_argument('--workers', help='Number of concurrent fetch loops', default=1, type=int)
+    parser.add_argument('--min-latency', default=0.1, type=float)
+    parser.add_argument('--max-latency', default=1, type=float)
+    parser.add_argument('--error-rate', default=0.05, type=float)
+    parser.add_argument('--captcha-rate', default=0.02, type=float)
+    parser.add_argument('--captcha-seconds', default=3, type=float)
+    parser.add_argument('--opening-rate', default=0.1, type=float)
+    parser.add_argument('--outage-at', help='Seconds since start to bring the site down at', default=20, type=float)
+    parser.add_argument('--outage', help='Outage length in seconds, 0 for no outage', default=10, type=float)
+    parser.add_argument('--retry-interval', help='Fetcher retry interval', default=3, type=int)
+    parser.add_argument('--attempts', help='Fetcher retry attempts', default=3, type=int)
+    parser.add_argument('--seed', type=int)
+    return parser.parse_args(args)
+
+
+def main():
+    summary = asyncio.run(run(_parse_args()))
+    for key, value in summary.items():
+        print(f'{key}: {value}')
+
+
+if __name__ == "__main__":
+    main()
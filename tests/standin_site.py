@@ -0,0 +1,196 @@
+"""
+Local stand-in of the exams registration website.
+
+Serves the recorded pages from tests/data the way the real site does: the towns list is rendered by javascript
+after the page has loaded and every town has its own `?progress=2&town=N` page. Latency, server errors,
+outages, recaptcha challenges and slot openings can be injected, so the fetcher can be exercised end-to-end
+without touching the ministry website.
+
+Run `python tests/standin_site.py --port 8080 --latency 0.2,1 --error-rate 0.1 --captcha-rate 0.05` and point
+the fetcher to it with URL=http://localhost:8080/trvaly-pobyt/a2/online-prihlaska/
+"""
+import argparse
+import http.server
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+MAIN_PAGE = os.path.join(DATA_DIR, 'last_fetched.html')
+CITY_PAGE = os.path.join(DATA_DIR, 'kolin.html')
+PATH = '/trvaly-pobyt/a2/online-prihlaska/'
+CAPTCHA_IFRAME = ('<iframe name="a-standin" title="reCAPTCHA" width="304" height="78" '
+                  'src="https://www.google.com/recaptcha/api2/anchor?ar=1&amp;k=standin"></iframe>')
+_TOWNS_RE = re.compile(r'<ul class="prihlaska_a2" id="select-town">.*?</ul>', re.DOTALL)
+_TOWN_RE = re.compile(r'(<a href="\?progress=2&amp;town=(\d+)" class=")btn btn-secondary(">)Filled(</a>)')
+# the stand-in has to work offline, so nothing is loaded from the outside world (apart from the captcha iframe)
+_EXTERNAL_RE = re.compile(r'<script[^>]*src="https?://[^"]*"[^>]*>\s*</script>|'
+                          r'<(?:link|img)[^>]*(?:href|src)="https?://[^"]*"[^>]*>')
+_FREE_SLOTS_RE = re.compile(r'\d+ volných míst')
+_SELECT_RE = re.compile(r'<a href="[^"]*progress=3[^"]*" class="btn btn-primary">Vybrat</a>')
+_RENDER_SCRIPT = """<div id="towns-placeholder"></div>
+<script>
+setTimeout(function() {
+    document.getElementById('towns-placeholder').outerHTML = %s;
+}, %d);
+</script>"""
+
+
+class StandinSite:
+
+    def __init__(self, latency=(0, 0), error_rate=0, captcha_rate=0, captcha_seconds=1, opening_rate=0,
+                 render_delay_ms=300, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.captcha_rate = captcha_rate
+        self.captcha_seconds = captcha_seconds
+        self.opening_rate = opening_rate
+        self.render_delay_ms = render_delay_ms
+        self.random = random.Random(seed)
+        with open(MAIN_PAGE) as f:
+            self._main_page = _EXTERNAL_RE.sub('', f.read())
+        with open(CITY_PAGE) as f:
+            self._city_page = f.read()
+        self.towns = [int(match[1]) for match in _TOWN_RE.findall(self._main_page)]
+        self.open_towns = set()
+        # (timestamp, town, opened) for every change of slots availability
+        self.events = []
+        self.outage_until = 0
+        self.stats = {'requests': 0, 'errors': 0, 'captchas': 0}
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}{PATH}'
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve in a background thread, returns the url of the registration page"""
+        site = self
+
+        class Handler(_Handler):
+            standin = site
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def outage(self, seconds):
+        """Answer every request with 503 for the given number of seconds"""
+        self.outage_until = time.time() + seconds
+
+    def toggle(self, town, opened=None):
+        """Open or close registration in a town, returns the new state"""
+        with self._lock:
+            opened = town not in self.open_towns if opened is None else opened
+            if opened:
+                self.open_towns.add(town)
+            else:
+                self.open_towns.discard(town)
+            self.events.append((time.time(), town, opened))
+        return opened
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def towns_html(self):
+        towns_html = _TOWNS_RE.search(self._main_page).group(0)
+        return _TOWN_RE.sub(lambda m: (f'{m[1]}btn btn-primary{m[3]}Vybrat{m[4]}' if int(m[2]) in self.open_towns
+                                       else m[0]), towns_html)
+
+    def main_page(self):
+        if self.opening_rate and self.random.random() < self.opening_rate:
+            self.toggle(self.random.choice(self.towns))
+        delay_ms = self.render_delay_ms
+        captcha = ''
+        if self.captcha_rate and self.random.random() < self.captcha_rate:
+            # the towns list shows up once the "user" has solved the captcha
+            self._count('captchas')
+            delay_ms += int(self.captcha_seconds * 1000)
+            captcha = CAPTCHA_IFRAME
+        return _TOWNS_RE.sub(lambda m: captcha + _RENDER_SCRIPT % (json.dumps(self.towns_html()), delay_ms),
+                             self._main_page, count=1)
+
+    def rendered_page(self):
+        """The main page as a browser shows it once javascript has done its job"""
+        return _TOWNS_RE.sub(lambda m: self.towns_html(), self._main_page, count=1)
+
+    def city_page(self, town):
+        if town in self.open_towns:
+            return self._city_page
+        return _SELECT_RE.sub('', _FREE_SLOTS_RE.sub('Obsazeno', self._city_page))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    standin = None
+
+    def do_GET(self):
+        site = self.standin
+        site._count('requests')
+        parsed = urllib.parse.urlparse(self.path)
+        time.sleep(site.random.uniform(*site.latency))
+        if time.time() < site.outage_until or (site.error_rate and site.random.random() < site.error_rate):
+            site._count('errors')
+            self._reply(503, 'Service Unavailable')
+            return
+        if parsed.path != PATH:
+            self._reply(404, 'Not Found')
+            return
+        query = urllib.parse.parse_qs(parsed.query)
+        if query.get('progress') == ['2'] and query.get('town', [''])[0].isdigit():
+            self._reply(200, site.city_page(int(query['town'][0])))
+            return
+        self._reply(200, site.main_page())
+
+    def _reply(self, status, body):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # keep load tests output readable
+        pass
+
+
+def _parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--latency', help='Min,max seconds to wait before answering', default='0,0')
+    parser.add_argument('--error-rate', help='Share of requests answered with 503', default=0, type=float)
+    parser.add_argument('--captcha-rate', help='Share of pages with recaptcha', default=0, type=float)
+    parser.add_argument('--captcha-seconds', help='Time it takes to "solve" recaptcha', default=5, type=float)
+    parser.add_argument('--opening-rate', help='Probability that a town changes its state on a page load',
+                        default=0, type=float)
+    return parser.parse_args(args)
+
+
+def main():
+    parsed_args = _parse_args()
+    site = StandinSite(latency=tuple(float(x) for x in parsed_args.latency.split(',')),
+                       error_rate=parsed_args.error_rate, captcha_rate=parsed_args.captcha_rate,
+                       captcha_seconds=parsed_args.captcha_seconds, opening_rate=parsed_args.opening_rate)
+    print(f'Serving {site.start(host="0.0.0.0", port=parsed_args.port)}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        site.stop()
+
+
+if __name__ == "__main__":
+    main()
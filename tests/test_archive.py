@@ -0,0 +1,104 @@
+import os
+import tempfile
+import time
+from unittest import mock
+
+import pytest
+
+from checker import reprocess
+from fetcher import a2exams_fetcher
+from fetcher import archive
+
+MAIN_PAGE = 'tests/data/last_fetched.html'
+
+
+def _pages(num):
+    with open(MAIN_PAGE) as f:
+        html = f.read()
+    return [html.replace('Brno', f'Brno {i}') for i in range(num)]
+
+
+def test_archive_dedup_and_random_access():
+    pages = _pages(3)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        snapshot_archive = archive.SnapshotArchive(tmpdir)
+        digests = [snapshot_archive.put(page, timestamp=100 + i * 10) for i, page in enumerate(pages)]
+        # the same page fetched once again is not stored twice
+        assert snapshot_archive.put(pages[2], timestamp=130) == digests[2]
+        assert len(os.listdir(os.path.join(tmpdir, 'objects', digests[2][:2]))) == 1
+        assert len(snapshot_archive) == 4
+        assert snapshot_archive.get(digests[1]) == pages[1]
+        assert snapshot_archive.at(99) is None
+        assert snapshot_archive.at(100) == (100, digests[0])
+        assert snapshot_archive.get_at(125) == pages[2]
+        assert snapshot_archive.get_at(1000) == pages[2]
+        # the archive is usable after restart
+        assert archive.SnapshotArchive(tmpdir).get_at(115) == pages[1]
+        # the fetcher's archive can be reprocessed as well
+        assert [digest for _, digest in reprocess.list_snapshots(tmpdir)] == digests + [digests[2]]
+
+
+def test_archive_dictionary_and_eviction():
+    pages = _pages(6)
+    with tempfile.TemporaryDirectory() as tmpdir, mock.patch('fetcher.archive.DICT_TRAINING_SAMPLES', 4):
+        snapshot_archive = archive.SnapshotArchive(tmpdir, max_bytes=0)
+        digests = [snapshot_archive.put(page, timestamp=i) for i, page in enumerate(pages)]
+        assert len(os.listdir(os.path.join(tmpdir, 'dicts'))) == 1
+        sizes = [os.path.getsize(snapshot_archive._object_path(digest)) for digest in digests]
+        # pages compressed with the dictionary are much smaller
+        assert sizes[5] < sizes[0] / 2
+        assert [snapshot_archive.get(digest) for digest in digests] == pages
+        # the first page is fetched once again, so it has to stay
+        snapshot_archive.put(pages[0], timestamp=6)
+        snapshot_archive.evict(snapshot_archive.size - sizes[1] - sizes[2])
+        assert [digest for _, digest in snapshot_archive.entries()] == digests[3:] + [digests[0]]
+        assert not os.path.isfile(snapshot_archive._object_path(digests[1]))
+        assert snapshot_archive.get_at(6) == pages[0]
+        assert snapshot_archive.get_at(2) is None
+
+
+@pytest.mark.asyncio
+async def test_fetched_page_is_archived_after_publishing(tmp_path):
+    page = _pages(1)[0]
+    published = []
+    snapshot_archive = archive.SnapshotArchive(str(tmp_path / 'archive'))
+
+    def _put(html, timestamp=None):
+        # the page is already there for the checker when it is being compressed
+        published.append(os.path.exists(str(tmp_path / 'last_fetched.html')))
+        return archive.SnapshotArchive.put(snapshot_archive, html, timestamp)
+
+    async def fetch_func(url):
+        return page
+
+    with mock.patch('fetcher.a2exams_fetcher.ARCHIVE', snapshot_archive), \
+            mock.patch.object(snapshot_archive, 'put', side_effect=_put):
+        await a2exams_fetcher.fetch('http://example.com', filename=str(tmp_path / 'last_fetched.html'),
+                                    fetch_func=fetch_func)
+        a2exams_fetcher.ARCHIVER.submit(lambda: None).result()
+    assert published == [True]
+    assert snapshot_archive.get_at(time.time()) == page
+
+
+def test_archive_evicts_unused_dictionaries():
+    # the site changes over time, so every batch of pages gets a different dictionary
+    pages = [page.replace('e', 'eio'[i // 4]) for i, page in enumerate(_pages(12))]
+    with tempfile.TemporaryDirectory() as tmpdir, mock.patch('fetcher.archive.DICT_TRAINING_SAMPLES', 4):
+        snapshot_archive = archive.SnapshotArchive(tmpdir, max_bytes=0)
+        dicts_dir = os.path.join(tmpdir, 'dicts')
+        digests, dicts = [], []
+        for i, page in enumerate(pages):
+            digests.append(snapshot_archive.put(page, timestamp=i))
+            if i % 4 == 3:
+                dicts.append(next(name for name in os.listdir(dicts_dir) if name not in dicts))
+        # dictionaries are counted in the archive size
+        sizes = [os.path.getsize(snapshot_archive._object_path(digest)) for digest in digests]
+        assert snapshot_archive.size == sum(sizes) + sum(os.path.getsize(os.path.join(dicts_dir, name))
+                                                         for name in dicts)
+        assert archive.SnapshotArchive(tmpdir).size == snapshot_archive.size
+        # pages 4-7 were the only ones compressed with the first dictionary, the last one is still in use
+        snapshot_archive.evict(snapshot_archive.size - sum(sizes[:8]))
+        assert [digest for _, digest in snapshot_archive.entries()] == digests[8:]
+        assert sorted(os.listdir(dicts_dir)) == sorted(dicts[1:])
+        assert archive.SnapshotArchive(tmpdir).size == snapshot_archive.size
+        assert [snapshot_archive.get(digest) for digest in digests[8:]] == pages[8:]
@@ -90,3 +90,112 @@ def test__fetch_from_db():
         assert a2exams_bot._fetch_from_db('3', as_list=False) == ''
         assert a2exams_bot._fetch_from_db('nosuchid', as_list=True) == []
         assert a2exams_bot._fetch_from_db('nosuchid', as_list=False) is None
+
+
+def test_vet_cities_args_aliases():
+    schools_data = a2exams_checker.get_schools_from_file(LAST_FETCHED_JSON)
+    # Separators and czech spelling don't matter
+    requested_cities = ['Frýdek Místek', 'ustinadlabem', 'ČESKÉ-budějovice']
+    res, errors = a2exams_bot._vet_requested_cities(requested_cities, source_of_truth=schools_data)
+    assert (res, errors) == (['Ceske Budejovice', 'Frydek-Mistek', 'Usti Nad Labem'], [])
+
+
+def test_suggest_track_commands():
+    schools_data = a2exams_checker.get_schools_from_file(LAST_FETCHED_JSON)
+    keyboard = a2exams_bot._suggest_track_commands(['Brno'], ['Pr', 'Nosuchcity'], source_of_truth=schools_data)
+    assert keyboard == [['/track Brno, Praha', '/track Brno, Prerov']]
+
+
+def test_stats_and_forecast():
+    history = {'updated': 1686036600, 'cities': {
+        'Kolin': {'city_name': 'Kolín', 'openings': 2, 'by_hour': [0] * 9 + [2] + [0] * 14,
+                  'by_weekday': [0, 2, 0, 0, 0, 0, 0], 'open_since': None, 'last_opened': 1686036600,
+                  'last_closed': 1686037200, 'last_open_seconds': 600, 'total_open_seconds': 1200,
+                  'longest_open_seconds': 600}}}
+    schools_data = a2exams_checker.get_schools_from_file(LAST_FETCHED_JSON)
+    update = mock.Mock()
+    context = mock.Mock(args=['kolin'])
+    with mock.patch('bot.a2exams_bot.ROLLUPS_SNAPSHOT') as snapshot_mock, \
+            mock.patch('bot.a2exams_bot.SCHOOLS') as schools_mock:
+        snapshot_mock.get.return_value = history
+        schools_mock.get.return_value = schools_data
+        a2exams_bot.forecast(update, context)
+        update.effective_message.reply_text.assert_called_with(
+            'Kolín: slots usually appear on Tue at 09:00-10:00 (based on 2 openings)')
+        context.args = ['nosuchcity']
+        a2exams_bot.stats(update, context)
+        update.effective_message.reply_text.assert_called_with('No exams in Nosuchcity')
+
+
+def test_get_cities_from_subscription_cache():
+    import fakeredis
+    from bot import subscriptions
+
+    db = fakeredis.FakeRedis()
+    db.mset({'1': 'Praha', '3': ''})
+    cache = subscriptions.SubscriptionCache(db)
+    cache.load()
+    with mock.patch('bot.a2exams_bot.REDIS', new=db), mock.patch('bot.a2exams_bot.SUBSCRIPTIONS', new=cache):
+        assert a2exams_bot._get_tracked_cities_str('3') == 'all cities'
+        assert a2exams_bot._get_tracked_cities('1') == ['Praha']
+        a2exams_bot._set_tracked_cities_str('2', 'Brno')
+        a2exams_bot._unsubscribe('1')
+        assert sorted(a2exams_bot._get_all_subscribers()) == ['2', '3']
+        assert a2exams_bot._get_subscriptions(['1', '2', '3']) == {'2': ['Brno'], '3': []}
+    assert db.get('2') == b'Brno'
+
+
+def test_render_updates_with_filters():
+    import fakeredis
+    from bot import filters
+
+    db = fakeredis.FakeRedis()
+    db.mset({'1': '', '2': 'Brno', '3': ''})
+    index = filters.FilterIndex()
+    index.set('3', {'before': '2024-01-01'})
+    prev_state = {city: {'free_slots': False, 'city_name': city, 'timestamp': '1', 'total_slots': 0}
+                  for city in ('Brno', 'Praha')}
+    new_state = {'Brno': dict(prev_state['Brno'], free_slots=True, slots=[['2024-02-01', 3]]),
+                 'Praha': dict(prev_state['Praha'], free_slots=True, slots=[['2023-12-01', 1]])}
+    with mock.patch('bot.a2exams_bot.REDIS', new=db), mock.patch('bot.a2exams_bot.FILTERS', new=index):
+        messages = dict(a2exams_bot._render_updates(['1', '2', '3'], new_state, prev_state))
+    assert 'Brno' in messages['1'] and 'Praha' in messages['1']
+    assert 'Praha' not in messages['2']
+    # the deadline rules Brno out
+    assert 'Brno' not in messages['3'] and 'Praha' in messages['3']
+
+
+def test_render_updates_of_several_targets():
+    import fakeredis
+
+    db = fakeredis.FakeRedis()
+    db.mset({'1': '', '2': 'obcanstvi/Brno'})
+    prev_state = {city: {'free_slots': False, 'city_name': city, 'timestamp': '1', 'total_slots': 0}
+                  for city in ('Brno', 'obcanstvi/Brno')}
+    new_state = {city: dict(data, free_slots=True) for city, data in prev_state.items()}
+    with mock.patch('bot.a2exams_bot.REDIS', new=db), mock.patch('bot.a2exams_bot.SUBSCRIPTIONS', new=None):
+        messages = dict(a2exams_bot._render_updates(['1', '2'], new_state, prev_state))
+    # "all cities" are the cities of the main target
+    assert 'Brno :)' in messages['1'] and 'obcanstvi/Brno' not in messages['1']
+    assert 'obcanstvi/Brno :)' in messages['2'] and '\nBrno :)' not in messages['2']
+
+
+def test_filter_tells_it_is_not_applied_without_dates():
+    import fakeredis
+    from bot import filters
+
+    state = {'Brno': {'free_slots': True, 'city_name': 'Brno', 'timestamp': '1', 'total_slots': 0}}
+    schools = mock.Mock()
+    schools.get.return_value = state
+    update = mock.Mock()
+    update.effective_message.chat_id = 1
+    context = mock.Mock(args=['before', '2024-05-01'])
+    with mock.patch('bot.a2exams_bot.REDIS_INTERNAL', new=fakeredis.FakeRedis()), \
+            mock.patch('bot.a2exams_bot.FILTERS', new=filters.FilterIndex()), \
+            mock.patch('bot.a2exams_bot.SCHOOLS', new=schools):
+        a2exams_bot.filter_cmd(update, context)
+        assert 'filter is not applied' in update.effective_message.reply_text.call_args[0][0]
+        state['Brno']['slots'] = [['2024-04-01', 3]]
+        a2exams_bot.filter_cmd(update, context)
+        assert update.effective_message.reply_text.call_args[0][0] == \
+            'Your subscription has exams before 2024-05-01'
@@ -0,0 +1,39 @@
+from utils import breaker
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_opens_and_probes_exponentially():
+    clock = Clock()
+    b = breaker.CircuitBreaker('registry', threshold=2, base_delay=10, max_delay=25, clock=clock)
+    assert b.allow()
+    b.failure()
+    assert b.state == breaker.CLOSED and b.allow()
+    b.failure()
+    assert b.state == breaker.OPEN and not b.allow()
+    assert b.retry_in() == 10
+    clock.now = 10
+    # a single probe is let through
+    assert b.allow() and b.state == breaker.HALF_OPEN
+    assert not b.allow()
+    b.failure()
+    assert b.state == breaker.OPEN and b.delay == 20
+    clock.now = 29
+    assert not b.allow()
+    clock.now = 30
+    assert b.allow()
+    b.failure()
+    # the delay is capped
+    assert b.delay == 25
+    clock.now = 55
+    assert b.allow()
+    b.success()
+    assert b.state == breaker.CLOSED and b.delay == 10 and b.failures == 0
+    assert b.allow()
@@ -0,0 +1,80 @@
+import time
+from unittest import mock
+
+import fakeredis
+import telegram
+
+from bot import broadcast
+
+
+def test_broadcast_is_resumed_from_cursor():
+    db = fakeredis.FakeRedis()
+    job_id = broadcast.start(db, 'Hello', ['1', '2', '3', '4', '5'])
+    bot = mock.Mock()
+    assert broadcast.send_batch(db, bot, job_id, limit=2) == 2
+    assert [c.kwargs['chat_id'] for c in bot.send_message.call_args_list] == ['1', '2']
+    # a restarted bot (new bot object) continues from the cursor and doesn't resend anything
+    bot = mock.Mock()
+    assert broadcast.send_batch(db, bot, job_id, limit=10) == 3
+    assert [c.kwargs['chat_id'] for c in bot.send_message.call_args_list] == ['3', '4', '5']
+    job = broadcast.get_job(db, job_id)
+    assert (job['state'], job['cursor'], job['sent'], job['failed']) == (broadcast.DONE, 5, 5, 0)
+    assert broadcast.send_batch(db, bot, job_id, limit=10) == 0
+    assert broadcast.format_status(job).startswith(f'Broadcast #{job_id} (done): 5/5 processed, 5 sent, 0 failed')
+
+
+def test_broadcast_pause_and_errors():
+    db = fakeredis.FakeRedis()
+    job_id = broadcast.start(db, 'Hello', ['1', '2', '3'])
+    assert broadcast.set_state(db, job_id, broadcast.PAUSED)
+    bot = mock.Mock()
+    assert broadcast.send_batch(db, bot, job_id, limit=10) == 0
+    assert not bot.send_message.called
+    assert broadcast.get_jobs(db, states=(broadcast.RUNNING,)) == []
+    assert broadcast.set_state(db, job_id, broadcast.RUNNING)
+    unsubscribed = []
+    bot.send_message.side_effect = [telegram.error.Unauthorized('blocked'), None, telegram.error.RetryAfter(5)]
+    assert broadcast.send_batch(db, bot, job_id, limit=10, on_unauthorized=unsubscribed.append) == 2
+    assert unsubscribed == ['1']
+    job = broadcast.get_job(db, job_id)
+    assert (job['state'], job['cursor'], job['sent'], job['failed']) == (broadcast.RUNNING, 2, 1, 1)
+    # nothing is sent until the flood wait is over, then the throttled chat is retried
+    bot.send_message.side_effect = None
+    assert broadcast.send_batch(db, bot, job_id, limit=10) == 0
+    with mock.patch('bot.broadcast.time.time', return_value=time.time() + 6):
+        assert broadcast.send_batch(db, bot, job_id, limit=10) == 1
+    assert bot.send_message.call_args.kwargs['chat_id'] == '3'
+    # finished broadcasts can't be resumed
+    assert not broadcast.set_state(db, job_id, broadcast.RUNNING)
+
+
+def test_broadcast_cancelled_mid_batch():
+    db = fakeredis.FakeRedis()
+    job_id = broadcast.start(db, 'Hello', ['1', '2', '3'])
+    bot = mock.Mock()
+    bot.send_message.side_effect = lambda **kwargs: broadcast.set_state(db, job_id, broadcast.CANCELLED)
+    assert broadcast.send_batch(db, bot, job_id, limit=10) == 1
+    assert bot.send_message.call_count == 1
+    assert broadcast.get_job(db, job_id)['state'] == broadcast.CANCELLED
+
+
+def test_broadcast_paused_on_last_message_is_not_done():
+    db = fakeredis.FakeRedis()
+    job_id = broadcast.start(db, 'Hello', ['1'])
+    bot = mock.Mock()
+    bot.send_message.side_effect = lambda **kwargs: broadcast.set_state(db, job_id, broadcast.PAUSED)
+    assert broadcast.send_batch(db, bot, job_id, limit=10) == 1
+    assert broadcast.get_job(db, job_id)['state'] == broadcast.PAUSED
+
+
+def test_broadcast_network_errors_are_retried():
+    db = fakeredis.FakeRedis()
+    job_id = broadcast.start(db, 'Hello', ['1', '2', '3'])
+    bot = mock.Mock()
+    bot.send_message.side_effect = [None, telegram.error.TimedOut(), None, None]
+    assert broadcast.send_batch(db, bot, job_id, limit=10) == 1
+    job = broadcast.get_job(db, job_id)
+    assert (job['cursor'], job['sent'], job['failed']) == (1, 1, 0)
+    assert broadcast.send_batch(db, bot, job_id, limit=10) == 2
+    assert [c.kwargs['chat_id'] for c in bot.send_message.call_args_list] == ['1', '2', '2', '3']
+    assert broadcast.get_job(db, job_id)['state'] == broadcast.DONE
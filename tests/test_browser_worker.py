@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+
+from fetcher import browser_worker
+
+
+def _echo(url):
+    return f'<html>{url}</html>'
+
+
+def _hang(url):
+    time.sleep(60)
+
+
+def _crash(url):
+    os._exit(1)
+
+
+def test_fetch_and_recycle():
+    worker = browser_worker.BrowserWorker(_echo, deadline=30, max_pages=2)
+    try:
+        assert worker.fetch('praha') == '<html>praha</html>'
+        first_pid = worker.pid
+        assert worker.state()['alive']
+        # page limit has been reached after the second fetch, a new worker serves the next one
+        assert worker.fetch('brno') == '<html>brno</html>'
+        assert not worker.is_alive()
+        assert worker.fetch('kolin') == '<html>kolin</html>'
+        assert worker.pid != first_pid
+        assert worker.restarts == 2
+    finally:
+        worker.stop()
+    assert worker.pid is None
+
+
+def test_deadline_and_crash():
+    worker = browser_worker.BrowserWorker(_hang, deadline=1)
+    started = time.monotonic()
+    assert worker.fetch('praha') is None
+    assert time.monotonic() - started < 10
+    assert worker.pid is None
+    worker = browser_worker.BrowserWorker(_crash, deadline=30)
+    assert worker.fetch('praha') is None
+    assert worker.pid is None
+
+
+def _echo_wait(url, wait_for_id='select-town'):
+    return f'<html id="{wait_for_id}">{url}</html>'
+
+
+def test_pool_passes_fetch_options():
+    pool = browser_worker.BrowserPool(_echo_wait, size=2, deadline=30)
+    try:
+        assert pool.fetch('praha') == '<html id="select-town">praha</html>'
+        assert pool.fetch('brno', wait_for_id='towns') == '<html id="towns">brno</html>'
+        # workers are started when a fetch needs them, one at a time here
+        assert sum(worker.is_alive() for worker in pool.workers) == 1
+    finally:
+        pool.stop()
+
+
+def test_cancel():
+    worker = browser_worker.BrowserWorker(_hang, deadline=30)
+    cancel = threading.Event()
+    threading.Timer(0.5, cancel.set).start()
+    started = time.monotonic()
+    assert worker.fetch('praha', cancel=cancel) is None
+    assert time.monotonic() - started < 10
+    assert worker.pid is None
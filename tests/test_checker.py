@@ -1,5 +1,6 @@
 import copy
 import tempfile
+import time
 import unittest
 from unittest import mock
 
@@ -8,6 +9,7 @@ import pytest
 import requests
 
 from checker import a2exams_checker
+from utils import breaker
 
 LAST_FETCHED_STATUS = \
 """Brno :(
@@ -178,3 +180,75 @@ def test_has_changes():
     # test that new_data with a diminished cities list doesn't raise exception
     new_data.pop('Tabor')
     assert not a2exams_checker.has_changes(new_data, old_data)
+
+
+@pytest.mark.asyncio
+async def test_add_exam_slots():
+    schools = {'Kolin': {'free_slots': True, 'url': 'http://kolin', 'total_slots': 0},
+               'Brno': {'free_slots': False, 'url': 'http://brno', 'total_slots': 0}}
+    with open('tests/data/kolin.html') as f:
+        exam_slots = a2exams_checker._html_to_exam_slots(f.read())
+
+    async def fetch_func(url):
+        assert url == 'http://kolin'
+        return exam_slots
+
+    await a2exams_checker.add_exam_slots(schools, fetch_func=fetch_func)
+    assert schools['Kolin']['total_slots'] == 60
+    assert schools['Kolin']['slots'][:2] == [['2022-02-26', 0], ['2022-03-09', 15]]
+    # nothing is known about closed cities
+    assert 'slots' not in schools['Brno']
+
+
+@pytest.mark.asyncio
+async def test_slow_detail_page_is_given_up(monkeypatch):
+    def _fetch_text(url, logger, timeout=None):
+        time.sleep(0.5)
+        return '<html></html>'
+
+    monkeypatch.setattr('utils.fetch_text', _fetch_text)
+    started = time.monotonic()
+    assert await a2exams_checker.fetch_exam_slots('http://kolin', timeout=0.1) is None
+    assert time.monotonic() - started < 0.4
+
+
+@pytest.mark.asyncio
+async def test_pull_breaker(monkeypatch, tmp_path):
+    calls = []
+
+    async def _do_fetch(url, logger):
+        calls.append(url)
+        return None
+
+    monkeypatch.setattr(a2exams_checker, 'URL_GET', 'http://registry')
+    monkeypatch.setattr(a2exams_checker, 'TOKEN_GET', 't')
+    monkeypatch.setattr(a2exams_checker, 'PULL_BREAKERS', {})
+    monkeypatch.setattr('utils.do_fetch', _do_fetch)
+    for _ in range(5):
+        assert await a2exams_checker.get_latest_html(str(tmp_path / 'last_fetched.html')) is None
+    # the registry is not asked again until the probe delay passes, neither for the page nor for its timestamp
+    assert await a2exams_checker.get_last_fetch_time() is None
+    assert len(calls) == breaker.BREAKER_THRESHOLD
+    assert a2exams_checker.PULL_BREAKERS['a2'].state == breaker.OPEN
+
+
+@pytest.mark.asyncio
+async def test_other_targets_are_pulled_from_their_own_endpoints(monkeypatch, tmp_path):
+    from utils import targets
+
+    calls = []
+
+    async def _do_fetch(url, logger):
+        calls.append(url)
+        return '<html></html>'
+
+    monkeypatch.setattr(a2exams_checker, 'URL_GET', 'http://registry/a2')
+    monkeypatch.setattr(a2exams_checker, 'TOKEN_GET', 't')
+    monkeypatch.setattr(a2exams_checker, 'PULL_BREAKERS', {})
+    monkeypatch.setattr('utils.do_fetch', _do_fetch)
+    filename = str(tmp_path / 'last_fetched.html')
+    # no endpoint of its own, the page the fetcher has saved is used
+    assert await a2exams_checker.get_latest_html(filename, target=targets.Target('b1', 'x')) is None
+    assert calls == []
+    await a2exams_checker.get_latest_html(filename, target=targets.Target('b1', 'x', url_get='http://registry/b1'))
+    assert calls == ['http://registry/b1?token=t']
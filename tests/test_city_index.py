@@ -0,0 +1,42 @@
+from bot import city_index
+from checker import a2exams_checker
+
+LAST_FETCHED_JSON = 'tests/data/last_fetched.json'
+
+
+def test_normalize():
+    assert city_index.normalize('Frýdek - Místek') == 'frydek mistek'
+    assert city_index.normalize('  ÚSTÍ nad   Labem ') == 'usti nad labem'
+
+
+def test_lookup():
+    index = city_index.CityIndex(a2exams_checker.get_schools_from_file(LAST_FETCHED_JSON))
+    assert index.lookup('praha') == 'Praha'
+    assert index.lookup('Plzeň') == 'Plzen'
+    assert index.lookup('frydek-mistek') == 'Frydek-Mistek'
+    assert index.lookup('frydekmistek') == 'Frydek-Mistek'
+    assert index.lookup('Hradec  kralove') == 'Hradec Kralove'
+    assert index.lookup('nosuchcity') is None
+    assert index.lookup('') is None
+
+
+def test_complete_and_suggest():
+    index = city_index.CityIndex(a2exams_checker.get_schools_from_file(LAST_FETCHED_JSON))
+    assert index.complete('pr') == ['Praha', 'Prerov']
+    assert index.complete('Ústí') == ['Usti Nad Labem']
+    assert index.complete('') == []
+    # misspelled names are found by similarity
+    assert index.suggest('Olomuc') == ['Olomouc']
+    assert index.suggest('Hradec', limit=5) == ['Hradec Kralove']
+    assert index.suggest('xyzzy') == []
+
+
+def test_index_is_rebuilt_for_new_data_only():
+    schools = a2exams_checker.get_schools_from_file(LAST_FETCHED_JSON)
+    index = city_index.get_index(schools)
+    assert city_index.get_index(schools) is index
+    new_schools = dict(schools)
+    new_schools['A New City'] = {'city_name': 'A New City'}
+    new_index = city_index.get_index(new_schools)
+    assert new_index is not index
+    assert new_index.lookup('a new city') == 'A New City'
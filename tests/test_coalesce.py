@@ -0,0 +1,55 @@
+from bot import coalesce
+
+
+def _state(**free_slots):
+    return {city: {'free_slots': is_free, 'city_name': city, 'total_slots': 0, 'timestamp': 0}
+            for city, is_free in free_slots.items()}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_openings_are_delivered_right_away():
+    coalescer = coalesce.Coalescer(_state(Praha=False, Brno=False), window=60, clock=Clock())
+    opened = _state(Praha=True, Brno=False)
+    assert coalescer.observe(opened) == (opened, _state(Praha=False, Brno=False))
+    # nothing has changed since
+    assert coalescer.observe(_state(Praha=True, Brno=False)) is None
+    assert coalescer.due() is None
+
+
+def test_flap_is_suppressed():
+    clock = Clock()
+    coalescer = coalesce.Coalescer(_state(Praha=True, Brno=False), window=60, clock=clock)
+    # a slot is taken and freed again within the window
+    assert coalescer.observe(_state(Praha=False, Brno=False)) is None
+    clock.now = 20
+    assert coalescer.observe(_state(Praha=True, Brno=False)) is None
+    clock.now = 100
+    assert coalescer.due() is None
+
+
+def test_closing_is_held_and_merged():
+    clock = Clock()
+    coalescer = coalesce.Coalescer(_state(Praha=True, Brno=True), window=60, clock=clock)
+    assert coalescer.observe(_state(Praha=False, Brno=True)) is None
+    clock.now = 30
+    # superseded by a newer state, the window still counts from the first held change
+    assert coalescer.observe(_state(Praha=False, Brno=False)) is None
+    assert coalescer.due() is None
+    clock.now = 60
+    assert coalescer.due() == (_state(Praha=False, Brno=False), _state(Praha=True, Brno=True))
+    assert coalescer.due() is None
+
+
+def test_held_closing_goes_along_with_opening():
+    coalescer = coalesce.Coalescer(_state(Praha=True, Brno=False), window=60, clock=Clock())
+    assert coalescer.observe(_state(Praha=False, Brno=False)) is None
+    new_state = _state(Praha=False, Brno=True)
+    assert coalescer.observe(new_state) == (new_state, _state(Praha=True, Brno=False))
+    assert coalescer.pending is None
@@ -0,0 +1,55 @@
+import asyncio
+import json
+
+import pytest
+
+from checker import rollups
+from embedded import a2exams_embedded
+from utils import snapshot
+from utils import targets
+
+
+@pytest.mark.asyncio
+async def test_parse_pages_hands_data_over_in_memory(main_page_html, tmp_path, monkeypatch):
+    monkeypatch.setattr(targets, 'OUTPUT_DIR', str(tmp_path))
+    main = targets.Target('a2', 'http://example.com', main=True)
+    state = snapshot.MemorySnapshot({})
+    reader = state.reader()
+    history = rollups.empty()
+    history_state = snapshot.MemorySnapshot(rollups.empty())
+    told = asyncio.Event()
+    pages = asyncio.Queue(a2exams_embedded.QUEUE_SIZE)
+    a2exams_embedded._enqueue(pages, (main, main_page_html, 1686036600.0))
+    task = asyncio.ensure_future(a2exams_embedded.parse_pages(
+        [main], pages, state, history, history_state, told.set, rollups_filename=str(tmp_path / 'rollups.json')))
+    try:
+        await asyncio.wait_for(told.wait(), 30)
+    finally:
+        task.cancel()
+    assert reader.changed()
+    data = reader.get()
+    assert 'Praha' in data and data['Praha']['timestamp'] == 1686036600.0
+    assert 'Praha' in history['cities']
+    # files are written after the bot has been told
+    for _ in range(50):
+        if (tmp_path / 'last_fetched.json').exists():
+            break
+        await asyncio.sleep(0.1)
+    assert json.loads((tmp_path / 'last_fetched.json').read_text()) == data
+
+
+def test_enqueue_drops_the_oldest_page():
+    pages = asyncio.Queue(2)
+    for page in ('first', 'second', 'third'):
+        a2exams_embedded._enqueue(pages, page)
+    assert [pages.get_nowait(), pages.get_nowait()] == ['second', 'third']
+
+
+@pytest.mark.asyncio
+async def test_persist_errors_are_logged(caplog):
+    main = targets.Target('a2', 'http://example.com', main=True)
+    future = asyncio.get_running_loop().create_future()
+    future.set_exception(ValueError('not serializable'))
+    a2exams_embedded._persisted(main, future)
+    assert 'Could not save data of a2' in caplog.text
+    assert 'not serializable' in caplog.text
@@ -0,0 +1,39 @@
+from unittest import mock
+
+import pytest
+import telegram
+
+from bot import outbox
+import fake_telegram
+
+
+@pytest.fixture()
+def fake():
+    fake = fake_telegram.FakeTelegram(rate_limit=2, blocked=['13'])
+    fake.start()
+    yield fake
+    fake.stop()
+
+
+def test_bot_against_fake_api(fake):
+    bot = telegram.Bot(fake_telegram.TOKEN, base_url=fake.base_url)
+    message = bot.send_message(chat_id='1', text='Praha :)')
+    assert message.text == 'Praha :)'
+    with pytest.raises(telegram.error.Unauthorized):
+        bot.send_message(chat_id='13', text='Praha :)')
+    bot.send_message(chat_id='2', text='Brno :)')
+    with mock.patch('time.time', return_value=fake._window[0] + 0.5):
+        with pytest.raises(telegram.error.RetryAfter):
+            bot.send_message(chat_id='3', text='Kolin :)')
+    assert [m[:2] for m in fake.messages] == [('1', 'Praha :)'), ('2', 'Brno :)')]
+    assert fake.stats == {'sent': 2, 'throttled': 1, 'blocked': 1}
+
+
+def test_outbox_delivery_through_fake_api(fake):
+    fake.rate_limit = 0
+    bot = telegram.Bot(fake_telegram.TOKEN, base_url=fake.base_url)
+    unsubscribed = []
+    for chat_id in ('1', '13', '2'):
+        assert outbox.deliver(bot, chat_id, 'Praha :)', on_unauthorized=unsubscribed.append)
+    assert fake.wait_for(3, timeout=1)
+    assert unsubscribed == ['13']
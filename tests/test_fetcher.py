@@ -1,6 +1,8 @@
 import asyncio
 import requests
+import time
 import unittest
+import urllib
 from unittest import mock
 
 import pytest
@@ -36,28 +38,69 @@ def test_post(mock_post, main_page_html):
     assert URL in pushed_html
 
 
-@mock.patch('fetcher.a2exams_fetcher._create_health_file')
-@mock.patch('fetcher.a2exams_fetcher._remove_health_file')
 @pytest.mark.asyncio
-async def test_healthy_state(mock_remove_file, mock_create_file, monkeypatch):
-    # Make sure healthy file is created\deleted as needed
-    # Fetching failed -> health status removed
+async def test_healthy_state(monkeypatch):
+    # Make sure readiness follows the last successful fetch
+    monkeypatch.setattr('fetcher.a2exams_fetcher.LAST_SUCCESS', None)
+    monkeypatch.setattr('fetcher.a2exams_fetcher.post', lambda *args, **kwargs: None)
+    # Fetching failed -> not ready
     fetch_res = asyncio.Future()
     fetch_res.set_result(None)
-    monkeypatch.setattr('fetcher.a2exams_fetcher.get_time_since_last_fetched', lambda: 100500)
-    monkeypatch.setattr('fetcher.a2exams_fetcher.fetch', lambda url, filename, retry_interval, fetch_func: fetch_res)
+    monkeypatch.setattr('fetcher.a2exams_fetcher.fetch', lambda url, filename, retry_interval, fetch_func, attempts: fetch_res)
     await a2exams_fetcher.run_once()
-    assert mock_remove_file.called
-    # Fetching ok -> health status set
+    assert a2exams_fetcher._check_last_fetch()[0] is False
+    # Fetching ok -> ready
     fetch_res = asyncio.Future()
     fetch_res.set_result('some data here')
-    monkeypatch.setattr('fetcher.a2exams_fetcher.get_time_since_last_fetched', lambda: 42)
-    monkeypatch.setattr('fetcher.a2exams_fetcher.fetch', lambda url, filename, retry_interval, fetch_func: fetch_res)
+    monkeypatch.setattr('fetcher.a2exams_fetcher.fetch', lambda url, filename, retry_interval, fetch_func, attempts: fetch_res)
+    monkeypatch.setattr('fetcher.a2exams_fetcher.get_last_fetch_time', lambda human_readable: '')
     await a2exams_fetcher.run_once()
-    assert mock_create_file.called
+    assert a2exams_fetcher._check_last_fetch()[0] is True
+    # Last successful fetch is too old -> not ready again
+    monkeypatch.setattr('fetcher.a2exams_fetcher.LAST_SUCCESS', time.time() - a2exams_fetcher.HEALTH_THRESHOLD - 1)
+    assert a2exams_fetcher._check_last_fetch()[0] is False
 
 
 @mock.patch('os.path.getmtime', return_value='1614382748.545964')
 def test_get_last_fetch_time(mock_getmtime):
     assert a2exams_fetcher.get_last_fetch_time() == '1614382748.545964'
     assert a2exams_fetcher.get_last_fetch_time(human_readable=True) == '27/02/2021 00:39:08'
+
+
+def test_load_profile_preferences():
+    # full profile changes nothing but proxy settings
+    assert a2exams_fetcher._load_profile_preferences('full', ['image'], ['ads.example.com']) == {}
+    assert a2exams_fetcher._load_profile_preferences('full', ['image'], [], proxy='127.0.0.1:9150') == {
+        'network.proxy.type': 1, 'network.proxy.socks': '127.0.0.1', 'network.proxy.socks_port': 9150,
+        'network.proxy.socks_remote_dns': True}
+    prefs = a2exams_fetcher._load_profile_preferences('lean', ['image', 'font', 'nosuchtype'], ['ads.example.com'],
+                                                      proxy='127.0.0.1:9150')
+    assert prefs['permissions.default.image'] == 2
+    assert prefs['gfx.downloadable_fonts.enabled'] is False
+    assert 'permissions.default.stylesheet' not in prefs
+    # blocked hosts are routed by proxy autoconfig script, the rest goes through the socks proxy
+    assert prefs['network.proxy.type'] == 2
+    pac = urllib.parse.unquote(prefs['network.proxy.autoconfig_url'])
+    assert '["ads.example.com"]' in pac
+    assert 'SOCKS5 127.0.0.1:9150' in pac
+
+
+@pytest.mark.asyncio
+async def test_other_targets_are_pushed_to_their_own_endpoints(monkeypatch):
+    from utils import targets
+
+    pushed = []
+
+    async def _fetch(url, filename, retry_interval, fetch_func, attempts):
+        return '<html></html>'
+
+    monkeypatch.setattr('fetcher.a2exams_fetcher.fetch', _fetch)
+    monkeypatch.setattr('fetcher.a2exams_fetcher.URL_POST', URL_POST)
+    monkeypatch.setattr('fetcher.a2exams_fetcher.post', lambda html, url, **kwargs: pushed.append(url) or html)
+    await a2exams_fetcher.run_once(target=targets.Target('b1', 'https://example.com/b1'))
+    # nowhere to push to, the A2 endpoint is not used
+    assert pushed == []
+    await a2exams_fetcher.run_once(target=targets.Target('b1', 'https://example.com/b1',
+                                                         url_post='https://registry/b1'))
+    await a2exams_fetcher.run_once(target=targets.Target('a2', URL, main=True))
+    assert pushed == ['https://registry/b1', URL_POST]
@@ -0,0 +1,81 @@
+from unittest import mock
+
+import fakeredis
+
+from bot import filters
+
+
+def _city(free_slots, slots=None):
+    data = {'free_slots': free_slots, 'city_name': 'Brno', 'timestamp': '1', 'total_slots': 0}
+    if slots is not None:
+        data['slots'] = slots
+    return data
+
+
+def _index():
+    index = filters.FilterIndex()
+    index.set('early', {'before': '2024-03-01'})
+    index.set('late', {'before': '2024-06-01'})
+    index.set('few', {'min_slots': 2})
+    index.set('many', {'min_slots': 20})
+    index.set('both', {'before': '2024-05-01', 'min_slots': 5})
+    return index
+
+
+def test_matching():
+    index = _index()
+    assert index.matching(_city(False)) == set()
+    # nothing is known about dates, nobody can be ruled out
+    assert index.matching(_city(True)) == {'early', 'late', 'few', 'many', 'both'}
+    slots = [['2024-04-10', 3], ['2024-03-15', 0], ['2024-05-20', 10]]
+    # 3 slots before May, 13 in total
+    assert index.matching(_city(True, slots)) == {'late', 'few'}
+    slots.append(['2024-04-20', 2])
+    assert index.matching(_city(True, slots)) == {'late', 'few', 'both'}
+    index.discard('late')
+    assert index.matching(_city(True, slots)) == {'few', 'both'}
+
+
+def test_notifications():
+    index = _index()
+    prev_state = {'Brno': _city(False), 'Praha': _city(False), 'Kolin': _city(True, [['2024-01-01', 1]]),
+                  'Plzen': _city(False)}
+    new_state = {'Brno': _city(True, [['2024-02-01', 30]]), 'Praha': _city(False), 'Kolin': _city(False),
+                 'Plzen': _city(True)}
+    notifications = index.notifications(new_state, prev_state)
+    # Brno has opened for everybody, Kolin had a single slot in January and has closed, Plzen has no dates known
+    assert notifications.passing == {'few': {'Brno'}, 'many': {'Brno'}, 'both': {'Brno'},
+                                     'early': {'Brno', 'Kolin'}, 'late': {'Brno', 'Kolin'}}
+    cities = ['Brno', 'Praha', 'Kolin', 'Plzen']
+    assert notifications.cities('few', cities) == ['Brno', 'Praha', 'Plzen']
+    assert notifications.cities('early', cities) == cities
+    assert notifications.cities('no filter', cities) == cities
+    assert notifications.cities('many', ['Kolin']) == []
+    assert filters.FilterIndex().notifications(new_state, prev_state).cities('few', ['Kolin']) == ['Kolin']
+
+
+def test_filters_are_stored():
+    db = fakeredis.FakeRedis()
+    index = filters.FilterIndex()
+    index.save(db, 1, {'before': '2024-03-01'})
+    index.save(db, 2, {'min_slots': 3})
+    index.save(db, 2, {})
+    loaded = filters.FilterIndex().load(db)
+    assert loaded.filters == {'1': {'before': '2024-03-01'}}
+    assert filters.parse_date('01.03.2024') == '2024-03-01'
+    assert filters.parse_date('tomorrow') is None
+    assert filters.filter_to_str({'before': '2024-03-01', 'min_slots': 3}) == \
+        'exams before 2024-03-01 with at least 3 free slots'
+
+
+def test_filters_are_reloaded_only_when_changed():
+    db = fakeredis.FakeRedis()
+    filters.FilterIndex().save(db, 1, {'before': '2024-03-01'})
+    index = filters.FilterIndex().refresh(db)
+    assert index.get(1) == {'before': '2024-03-01'}
+    with mock.patch.object(index, 'load') as load:
+        index.refresh(db)
+        assert not load.called
+    # a filter saved by another process is picked up
+    filters.FilterIndex().save(db, 2, {'min_slots': 3})
+    assert index.refresh(db).get(2) == {'min_slots': 3}
@@ -0,0 +1,61 @@
+import json
+import socket
+import urllib.error
+import urllib.request
+
+import pytest
+
+from utils import health
+
+
+@pytest.fixture
+def server():
+    health.reset()
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = health.serve(port=port, host='127.0.0.1')
+    yield f'http://127.0.0.1:{port}'
+    server.shutdown()
+    health.reset()
+
+
+def _get(url):
+    try:
+        with urllib.request.urlopen(url) as resp:
+            return resp.status, json.loads(resp.read())
+    except urllib.error.HTTPError as exc:
+        return exc.code, json.loads(exc.read())
+
+
+def test_liveness_and_readiness(server):
+    ready = {'ok': True}
+    health.add_check('fetch', lambda: (ready['ok'], 'last fetch 1 s ago'))
+    health.report(backoff=0)
+    health.heartbeat(60)
+    assert _get(f'{server}/healthz')[0] == 200
+    status, body = _get(f'{server}/readyz')
+    assert status == 200
+    assert body['checks']['fetch'] == {'ok': True, 'detail': 'last fetch 1 s ago'}
+    assert body['state'] == {'backoff': 0}
+    # failing readiness check doesn't make the service dead
+    ready['ok'] = False
+    assert _get(f'{server}/readyz')[0] == 503
+    assert _get(f'{server}/healthz')[0] == 200
+    # the main loop has missed its heartbeat
+    health.heartbeat(-1)
+    status, body = _get(f'{server}/healthz')
+    assert status == 503
+    assert body['checks']['main_loop']['ok'] is False
+
+
+def test_failing_check_is_reported(server):
+    def _check():
+        raise ConnectionError('redis is gone')
+
+    health.add_check('redis', _check, endpoint=health.LIVENESS)
+    status, body = _get(f'{server}/healthz')
+    assert status == 503
+    assert body['checks']['redis']['detail'] == 'ConnectionError: redis is gone'
+    with pytest.raises(urllib.error.HTTPError):
+        urllib.request.urlopen(f'{server}/metrics')
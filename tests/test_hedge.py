@@ -0,0 +1,62 @@
+import asyncio
+import threading
+
+import pytest
+
+from fetcher import hedge
+
+
+def _fetch_func(durations):
+    """Loads of the page take the given time one after another, None means the load fails"""
+    calls = []
+
+    async def _fetch(url, cancel):
+        duration, result = durations[len(calls)]
+        calls.append(cancel)
+        await asyncio.sleep(duration)
+        return None if cancel.is_set() else result
+    return _fetch, calls
+
+
+def _warmed_up(latency=0.05, **kwargs):
+    hedger = hedge.Hedger(min_samples=5, min_delay=0, **kwargs)
+    hedger.latencies.extend([latency] * 10)
+    return hedger
+
+
+@pytest.mark.asyncio
+async def test_slow_load_is_hedged():
+    hedger = _warmed_up()
+    fetch, calls = _fetch_func([(5, 'slow'), (0.01, 'fast')])
+    assert await hedger.fetch(fetch, 'http://example.com') == 'fast'
+    # the slow load has been cancelled
+    assert len(calls) == 2 and calls[0].is_set()
+    assert hedger.stats['hedge_wins'] == 1
+
+
+@pytest.mark.asyncio
+async def test_fast_load_and_budget():
+    hedger = _warmed_up(burst=1, ratio=0)
+    fetch, calls = _fetch_func([(0.01, 'page')])
+    assert await hedger.fetch(fetch, 'http://example.com') == 'page'
+    assert len(calls) == 1
+    # the only token goes to the first failure, the next one waits for the retry
+    fetch, calls = _fetch_func([(0, None), (0.01, 'page')])
+    assert await hedger.fetch(fetch, 'http://example.com') == 'page'
+    assert hedger.tokens == 0
+    fetch, calls = _fetch_func([(0, None), (0.01, 'page')])
+    assert await hedger.fetch(fetch, 'http://example.com') is None
+    assert len(calls) == 1 and hedger.stats['hedges_skipped'] == 1
+
+
+@pytest.mark.asyncio
+async def test_no_hedging_without_spare_or_history():
+    hedger = hedge.Hedger(has_spare=lambda: False, min_samples=5, min_delay=0)
+    fetch, calls = _fetch_func([(0.2, 'page')])
+    # no latency history yet -> no hedge however slow
+    assert hedger.delay() is None
+    assert await hedger.fetch(fetch, 'http://example.com') == 'page'
+    hedger.latencies.extend([0.01] * 10)
+    fetch, calls = _fetch_func([(0.2, 'page')])
+    assert await hedger.fetch(fetch, 'http://example.com') == 'page'
+    assert len(calls) == 1 and hedger.stats['hedges'] == 0 and hedger.stats['hedges_skipped'] == 1
@@ -0,0 +1,18 @@
+import pytest
+
+from utils import importtime
+
+
+@pytest.mark.parametrize('module', importtime.BUDGETS_MS)
+def test_import_time_budget(module):
+    timings = importtime.measure(module)
+    assert timings[module][1] <= importtime.BUDGETS_MS[module], importtime.report(module, timings)
+
+
+@pytest.mark.parametrize('module, heavy', [
+    ('bot.a2exams_bot', {'bs4', 'lxml', 'selenium', 'pyvirtualdisplay', 'fake_useragent'}),
+    ('checker.a2exams_checker', {'bs4', 'lxml', 'pytz', 'csv', 'requests'}),
+    ('fetcher.a2exams_fetcher', {'selenium', 'pyvirtualdisplay', 'requests', 'fake_useragent'}),
+])
+def test_heavy_dependencies_are_lazy(module, heavy):
+    assert not importtime.loaded_modules(module) & heavy
@@ -0,0 +1,105 @@
+import threading
+from unittest import mock
+
+import fakeredis
+import redis
+import telegram
+
+from bot import outbox
+
+
+def _outbox():
+    db = fakeredis.FakeRedis()
+    outbox.ensure_group(db)
+    # creating the group twice is fine
+    outbox.ensure_group(db)
+    return db
+
+
+def test_enqueue_and_consume():
+    db = _outbox()
+    assert outbox.enqueue(db, [('1', 'Praha :)'), ('2', 'Brno :)')]) == 2
+    bot = mock.Mock()
+    assert outbox.consume(db, bot, 'sender-1', block_ms=1) == 2
+    assert [(c.kwargs['chat_id'], c.kwargs['text']) for c in bot.send_message.call_args_list] == [
+        ('1', 'Praha :)'), ('2', 'Brno :)')]
+    # delivered entries are gone
+    assert db.xlen(outbox.STREAM) == 0
+    assert outbox.consume(db, bot, 'sender-1', block_ms=1) == 0
+
+
+def test_entries_of_crashed_sender_are_redelivered():
+    db = _outbox()
+    outbox.enqueue(db, [('1', 'Praha :)')])
+    # the first sender reads the entry and dies before acknowledging it
+    db.xreadgroup(outbox.GROUP, 'crashed-sender', {outbox.STREAM: '>'}, count=10)
+    bot = mock.Mock()
+    with mock.patch('bot.outbox.CLAIM_IDLE_MS', 0):
+        assert outbox.consume(db, bot, 'sender-2', block_ms=1) == 1
+    bot.send_message.assert_called_once_with(chat_id='1', text='Praha :)')
+
+
+def test_consume_errors():
+    db = _outbox()
+    outbox.enqueue(db, [('1', 'Praha :)'), ('2', 'Brno :)'), ('3', 'Kolin :)')])
+    unsubscribed = []
+    bot = mock.Mock()
+    bot.send_message.side_effect = [telegram.error.Unauthorized('blocked'),
+                                    telegram.error.BadRequest('Chat not found'),
+                                    telegram.error.RetryAfter(0), telegram.error.RetryAfter(0)]
+    # unauthorized and broken chats are acknowledged, throttled message stays in the outbox
+    assert outbox.consume(db, bot, 'sender-1', block_ms=1, on_unauthorized=unsubscribed.append) == 2
+    assert unsubscribed == ['1']
+    assert db.xlen(outbox.STREAM) == 1
+    # so does a message telegram could not be reached with
+    bot.send_message.side_effect = telegram.error.TimedOut()
+    with mock.patch('bot.outbox.CLAIM_IDLE_MS', 0):
+        assert outbox.consume(db, bot, 'sender-1', block_ms=1) == 0
+    assert db.xlen(outbox.STREAM) == 1
+    bot.send_message.side_effect = None
+    with mock.patch('bot.outbox.CLAIM_IDLE_MS', 0):
+        assert outbox.consume(db, bot, 'sender-1', block_ms=1) == 1
+    bot.send_message.assert_called_with(chat_id='3', text='Kolin :)')
+
+
+def test_fair_order():
+    subscriptions = {str(i): ['Brno'] if i % 2 else [] for i in range(100)}
+    orders = [outbox.fair_order(subscriptions) for _ in range(5)]
+    for order in orders:
+        assert sorted(order) == sorted(subscriptions)
+        # chats tracking chosen cities come first
+        assert all(subscriptions[chat_id] for chat_id in order[:50])
+    # and the order changes from update to update
+    assert len({tuple(order) for order in orders}) > 1
+
+
+def test_delivery_latency_is_recorded():
+    db = _outbox()
+    with mock.patch('time.time', return_value=1000):
+        outbox.enqueue(db, [('1', 'Praha :)'), ('2', 'Brno :)')], created=990)
+    with mock.patch('time.time', return_value=1002):
+        outbox.consume(db, mock.Mock(), 'sender-1', block_ms=1)
+    stats = outbox.latency_stats(db)
+    assert stats['deliveries'] == 2
+    assert stats['chats'] == 2
+    assert stats['p99'] == stats['chat_p99'] == 12
+    assert 'p99 12.0s' in outbox.format_latency_stats(stats)
+
+
+def test_sender_survives_errors():
+    db = _outbox()
+    stop_event = threading.Event()
+    calls = []
+
+    def _consume(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise ValueError('on_unauthorized has failed')
+        if len(calls) == 2:
+            raise redis.exceptions.ResponseError('NOGROUP No such key or consumer group')
+        stop_event.set()
+        return 0
+
+    with mock.patch('bot.outbox.consume', side_effect=_consume), mock.patch('bot.outbox.READ_BLOCK_MS', 0):
+        outbox.run_sender(db, mock.Mock(), 'sender-1', stop_event)
+    assert len(calls) == 3
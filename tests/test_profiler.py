@@ -0,0 +1,49 @@
+import threading
+import time
+
+from utils import profiler
+
+
+def _busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sample_finds_busy_thread():
+    stop = threading.Event()
+    thread = threading.Thread(target=_busy_loop, args=(stop,), name='busy')
+    thread.start()
+    try:
+        stacks = profiler.sample(0.3, interval=0.005)
+    finally:
+        stop.set()
+        thread.join()
+    busy = {stack: count for stack, count in stacks.items() if stack.startswith('busy;')}
+    assert busy
+    assert any('test_profiler:_busy_loop' in stack for stack in busy)
+    assert 'test_profiler:_busy_loop' in profiler.summary(stacks)
+    line = profiler.collapsed(stacks).splitlines()[0]
+    assert int(line.rsplit(' ', 1)[1]) > 0
+
+
+def test_start_saves_profile(tmp_path):
+    # nothing runs until a profile is requested
+    assert not any(thread.name == 'profiler' for thread in threading.enumerate())
+    done = threading.Event()
+    results = []
+
+    def _on_done(filename, stacks):
+        results.append(filename)
+        done.set()
+
+    assert profiler.start(1, 'test', on_done=_on_done, directory=str(tmp_path))
+    # only one profile at a time
+    assert not profiler.start(1, 'test', directory=str(tmp_path))
+    assert done.wait(5)
+    with open(results[0]) as f:
+        assert 'MainThread;' in f.read()
+    # the lock is released right after on_done
+    time.sleep(0.1)
+    done.clear()
+    assert profiler.start(1, 'test', on_done=_on_done, directory=str(tmp_path))
+    assert done.wait(5)
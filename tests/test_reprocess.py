@@ -0,0 +1,70 @@
+import csv
+import os
+import tempfile
+import zipfile
+from unittest import mock
+
+import pytest
+
+from checker import reprocess
+
+MAIN_PAGE = 'tests/data/last_fetched.html'
+# Tuesday, June 6 2023 9:00
+FIRST_SNAPSHOT_TS = 1686034800
+
+
+def _make_snapshots(dirname):
+    """Brno opens in the second snapshot and closes in the third one"""
+    with open(MAIN_PAGE) as f:
+        html = f.read()
+    opened = html.replace('<a href="?progress=2&amp;town=368" class="btn btn-secondary">Filled</a>',
+                          '<a href="?progress=2&amp;town=368" class="btn btn-primary">Vybrat</a>')
+    # names are deliberately not in time order
+    for i, (name, page) in enumerate([('c.html', html), ('a.html', opened), ('b.html', html)]):
+        path = os.path.join(dirname, name)
+        with open(path, 'w') as f:
+            f.write(page)
+        os.utime(path, (FIRST_SNAPSHOT_TS + i * 600, FIRST_SNAPSHOT_TS + i * 600))
+
+
+def _read_csv(output_dir):
+    with open(os.path.join(output_dir, 'out.csv')) as f:
+        return [row for row in csv.reader(f) if row[2] == 'Brno']
+
+
+def test_reprocess_directory_and_archive():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        snapshots_dir = os.path.join(tmpdir, 'snapshots')
+        os.makedirs(snapshots_dir)
+        _make_snapshots(snapshots_dir)
+        assert [name for _, name in reprocess.list_snapshots(snapshots_dir)] == ['c.html', 'a.html', 'b.html']
+        output_dir = os.path.join(tmpdir, 'out')
+        assert reprocess.reprocess(snapshots_dir, output_dir, workers=2) == 3
+        assert [row[1] for row in _read_csv(output_dir)] == ['False', 'True', 'False']
+        history = reprocess.rollups.load_from_file(os.path.join(output_dir, 'rollups.json'))
+        assert history['cities']['Brno']['openings'] == 1
+        assert history['cities']['Brno']['last_open_seconds'] == 600
+        # the same snapshots zipped
+        archive = os.path.join(tmpdir, 'snapshots.zip')
+        with zipfile.ZipFile(archive, 'w') as zf:
+            for name in ('a.html', 'b.html', 'c.html'):
+                zf.write(os.path.join(snapshots_dir, name), name)
+        assert [name for _, name in reprocess.list_snapshots(archive)] == ['c.html', 'a.html', 'b.html']
+        with pytest.raises(ValueError):
+            reprocess.list_snapshots(MAIN_PAGE)
+
+
+def test_reprocess_resume():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _make_snapshots(tmpdir)
+        output_dir = os.path.join(tmpdir, 'out')
+        # interrupted while processing the last snapshot
+        with mock.patch('checker.reprocess.CHECKPOINT_EVERY', 1), \
+                mock.patch('checker.reprocess.rollups.update', side_effect=[None, None, KeyboardInterrupt]):
+            with pytest.raises(KeyboardInterrupt):
+                reprocess.reprocess(tmpdir, output_dir, workers=1)
+        assert os.path.isfile(os.path.join(output_dir, 'reprocess.checkpoint'))
+        # only the last snapshot is left
+        assert reprocess.reprocess(tmpdir, output_dir, workers=1) == 1
+        assert not os.path.isfile(os.path.join(output_dir, 'reprocess.checkpoint'))
+        assert [row[1] for row in _read_csv(output_dir)] == ['False', 'True', 'False']
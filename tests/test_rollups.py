@@ -0,0 +1,50 @@
+import copy
+import datetime
+import json
+import os
+import tempfile
+
+from checker import rollups
+
+LAST_FETCHED_JSON = 'tests/data/last_fetched.json'
+
+
+def _observation(schools, timestamp, open_cities=()):
+    observed = copy.deepcopy(schools)
+    for city, data in observed.items():
+        data['free_slots'] = city in open_cities
+        data['timestamp'] = timestamp
+    return observed
+
+
+def test_update_rollups():
+    with open(LAST_FETCHED_JSON) as f:
+        schools = json.load(f)
+    # Tuesday, 9:30
+    opened = datetime.datetime(2023, 6, 6, 9, 30).timestamp()
+    history = rollups.empty()
+    assert rollups.update(history, _observation(schools, opened - 60)) == []
+    assert rollups.update(history, _observation(schools, opened, ['Kolin'])) == ['Kolin']
+    # nothing changes while the city stays open
+    assert rollups.update(history, _observation(schools, opened + 60, ['Kolin'])) == []
+    assert rollups.update(history, _observation(schools, opened + 600)) == ['Kolin']
+    kolin = history['cities']['Kolin']
+    assert kolin['openings'] == 1
+    assert kolin['by_hour'][9] == 1 and sum(kolin['by_hour']) == 1
+    assert kolin['by_weekday'][1] == 1 and sum(kolin['by_weekday']) == 1
+    assert (kolin['last_opened'], kolin['last_open_seconds'], kolin['open_since']) == (opened, 600, None)
+    assert history['cities']['Praha']['openings'] == 0
+    assert history['updated'] == opened + 600
+
+    assert rollups.stats_to_str(kolin, now=opened + 3600) == (
+        'Kolín: registration has opened 1 time, last time 1 h 0 min ago, stays open for 10 min on average '
+        '(10 min at most)')
+    assert rollups.forecast_to_str(kolin) == 'Kolín: slots usually appear on Tue at 09:00-10:00 (based on 1 opening)'
+    assert rollups.forecast_to_str(history['cities']['Praha']) == (
+        'Praha: no openings seen yet, nothing to base a forecast on')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'rollups.json')
+        assert rollups.load_from_file(filename) == rollups.empty()
+        rollups.save(history, filename)
+        assert rollups.load_from_file(filename) == history
@@ -0,0 +1,115 @@
+import copy
+import json
+import os
+import tempfile
+from unittest import mock
+
+import fakeredis
+import telegram
+
+from bot import shards
+from checker import a2exams_checker
+from utils import snapshot
+
+LAST_FETCHED_JSON = 'tests/data/last_fetched.json'
+
+
+def _subscriptions(num):
+    db = fakeredis.FakeRedis()
+    for chat_id in range(num):
+        db.set(str(chat_id), 'Praha' if chat_id % 2 else '')
+    return db
+
+
+def test_shards_partition_subscribers():
+    db = _subscriptions(100)
+    loaded = [shards.load_shard(db, shard, 3) for shard in range(3)]
+    assert sum(len(shard) for shard in loaded) == 100
+    assert set().union(*loaded) == {str(chat_id) for chat_id in range(100)}
+    assert loaded[shards.shard_of('1', 3)]['1'] == ['Praha']
+    assert loaded[shards.shard_of('2', 3)]['2'] == []
+
+
+def test_every_subscriber_is_informed_once():
+    with open(LAST_FETCHED_JSON) as f:
+        old_data = json.loads(f.read())
+    new_data = copy.deepcopy(old_data)
+    new_data['Praha']['free_slots'] = True
+    subscriptions = _subscriptions(50)
+    db = fakeredis.FakeRedis()
+    bot = mock.Mock()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'last_fetched.json')
+        snapshot.publish(filename, json.dumps(old_data))
+        workers = [shards.ShardWorker(shard, 4, subscriptions, db, bot,
+                                      snapshot.SnapshotReader(filename, loader=a2exams_checker.load_schools))
+                   for shard in range(4)]
+        # first poll just remembers the state
+        assert sum(worker.poll() for worker in workers) == 0
+        snapshot.publish(filename, json.dumps(new_data))
+        bot.send_message.side_effect = [None] * 10 + [telegram.error.RetryAfter(0)] * 2 + [None] * 100
+        sent = sum(worker.poll() for worker in workers)
+        # the throttled shard resumes where it has stopped
+        sent += sum(worker.poll() for worker in workers)
+        assert sent == 50
+        chat_ids = [c.kwargs['chat_id'] for c in bot.send_message.call_args_list]
+        assert len(set(chat_ids)) == 50
+        # nothing new - nothing is sent
+        assert sum(worker.poll() for worker in workers) == 0
+
+
+def test_single_process_per_shard():
+    db = fakeredis.FakeRedis()
+    reader = mock.Mock()
+    reader.changed.return_value = False
+    worker = shards.ShardWorker(0, 2, fakeredis.FakeRedis(), db, mock.Mock(), reader)
+    other_worker = shards.ShardWorker(0, 2, fakeredis.FakeRedis(), db, mock.Mock(), reader)
+    other_worker.consumer = 'some-other-host'
+    assert worker._hold_lease()
+    assert worker._hold_lease()
+    assert not other_worker._hold_lease()
+
+
+def test_delivery_stops_when_lease_is_lost():
+    with open(LAST_FETCHED_JSON) as f:
+        old_data = json.loads(f.read())
+    new_data = copy.deepcopy(old_data)
+    new_data['Praha']['free_slots'] = True
+    db = fakeredis.FakeRedis()
+    reader = mock.Mock()
+    reader.changed.side_effect = [True, True]
+    reader.get.side_effect = [old_data, new_data]
+    bot = mock.Mock()
+    worker = shards.ShardWorker(0, 1, _subscriptions(10), db, bot, reader)
+    worker.poll()
+
+    def _steal_lease(**kwargs):
+        if bot.send_message.call_count == 3:
+            db.set(f'{worker._prefix}:lease', 'some-other-host')
+
+    bot.send_message.side_effect = _steal_lease
+    with mock.patch('bot.shards.LEASE_RENEW_INTERVAL', 0):
+        assert worker.poll() == 3
+    assert bot.send_message.call_count == 3
+    # the update is left for the new owner of the shard to finish
+    assert worker._get_state('pending') == new_data
+
+
+def test_lease_is_not_renewed_once_taken_over():
+    db = fakeredis.FakeRedis()
+    reader = mock.Mock()
+    worker = shards.ShardWorker(0, 2, fakeredis.FakeRedis(), db, mock.Mock(), reader)
+    assert worker._hold_lease()
+    key = f'{worker._prefix}:lease'
+    # the lease expires and another process takes it right between the check and the renewal
+    db.set(key, 'some-other-host', px=shards.LEASE_MS)
+    assert not worker._hold_lease()
+    assert db.get(key) == b'some-other-host'
+
+
+def test_poll_errors_dont_stop_the_shard():
+    worker = mock.Mock(shard=0, shards=2)
+    worker.poll.side_effect = [KeyError('Praha'), telegram.error.TelegramError('oops'), 3]
+    assert shards.poll_safely(worker) == 0
+    assert shards.poll_safely(worker) == 0
+    assert shards.poll_safely(worker) == 3
@@ -0,0 +1,81 @@
+import concurrent.futures
+import json
+import os
+import tempfile
+
+from utils import snapshot
+
+
+def test_publish_bumps_generation():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'last_fetched.json')
+        assert snapshot.get_generation(filename) == 0
+        assert snapshot.publish(filename, '{"Praha": {}}') == 1
+        assert snapshot.publish(filename, b'{"Brno": {}}') == 2
+        assert snapshot.get_generation(filename) == 2
+        with open(filename) as f:
+            assert json.loads(f.read()) == {'Brno': {}}
+        # no temporary files should be left behind
+        assert sorted(os.listdir(tmpdir)) == ['last_fetched.json', 'last_fetched.json.gen']
+
+
+def test_reader_reloads_only_on_new_generation():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'last_fetched.json')
+        loaded = []
+
+        def _loader(text):
+            loaded.append(text)
+            return json.loads(text)
+
+        reader = snapshot.SnapshotReader(filename, loader=_loader, default={})
+        # nothing has been published yet
+        assert reader.get() == {}
+        assert not reader.changed()
+        snapshot.publish(filename, '{"Praha": {"free_slots": false}}')
+        assert reader.changed()
+        assert reader.get() == {'Praha': {'free_slots': False}}
+        # polling again doesn't touch the file
+        assert not reader.changed()
+        assert reader.get() == {'Praha': {'free_slots': False}}
+        assert len(loaded) == 1
+        snapshot.publish(filename, '{"Praha": {"free_slots": true}}')
+        assert reader.get() == {'Praha': {'free_slots': True}}
+        assert len(loaded) == 2
+        reader.close()
+
+
+def test_reader_without_generation_file():
+    # Files written by someone else than publish() are still tracked by their stat
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'last_fetched.html')
+        with open(filename, 'w') as f:
+            f.write('<html></html>')
+        reader = snapshot.SnapshotReader(filename)
+        assert reader.get() == '<html></html>'
+        assert not reader.changed()
+        with open(filename, 'w') as f:
+            f.write('<html>new data</html>')
+        assert reader.changed()
+        assert reader.get() == '<html>new data</html>'
+
+
+def test_memory_snapshot():
+    source = snapshot.MemorySnapshot()
+    first, second = source.reader(default={}), source.reader(default={})
+    assert first.get() == {}
+    assert not first.changed()
+    data = {'Praha': {'free_slots': True}}
+    source.publish(data)
+    assert first.changed() and second.changed()
+    # data is handed over as is, every reader notices the change on its own
+    assert first.get() is data
+    assert not first.changed() and second.changed()
+
+
+def test_concurrent_publications_dont_lose_generations():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'last_fetched.json')
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda i: snapshot.publish(filename, f'{{"n": {i}}}'), range(200)))
+        assert snapshot.get_generation(filename) == 200
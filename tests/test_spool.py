@@ -0,0 +1,91 @@
+import gzip
+import json
+from unittest import mock
+
+from fetcher import a2exams_fetcher
+from fetcher import spool
+from utils import breaker
+
+
+def test_spool_is_bounded(tmp_path):
+    s = spool.Spool(str(tmp_path), max_entries=3)
+    for i in range(5):
+        s.put({'date': i, 'html': f'<html>{i}</html>'})
+    assert len(s) == 3
+    # the oldest have been dropped
+    assert [entry['date'] for _, entry in s.load()] == [2, 3, 4]
+    s.remove([filename for filename, _ in s.load()[:2]])
+    assert [entry['date'] for _, entry in s.load()] == [4]
+
+
+def test_post_spools_while_registry_is_down(tmp_path, monkeypatch):
+    monkeypatch.setattr(a2exams_fetcher, 'SPOOL', spool.Spool(str(tmp_path)))
+    monkeypatch.setattr(a2exams_fetcher, 'PUSH_BREAKER', breaker.CircuitBreaker('push', threshold=2, base_delay=0))
+    monkeypatch.setattr(a2exams_fetcher, 'get_last_fetch_time', lambda human_readable: '1')
+    with mock.patch('requests.post') as post:
+        post.return_value.ok = False
+        for i in range(3):
+            assert a2exams_fetcher.post(f'<html>{i}</html>', url='http://registry', token='t') is None
+        # nothing is lost and the token is not kept on disk
+        assert len(a2exams_fetcher.SPOOL) == 3
+        assert 'token' not in a2exams_fetcher.SPOOL.load()[0][1]
+        post.return_value.ok = True
+        assert a2exams_fetcher.post('<html>3</html>', url='http://registry', token='t') == '<html>3</html>'
+    # the fresh page goes first, then the spool in one compressed batch in the order of pushes
+    assert post.call_count == 5
+    fresh, batch = post.call_args_list[-2:]
+    assert batch[1]['params'] == {'token': 't', 'batch': 3}
+    assert [entry['html'] for entry in json.loads(gzip.decompress(batch[1]['data']))] == [
+        '<html>0</html>', '<html>1</html>', '<html>2</html>']
+    assert fresh[1]['data']['html'] == '<html>3</html>'
+    assert len(a2exams_fetcher.SPOOL) == 0
+
+
+def test_open_breaker_saves_requests(tmp_path, monkeypatch):
+    monkeypatch.setattr(a2exams_fetcher, 'SPOOL', spool.Spool(str(tmp_path)))
+    monkeypatch.setattr(a2exams_fetcher, 'PUSH_BREAKER', breaker.CircuitBreaker('push', threshold=1, base_delay=60))
+    monkeypatch.setattr(a2exams_fetcher, 'get_last_fetch_time', lambda human_readable: '1')
+    with mock.patch('requests.post') as post:
+        post.return_value.ok = False
+        for i in range(3):
+            a2exams_fetcher.post(f'<html>{i}</html>', url='http://registry', token='t')
+    assert post.call_count == 1
+    assert len(a2exams_fetcher.SPOOL) == 3
+
+
+def test_pushes_are_replayed_to_their_endpoints(tmp_path, monkeypatch):
+    monkeypatch.setattr(a2exams_fetcher, 'SPOOL', spool.Spool(str(tmp_path)))
+    a2exams_fetcher._spool_push({'token': 't', 'date': '1', 'html': '<html>a2</html>'}, 'http://registry/a2')
+    a2exams_fetcher._spool_push({'token': 't', 'date': '1', 'html': '<html>b1</html>'}, 'http://registry/b1')
+    with mock.patch('requests.post') as post:
+        post.return_value.ok = True
+        a2exams_fetcher._replay_spool('http://registry/b1', 't')
+    assert post.call_args[0][0] == 'http://registry/b1'
+    assert json.loads(gzip.decompress(post.call_args[1]['data'])) == [{'date': '1', 'html': '<html>b1</html>'}]
+    assert [entry['html'] for _, entry in a2exams_fetcher.SPOOL.load()] == ['<html>a2</html>']
+
+
+def test_failed_replay_doesnt_hold_up_the_fresh_page(tmp_path, monkeypatch):
+    monkeypatch.setattr(a2exams_fetcher, 'SPOOL', spool.Spool(str(tmp_path)))
+    monkeypatch.setattr(a2exams_fetcher, 'PUSH_BREAKER', breaker.CircuitBreaker('push', threshold=1))
+    monkeypatch.setattr(a2exams_fetcher, 'get_last_fetch_time', lambda human_readable: '1')
+    a2exams_fetcher._spool_push({'token': 't', 'date': '0', 'html': '<html>0</html>'}, 'http://registry')
+    fresh, replay = mock.Mock(ok=True, status_code=200), mock.Mock(ok=False, status_code=503)
+    with mock.patch('requests.post', side_effect=[fresh, replay, fresh, replay]) as post:
+        assert a2exams_fetcher.post('<html>1</html>', url='http://registry', token='t') == '<html>1</html>'
+        # the registry is still considered up and the spool is retried after the next push
+        assert a2exams_fetcher.PUSH_BREAKER.allow()
+        assert a2exams_fetcher.post('<html>2</html>', url='http://registry', token='t') == '<html>2</html>'
+    assert [call[1]['data']['html'] for call in post.call_args_list[::2]] == ['<html>1</html>', '<html>2</html>']
+    assert [entry['html'] for _, entry in a2exams_fetcher.SPOOL.load()] == ['<html>0</html>']
+
+
+def test_rejected_replay_is_dropped(tmp_path, monkeypatch):
+    monkeypatch.setattr(a2exams_fetcher, 'SPOOL', spool.Spool(str(tmp_path)))
+    a2exams_fetcher._spool_push({'token': 't', 'date': '0', 'html': '<html>0</html>'}, 'http://registry')
+    with mock.patch('requests.post', return_value=mock.Mock(ok=False, status_code=429)):
+        assert not a2exams_fetcher._replay_spool('http://registry', 't')
+    assert len(a2exams_fetcher.SPOOL) == 1
+    with mock.patch('requests.post', return_value=mock.Mock(ok=False, status_code=422)):
+        assert a2exams_fetcher._replay_spool('http://registry', 't')
+    assert len(a2exams_fetcher.SPOOL) == 0
@@ -0,0 +1,57 @@
+import urllib.request
+
+import pytest
+
+from checker import a2exams_checker
+from fetcher import a2exams_fetcher
+import standin_site
+
+
+@pytest.fixture()
+def site():
+    site = standin_site.StandinSite(seed=42)
+    site.start()
+    yield site
+    site.stop()
+
+
+async def _http_fetch(url):
+    try:
+        with urllib.request.urlopen(url, timeout=5) as resp:
+            return resp.read().decode('utf-8')
+    except OSError:
+        return None
+
+
+@pytest.mark.asyncio
+async def test_towns_are_rendered_by_javascript(site):
+    site.toggle(368)
+    with urllib.request.urlopen(site.url) as resp:
+        html = resp.read().decode('utf-8')
+    # a plain GET doesn't get the towns list
+    assert await a2exams_checker._html_to_schools(html) == {}
+    schools = await a2exams_checker._html_to_schools(site.rendered_page())
+    assert len(schools) == len(site.towns) == 21
+    assert [city for city in schools if schools[city]['free_slots']] == ['Brno']
+
+
+def test_city_pages(site):
+    assert a2exams_checker._html_to_exam_slots(site.city_page(368))['total'] == 0
+    site.toggle(368)
+    with urllib.request.urlopen(f'{site.url}?progress=2&town=368') as resp:
+        assert a2exams_checker._html_to_exam_slots(resp.read().decode('utf-8'))['total'] == 60
+    assert site.events[-1][1:] == (368, True)
+
+
+def test_captcha(site):
+    site.captcha_rate = 1
+    assert 'https://www.google.com/recaptcha/api2/anchor?' in site.main_page()
+    assert site.stats['captchas'] == 1
+
+
+@pytest.mark.asyncio
+async def test_fetch_recovers_after_outage(site):
+    site.outage(1)
+    html = await a2exams_fetcher.fetch(site.url, fetch_func=_http_fetch, retry_interval=2, attempts=3)
+    assert html
+    assert site.stats['errors'] >= 1
@@ -0,0 +1,87 @@
+import time
+from unittest import mock
+
+import fakeredis
+
+from bot import subscriptions
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_cache_serves_reads_from_memory():
+    db = fakeredis.FakeRedis()
+    db.mset({'1': 'Brno', '2': ''})
+    cache = subscriptions.SubscriptionCache(db)
+    assert cache.load() == 2
+    assert sorted(cache.chat_ids()) == ['1', '2']
+    # redis isn't asked anymore
+    db.set('3', 'Praha')
+    assert cache.get_many(['1', '2', '3']) == {'1': 'Brno', '2': ''}
+    assert cache.stats['misses'] == 0
+
+
+def test_lru_eviction():
+    db = fakeredis.FakeRedis()
+    db.mset({str(i): 'Brno' for i in range(5)})
+    cache = subscriptions.SubscriptionCache(db, max_size=3)
+    # subscribers don't fit, the cache keeps recently used ones only
+    assert cache.load() == 0
+    assert cache.chat_ids() is None
+    assert cache.get('0') == 'Brno'
+    cache.get_many(['1', '2', '3'])
+    assert len(cache) == 3
+    assert cache.stats['evictions'] == 1
+    assert cache.get('0') == 'Brno'
+    assert cache.stats['misses'] == 5
+
+
+def test_reconcile_repairs_missed_changes():
+    db = fakeredis.FakeRedis()
+    db.mset({'1': 'Brno', '2': ''})
+    cache = subscriptions.SubscriptionCache(db)
+    cache.load()
+    # changes nobody has been notified about
+    db.set('1', 'Praha')
+    db.delete('2')
+    db.set('3', '')
+    assert cache.reconcile() == 4
+    assert cache.get_many(['1', '2', '3']) == {'1': 'Praha', '3': ''}
+    assert cache.reconcile() == 0
+
+
+def test_keyspace_notifications_keep_cache_coherent():
+    db = fakeredis.FakeRedis()
+    db.set('1', 'Brno')
+    cache = subscriptions.SubscriptionCache(db)
+    cache.start()
+    try:
+        assert _wait_for(lambda: cache.complete)
+        db.set('1', 'Praha')
+        db.set('2', '')
+        assert _wait_for(lambda: cache.get_many(['1', '2']) == {'1': 'Praha', '2': ''})
+        db.delete('1')
+        assert _wait_for(lambda: cache.chat_ids() == ['2'])
+    finally:
+        cache.stop()
+
+
+def test_listener_survives_unexpected_errors():
+    db = fakeredis.FakeRedis()
+    db.set('1', 'Brno')
+    cache = subscriptions.SubscriptionCache(db)
+    # the first attempt fails, the listener has to retry
+    cache.reconcile = mock.Mock(side_effect=[ValueError('oops'), 0])
+    with mock.patch('bot.subscriptions.RETRY_INTERVAL', 0):
+        cache.start()
+        try:
+            assert _wait_for(lambda: cache.reconcile.call_count == 2)
+            db.set('1', 'Praha')
+            assert _wait_for(lambda: cache.stats['invalidations'] == 1)
+            assert cache.get('1') == 'Praha'
+        finally:
+            cache.stop()
@@ -0,0 +1,79 @@
+import json
+import os
+
+import pytest
+
+from checker import schools_data
+from utils import snapshot
+from utils import targets
+
+
+def _targets():
+    return targets.load(json.dumps([{'name': 'a2', 'url': 'https://example.com/a2'},
+                                    {'name': 'obcanstvi', 'url': 'https://example.com/b1', 'interval': 60,
+                                     'title': 'B1'}]), interval=20)
+
+
+def test_load():
+    main, other = _targets()
+    assert main.main and main.interval == 20 and main.last_fetched == os.path.join(targets.OUTPUT_DIR, 'last_fetched.html')
+    assert not other.main and other.interval == 60
+    assert other.last_fetched_json.endswith('obcanstvi/last_fetched.json')
+    assert other.key('Praha') == 'obcanstvi/Praha' and main.key('Praha') == 'Praha'
+    # no targets configured means the A2 page only
+    assert [t.name for t in targets.load(None)] == ['a2']
+    with pytest.raises(ValueError):
+        targets.load(json.dumps([{'name': 'a2', 'url': 'x'}, {'name': 'a2', 'url': 'y'}]))
+    with pytest.raises(ValueError):
+        targets.load(json.dumps([{'name': 'a2', 'url': 'x', 'profile': 'nosuchprofile'}]))
+
+
+def test_registry_urls():
+    main, other = _targets()
+    assert main.registry_url('url_post', 'https://registry/a2') == 'https://registry/a2'
+    # other targets never go to the endpoints of the main one
+    assert other.registry_url('url_post', 'https://registry/a2') is None
+    other, = targets.load(json.dumps([{'name': 'a2', 'url': 'x'},
+                                      {'name': 'b1', 'url': 'y', 'url_post': 'https://registry/b1'}]))[1:]
+    assert other.registry_url('url_post', 'https://registry/a2') == 'https://registry/b1'
+    assert other.registry_url('url_get', 'https://registry/a2') is None
+
+
+def test_schedule_shares_budget():
+    main, other = _targets()
+    schedule = targets.Schedule([main, other], budget=6, default_backoff=100, now=0)
+    # both are due, the main one goes first
+    assert schedule.next(0) == (main, 0)
+    schedule.started(main, 0)
+    # the other one is due too, but fetches are spaced 10 s apart to stay within 6 a minute
+    assert schedule.next(0) == (other, 10)
+    schedule.started(other, 10)
+    assert schedule.next(10)[1] == float('inf')
+    schedule.done(main, True, 15)
+    assert schedule.next(15) == (main, 20)
+    # a failed fetch backs the target off and the backoff grows
+    schedule.done(other, False, 20)
+    assert schedule.due['obcanstvi'] == 20 + 60 + 100
+    schedule.started(other, 180)
+    schedule.done(other, False, 180)
+    assert schedule.backoff['obcanstvi'] == 300
+    schedule.started(other, 600)
+    schedule.done(other, True, 600)
+    assert schedule.backoff['obcanstvi'] == 0
+
+
+def test_state_reader(tmp_path, monkeypatch):
+    monkeypatch.setattr(targets, 'OUTPUT_DIR', str(tmp_path))
+    main, other = _targets()
+    (tmp_path / 'obcanstvi').mkdir()
+    city = {'free_slots': True, 'city_name': 'Praha', 'total_slots': 0, 'timestamp': '1'}
+    snapshot.publish(main.last_fetched_json, json.dumps({'Praha': city}))
+    reader = schools_data.StateReader([main, other])
+    assert list(reader.get()) == ['Praha']
+    assert not reader.changed()
+    snapshot.publish(other.last_fetched_json, json.dumps({'Praha': dict(city, free_slots=False)}))
+    assert reader.changed()
+    state = reader.get()
+    assert state['obcanstvi/Praha']['city_name'] == 'B1: Praha'
+    assert state['Praha']['city_name'] == 'Praha'
+    assert targets.main_cities(state) == ['Praha']
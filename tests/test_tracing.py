@@ -0,0 +1,58 @@
+import pytest
+
+from bot import a2exams_bot
+from checker import a2exams_checker
+from fetcher import a2exams_fetcher
+from utils import tracing
+
+
+def test_spans_and_report(traces_file):
+    with tracing.span('fetcher.fetch') as root:
+        with tracing.span('fetcher.publish', root) as child:
+            pass
+    assert child[0] == root[0]
+    tracing.record('bot.deliver', 1, 2, root)
+    spans = list(tracing.load_spans([traces_file]))
+    assert [s['name'] for s in spans] == ['fetcher.publish', 'fetcher.fetch', 'bot.deliver']
+    assert {s['trace_id'] for s in spans} == {root[0]}
+    report = tracing.report([traces_file])
+    assert 'fetcher.publish' in report
+    assert 'End to end over 1 traces' in report
+
+
+def test_context_survives_html_and_json():
+    html = tracing.inject('<html></html>', ('a' * 32, 'b' * 16), 42)
+    assert tracing.extract(html) == (('a' * 32, 'b' * 16), 42)
+    assert tracing.extract('<html></html>') == (None, None)
+    assert tracing.from_str(tracing.to_str(('a' * 32, 'b' * 16), 42)) == (('a' * 32, 'b' * 16), 42)
+    assert tracing.from_str(None) == (None, None)
+
+
+@pytest.mark.asyncio
+async def test_trace_goes_from_fetcher_to_bot(tmp_path, main_page_html, traces_file, monkeypatch):
+    monkeypatch.setattr('fetcher.archive.ARCHIVE_MAX_MB', 0)
+
+    async def fetch_func(url):
+        return main_page_html
+
+    html_file = str(tmp_path / 'last_fetched.html')
+    html = await a2exams_fetcher.fetch('http://example.com', filename=html_file, fetch_func=fetch_func)
+    trace, _ = tracing.extract(html)
+    with open(html_file) as f:
+        assert tracing.extract(f.read())[0] == trace
+    schools = await a2exams_checker.html_to_schools(html_file, filename_json=str(tmp_path / 'last_fetched.json'),
+                                                    html=html)
+    bot_trace, _ = a2exams_bot._get_trace(schools)
+    assert bot_trace[0] == trace[0]
+    assert [s['name'] for s in tracing.load_spans([traces_file])] == ['fetcher.fetch', 'fetcher.publish',
+                                                                       'checker.parse']
+
+
+def test_trace_file_is_rolled_over(traces_file, monkeypatch):
+    monkeypatch.setattr('utils.tracing.TRACES_MAX_MB', 1 / 2 ** 20)
+    tracing.record('fetcher.fetch', 1, 2)
+    tracing.record('fetcher.fetch', 3, 4)
+    # every span is bigger than the limit, so only the last one is kept in the previous file
+    assert len(list(tracing.load_spans([traces_file + tracing.ROLLOVER_SUFFIX]))) == 1
+    with pytest.raises(FileNotFoundError):
+        list(tracing.load_spans([traces_file]))
@@ -0,0 +1,42 @@
+import json
+import os
+import tempfile
+from unittest import mock
+
+import utils
+
+
+def test_get_useragent_without_catalog():
+    with mock.patch('utils.USERAGENTS', None), \
+            mock.patch('utils.USERAGENTS_FILE', '/nonexistent/useragents.json'), \
+            mock.patch('utils.USERAGENTS_REFRESH_INTERVAL', 0), \
+            mock.patch('utils._fetch_useragents', side_effect=AssertionError('No network at startup')):
+        assert utils.get_useragent() in utils.FALLBACK_USERAGENTS
+
+
+def test_useragents_catalog():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'useragents.json')
+        with mock.patch('utils.USERAGENTS', None), \
+                mock.patch('utils._fetch_useragents', return_value=['Mozilla/5.0 Firefox/120.0']):
+            assert utils.refresh_useragents(filename)
+            with open(filename) as f:
+                assert json.loads(f.read()) == ['Mozilla/5.0 Firefox/120.0']
+        with mock.patch('utils.USERAGENTS', None), \
+                mock.patch('utils.USERAGENTS_FILE', filename), \
+                mock.patch('utils.USERAGENTS_REFRESH_INTERVAL', 0):
+            assert utils.get_useragent() == 'Mozilla/5.0 Firefox/120.0'
+        # failed refresh keeps the catalog as it is
+        with mock.patch('utils._fetch_useragents', side_effect=Exception('No network')):
+            assert not utils.refresh_useragents(filename)
+        with open(filename) as f:
+            assert json.loads(f.read()) == ['Mozilla/5.0 Firefox/120.0']
+
+
+def test_percentile():
+    assert utils.percentile([], 50) == 0
+    assert utils.percentile([3, 1, 2], 50) == 2
+    assert utils.percentile([4, 1, 3, 2], 50) == 2
+    assert utils.percentile([4, 1, 3, 2], 0) == 1
+    assert utils.percentile([4, 1, 3, 2], 100) == 4
+    assert utils.percentile(range(101), 99) == 99